@@ -0,0 +1,591 @@
+'''asyncio backend.
+
+awirc.aio.Client has the same API as awirc.socket.Client (awirc.Client),
+except connect, flush and disconnect are coroutines and send can't block,
+a full outbound queue always drops messages (outbound_policy 'drop'). It
+is also returned by awirc.create_client(..., backend='asyncio'). Works
+with any asyncio event loop implementing BufferedProtocol (e.g. uvloop).
+
+Handlers run inline in the event loop by default, coroutine functions are
+scheduled as tasks and regular functions bound with spawn=True (or all of
+them without inline) run in the loop's default executor. send called
+from there is passed on to the loop, other client methods are not thread
+safe (use loop.call_soon_threadsafe). max_handlers bounds the handlers
+running at the same time, further handlers wait for their turn.
+'''
+import functools
+import traceback
+import asyncio
+import sys
+
+from awirc.client import BaseClient
+from awirc.protocol import Protocol
+import awirc.reconnect
+import awirc.scheduler
+import awirc.tls
+import awirc.wire
+
+
+class TaskPool(object):
+    '''the asyncio counterpart of a gevent Group (or a Pool with size),
+    used to spawn handlers'''
+    def __init__(self, size=None):
+        self.size = size
+        self._tasks = set()
+        self._running = 0
+        # created on first use, inside the event loop
+        self._semaphore = None
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def full(self):
+        return self.size is not None and self._running >= self.size
+
+    def free_count(self):
+        if self.size is None:
+            return 1
+        return max(0, self.size - self._running)
+
+    def spawn(self, func, *args):
+        loop = asyncio.get_event_loop()
+
+        if self.size is not None:
+            task = loop.create_task(self._run_bounded(func, args))
+        elif asyncio.iscoroutinefunction(func):
+            task = loop.create_task(func(*args))
+        else:
+            task = loop.run_in_executor(None, func, *args)
+
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def kill(self, block=True, timeout=None):
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def _run_bounded(self, func, args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        async with self._semaphore:
+            self._running += 1
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    return await func(*args)
+                return await asyncio.get_running_loop().run_in_executor(
+                    None, func, *args
+                )
+            finally:
+                self._running -= 1
+
+    async def join(self, timeout=None):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+
+class _Protocol(asyncio.BufferedProtocol):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def connection_made(self, transport):
+        self.connection._connection_made(transport)
+
+    def get_buffer(self, sizehint):
+        return self.connection._get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.connection._buffer_updated(nbytes)
+
+    def eof_received(self):
+        return False
+
+    def connection_lost(self, exc):
+        self.connection._connection_lost()
+
+    def pause_writing(self):
+        self.connection._can_write.clear()
+
+    def resume_writing(self):
+        self.connection._can_write.set()
+
+
+class Connection(object):
+    '''the asyncio version of awirc.socket.Connection'''
+    delimiter = awirc.wire.DELIMITER
+    max_line_length = awirc.wire.MAX_LINE_LENGTH
+    chunk_size = 4096
+    max_chunk_size = 65536
+    max_write_size = 16384
+    max_write_lines = 1024
+
+    hold_until_registered = False
+
+    # without inline, reading is paused while max_inbound lines wait to be
+    # dispatched. send can't block a coroutine, a full outbound queue
+    # always drops messages (PRIORITY_LOW first)
+    max_inbound = 10000
+    max_outbound = 0
+    outbound_policy = 'drop'
+
+    def __init__(self, pool, host, port, ssl=False, inline=True,
+                 chunk_size=None, scheduler=None, reconnect=None,
+                 max_inbound=None, max_outbound=None, outbound_policy=None):
+        self._pool = pool
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+            self.max_chunk_size = max(self.max_chunk_size, chunk_size)
+        if max_inbound is not None:
+            self.max_inbound = max_inbound
+        if max_outbound is not None:
+            self.max_outbound = max_outbound
+        if outbound_policy is not None:
+            self.outbound_policy = outbound_policy
+        if self.outbound_policy != 'drop':
+            raise ValueError(
+                'unknown outbound_policy {!r}, send can\'t block a '
+                'coroutine'.format(self.outbound_policy)
+            )
+
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.server_hostname = host
+        self.inline = inline
+
+        self._transport = None
+        self._writer = None
+        # the loop of the connection, send passes calls from other threads
+        # (handlers in the executor) on to it
+        self._loop = None
+        # lines scheduled with call_soon but not dispatched yet
+        self._in_pending = 0
+        self._reading_paused = False
+
+        self._connected = False
+        self._closed = asyncio.Event()
+        self._terminated = False
+        self._connected_at = None
+
+        if reconnect is True:
+            reconnect = awirc.reconnect.Backoff()
+        self.reconnect = reconnect or None
+        self._reconnect_attempt = 0
+        self._connect_args = dict()
+        self._out_priority = None
+
+        if scheduler is None:
+            # flood control by default, awirc.scheduler.Scheduler() without
+            # a bucket sends as fast as the socket allows
+            scheduler = awirc.scheduler.Scheduler(
+                awirc.scheduler.TokenBucket()
+            )
+        self.scheduler = scheduler
+        self._out_ready = asyncio.Event()
+        self._out_flushed = asyncio.Event()
+        self._out_flushed.set()
+        self._out_pending = 0
+        self.dropped = 0
+        # cleared while the transport's write buffer is full
+        self._can_write = asyncio.Event()
+        self._can_write.set()
+
+        self._buffer = bytearray(self.chunk_size)
+        self._view = memoryview(self._buffer)
+        self._end = 0
+        # set while the rest of an over-long line is dropped
+        self._skipping = False
+        # size of the buffer for the next read
+        self._size = self.chunk_size
+
+        self.lines_in = 0
+        self.overlong_lines = 0
+        self.bytes_in = 0
+        self.lines_out = 0
+        self.bytes_out = 0
+
+    async def connect(self, timeout=10, source=None, ssl_args=None,
+                      happy_eyeballs=False, handshake_timeout=None):
+        '''asyncio transports can't resume TLS sessions, the contexts are
+        shared like with the gevent backend'''
+        if ssl_args is None:
+            ssl_args = dict()
+        self._connect_args = dict(timeout=timeout, source=source,
+                                  ssl_args=ssl_args,
+                                  happy_eyeballs=happy_eyeballs,
+                                  handshake_timeout=handshake_timeout)
+        self._terminated = False
+
+        tls = dict()
+        if self.ssl:
+            tls = dict(
+                ssl=awirc.tls.context(ssl_args),
+                server_hostname=ssl_args.get('server_hostname',
+                                             self.server_hostname),
+                ssl_handshake_timeout=handshake_timeout or timeout
+            )
+
+        loop = self._loop = asyncio.get_running_loop()
+        await asyncio.wait_for(
+            loop.create_connection(
+                lambda: _Protocol(self), self.host, self.port,
+                local_addr=source,
+                happy_eyeballs_delay=0.25 if happy_eyeballs else None,
+                **tls
+            ),
+            timeout
+        )
+
+    def _connection_made(self, transport):
+        # called before any data is received
+        self._transport = transport
+        self._reading_paused = False
+        self._connected = True
+        self._connected_at = asyncio.get_event_loop().time()
+        if self.hold_until_registered and self.reconnect is not None:
+            self._out_priority = awirc.scheduler.PRIORITY_HIGH
+        self._closed.clear()
+        self._writer = asyncio.get_event_loop().create_task(self._write())
+
+        self.handle_connect()
+
+    def _get_buffer(self):
+        # the transport holds on to the buffer during buffer_updated,
+        # so resizing is done here
+        size = self._size
+        if self._end == size:
+            if size >= self.max_chunk_size:
+                # a line longer than max_chunk_size is dropped up to its
+                # delimiter, keep what may be the start of the delimiter
+                if not self._skipping:
+                    self.overlong_lines += 1
+                self._skipping = True
+                keep = len(self.delimiter) - 1
+                self._buffer[:keep] = self._buffer[self._end - keep:self._end]
+                self._end = keep
+            else:
+                # a single line doesn't fit into the buffer
+                size = self._size = min(size * 2, self.max_chunk_size)
+        if size != len(self._buffer):
+            self._resize(size)
+        return self._view[self._end:]
+
+    def _resize(self, size):
+        self._view.release()
+        if size > len(self._buffer):
+            self._buffer.extend(bytes(size - len(self._buffer)))
+        else:
+            del self._buffer[size:]
+        self._view = memoryview(self._buffer)
+
+    def _buffer_updated(self, received):
+        # same buffer handling as awirc.socket.Connection._read
+        buffer, view = self._buffer, self._view
+        delimiter = self.delimiter
+
+        self.bytes_in += received
+        filled = self._end + received == len(buffer)
+        end = self._end + received
+
+        start = 0
+        if self._skipping:
+            pos = buffer.find(delimiter, 0, end)
+            if pos == -1:
+                self._end = end
+                return
+            start = pos + len(delimiter)
+            self._skipping = False
+
+        pos = buffer.find(delimiter, start, end)
+        while pos != -1:
+            self.lines_in += 1
+            self._line_received(bytes(view[start:pos]).strip())
+            start = pos + len(delimiter)
+            pos = buffer.find(delimiter, start, end)
+
+        if start:
+            buffer[:end - start] = buffer[start:end]
+            end -= start
+        self._end = end
+
+        size = len(buffer)
+        if filled and size < self.max_chunk_size:
+            self._size = min(size * 2, self.max_chunk_size)
+        elif not end and received < size // 4 and size > self.chunk_size:
+            self._size = max(size // 2, self.chunk_size)
+
+    def _line_received(self, line):
+        if self.inline:
+            try:
+                self.line_received(line)
+            except Exception:
+                self.handle_error(self.line_received, *sys.exc_info())
+        else:
+            self._in_pending += 1
+            if self.max_inbound and self._in_pending >= self.max_inbound \
+                    and not self._reading_paused:
+                self.report_overload('inbound', queued=self._in_pending)
+                self._reading_paused = True
+                self._transport.pause_reading()
+            asyncio.get_event_loop().call_soon(self._dispatch, line)
+
+    def _dispatch(self, line):
+        self._in_pending -= 1
+        try:
+            self.line_received(line)
+        except Exception:
+            self.handle_error(self.line_received, *sys.exc_info())
+
+        if self._reading_paused and \
+                self._in_pending <= self.max_inbound // 2:
+            self._reading_paused = False
+            self.clear_overload('inbound')
+            if self._transport is not None:
+                self._transport.resume_reading()
+
+    def _connection_lost(self):
+        was_connected = self._connected
+        self._connected = False
+        if was_connected:
+            self.handle_disconnect()
+        if self._terminated:
+            return
+        if self.reconnect is None:
+            self.terminate()
+            return
+
+        # keep the handlers and the queued messages
+        self._transport = None
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        self._end = 0
+        self._skipping = False
+
+        loop = asyncio.get_event_loop()
+        if loop.time() - self._connected_at >= self.reconnect.stable:
+            self._reconnect_attempt = 0
+        self._pool.spawn(self._reconnect)
+
+    async def _reconnect(self):
+        while not self._terminated:
+            attempt = self._reconnect_attempt
+            delay = self.reconnect.delay(attempt)
+            self._reconnect_attempt += 1
+
+            self.handle_reconnect(attempt, delay)
+            await asyncio.sleep(delay)
+            try:
+                await self.connect(**self._connect_args)
+            except (OSError, asyncio.TimeoutError):
+                continue
+            return
+
+    async def _write(self):
+        scheduler = self.scheduler
+
+        while True:
+            message, delay = scheduler.pop(max_priority=self._out_priority)
+            if message is None:
+                self._out_ready.clear()
+                try:
+                    await asyncio.wait_for(self._out_ready.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            batch = [message]
+            size = len(message)
+            while len(batch) < self.max_write_lines:
+                message, _ = scheduler.pop(self.max_write_size - size,
+                                           self._out_priority)
+                if message is None:
+                    break
+                batch.append(message)
+                size += len(message)
+
+            try:
+                await self._can_write.wait()
+                self._transport.writelines(batch)
+                self.lines_out += len(batch)
+                self.bytes_out += size
+            finally:
+                # a batch lost with the connection (the writer is
+                # cancelled) isn't pending anymore either
+                self._out_pending -= len(batch)
+                if not self._out_pending:
+                    self._out_flushed.set()
+            if self._overloaded and \
+                    len(scheduler) <= self.max_outbound // 2:
+                self.clear_overload('outbound')
+
+    def release_outbound(self):
+        '''sends all queued messages, not just the registration'''
+        self._out_priority = None
+        self._out_ready.set()
+
+    async def flush(self, timeout=None):
+        '''waits until all queued messages were handed to the transport,
+        returns False if the timeout expired before that'''
+        try:
+            await asyncio.wait_for(self._out_flushed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def send(self, data, priority=awirc.scheduler.PRIORITY_NORMAL,
+             target=None, first=False):
+        if isinstance(data, bytes) and data.endswith(self.delimiter):
+            message = data
+        else:
+            message = awirc.wire.encode(data, self.max_line_length,
+                                        self.delimiter)
+
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not loop:
+                # a handler in the executor, the result isn't known yet
+                loop.call_soon_threadsafe(functools.partial(
+                    self.send, message, priority, target, first
+                ))
+                return True
+
+        scheduler = self.scheduler
+        if self.max_outbound and len(scheduler) >= self.max_outbound \
+                and priority != awirc.scheduler.PRIORITY_HIGH:
+            self.report_overload('outbound', queued=len(scheduler))
+            self.dropped += 1
+            if priority == awirc.scheduler.PRIORITY_LOW or \
+                    scheduler.drop(awirc.scheduler.PRIORITY_LOW) is None:
+                return False
+            self._out_pending -= 1
+
+        scheduler.put(message, priority=priority, target=target,
+                      first=first)
+        self._out_pending += 1
+        self._out_flushed.clear()
+        self._out_ready.set()
+        return True
+
+    @property
+    def connected(self):
+        return self._connected
+
+    def peername(self):
+        return self._transport.get_extra_info('peername')
+
+    def traffic_stats(self):
+        return {
+            'connected': self._connected,
+            'host': self.host,
+            'port': self.port,
+            'lines_in': self.lines_in,
+            'overlong_lines': self.overlong_lines,
+            'bytes_in': self.bytes_in,
+            'lines_out': self.lines_out,
+            'bytes_out': self.bytes_out,
+            'inbound_queued': self._in_pending,
+            'dropped': self.dropped,
+            'overloads': dict(self.overloads),
+            'tls_resumed': False,
+            'scheduler': self.scheduler.stats(),
+        }
+
+    def abort(self):
+        '''closes the connection as if the server did, it is reconnected
+        if reconnect is set'''
+        if self._transport is not None:
+            self._transport.abort()
+
+    def terminate(self, block=True, timeout=None):
+        self._terminated = True
+        self._connected = False
+        if self._transport is not None:
+            self._transport.close()
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+        self._pool.kill()
+        self._closed.set()
+
+    async def wait_closed(self):
+        '''waits until the connection is terminated'''
+        await self._closed.wait()
+
+    # primitives used by awirc.query
+    def _new_future(self):
+        return asyncio.get_event_loop().create_future()
+
+    def _new_queue(self):
+        return asyncio.Queue()
+
+    def _call_later(self, seconds, func, *args):
+        '''calls func after seconds, returns a function cancelling it'''
+        return asyncio.get_event_loop().call_later(seconds, func, *args).cancel
+
+    def handle_connect(self):
+        pass
+
+    def handle_disconnect(self):
+        pass
+
+    def handle_reconnect(self, attempt, delay):
+        pass
+
+    def handle_error(self, context, type, value, tb):
+        traceback.print_exception(type, value, tb)
+
+
+class Client(BaseClient, Connection, Protocol):
+    def __init__(self, nickname, host, port, ssl=False,
+                 username=None, realname=None, password=None, inline=True,
+                 chunk_size=None, scheduler=None, handler_pool=None,
+                 caps=None, reconnect=None, max_inbound=None,
+                 max_outbound=None, outbound_policy=None, max_handlers=None,
+                 ping_interval=None, ping_timeout=None):
+        self._pool = TaskPool()
+        # handlers run in handler_pool if one is given, otherwise in a
+        # pool of this client running up to max_handlers
+        self._handler_tasks = None
+        if handler_pool is None and max_handlers:
+            handler_pool = self._handler_tasks = TaskPool(max_handlers)
+        if handler_pool is None:
+            handler_pool = self._pool
+
+        Connection.__init__(self, self._pool, host, port, ssl=ssl,
+                            inline=inline, chunk_size=chunk_size,
+                            scheduler=scheduler, reconnect=reconnect,
+                            max_inbound=max_inbound,
+                            max_outbound=max_outbound,
+                            outbound_policy=outbound_policy)
+        BaseClient.__init__(self, handler_pool, nickname, username=username,
+                            realname=realname, password=password,
+                            inline=inline, caps=caps,
+                            ping_interval=ping_interval,
+                            ping_timeout=ping_timeout)
+        Protocol.__init__(self)
+
+    @property
+    def task_pool(self):
+        return self._pool
+
+    def terminate(self, block=True, timeout=None):
+        Connection.terminate(self, block=block, timeout=timeout)
+        if self._handler_tasks is not None:
+            self._handler_tasks.kill()
+
+    def bind(self, event_type, handler, spawn=None, **filters):
+        # coroutines have to be scheduled as a task
+        if spawn is None and asyncio.iscoroutinefunction(handler):
+            spawn = True
+        BaseClient.bind(self, event_type, handler, spawn=spawn, **filters)
+
+    async def disconnect(self, msg='', timeout=1):
+        self.quit(msg)
+        await self.flush(timeout=timeout)
+        self.terminate()
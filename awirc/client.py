@@ -0,0 +1,491 @@
+import time
+import sys
+
+from awirc.event import EventManager
+from awirc.protocol import Batch, Protocol
+import awirc.metrics
+import awirc.query
+import awirc.scheduler
+import awirc.utils
+
+
+class BaseClient(EventManager):
+    '''the backend independent part of a client, a client combines it
+    with the Connection of a backend and Protocol:
+
+        class Client(BaseClient, Connection, Protocol)
+
+    IRCv3 capabilities in caps (default_caps if None) are requested if the
+    server offers them. Batches are dispatched as one BATCH_<TYPE> event
+    (e.g. BATCH_NETSPLIT, args is the awirc.protocol.Batch) if handlers
+    are bound for it, otherwise the messages are dispatched one by one.
+
+    OVERLOAD is dispatched (inline) when a bounded stage is full, args is
+    (stage, info), see Connection.max_inbound and max_outbound.
+
+    The keepalive is off by default. With ping_interval the client sends
+    a PING once nothing was received for ping_interval seconds (or lag
+    wasn't measured for lag_interval), lag is the round trip time (rtt
+    keeps a histogram of them). If nothing is received within
+    ping_timeout of a PING, PING_TIMEOUT is dispatched (args is the
+    seconds waited) and the connection is aborted, it is reconnected like
+    any other lost connection.
+    '''
+    # capabilities requested by default if the server offers them,
+    # echo-message changes what handlers see and has to be requested
+    default_caps = ('multi-prefix', 'server-time', 'batch', 'message-tags',
+                    'extended-join', 'userhost-in-names', 'away-notify',
+                    'account-notify', 'cap-notify')
+
+    # with reconnect registration messages go first, see
+    # Connection.release_outbound
+    hold_until_registered = True
+
+    # parses a received line (bytes) into a Message, None for empty lines
+    parse_message = staticmethod(awirc.utils.parse_message)
+
+    # keepalive, seconds, None disables it
+    ping_interval = None
+    ping_timeout = 30.0
+    lag_interval = 120.0
+
+    def __init__(self, pool, nickname, username=None, realname=None,
+                 password=None, inline=False, caps=None, ping_interval=None,
+                 ping_timeout=None):
+        EventManager.__init__(self, pool, inline=inline)
+        if ping_interval is not None:
+            self.ping_interval = ping_interval
+        if ping_timeout is not None:
+            self.ping_timeout = ping_timeout
+
+        self.nickname = nickname
+        self.username = username or self.nickname
+        self.realname = realname or self.nickname
+        self.password = password
+
+        self.server_name = None
+        # set by awirc.state.StateTracker
+        self.state = None
+        # WHO, WHOIS, NAMES, LIST and MODE requests returning futures
+        self.queries = awirc.query.QueryManager(self)
+
+        # the message currently dispatched, only valid in inline handlers
+        self.message = None
+
+        # capabilities to request, offered by the server (name -> value)
+        # and enabled
+        self.caps_wanted = set(self.default_caps if caps is None else caps)
+        self.server_caps = dict()
+        self.caps = set()
+        self._cap_pending = 0
+        self._cap_negotiating = False
+        # open batches, ref -> Batch
+        self._batches = dict()
+
+        # lowered name -> name of the joined channels, rejoined after a
+        # reconnect
+        self.joined = dict()
+        self._rejoin = None
+        # name -> key of the joined channels with a key, saved when the
+        # connection drops (the state tracker forgets them on DISCONNECT)
+        self._rejoin_keys = dict()
+
+        # keepalive state, the token and time of the unanswered PING
+        self.rtt = awirc.metrics.Histogram(awirc.metrics.LAG_BUCKETS)
+        self.ping_timeouts = 0
+        self._lag = None
+        self._lag_measured = None
+        self._ping_token = None
+        self._ping_sent = None
+        self._keepalive_bytes = 0
+        self._cancel_keepalive = None
+
+        # bind intern events!
+        for evt, handler in [('001', self.handle_001),
+                             ('005', self.handle_005),
+                             ('CAP', self.handle_cap),
+                             ('JOIN', self.handle_join),
+                             ('PART', self.handle_part),
+                             ('KICK', self.handle_kick),
+                             ('396', self.handle_displayed_host),
+                             ('376', self.handle_motd_end),
+                             ('422', self.handle_motd_end),
+                             ('PING', self.handle_pong),
+                             ('PONG', self.handle_keepalive_pong)]:
+            self.bind(evt, handler, spawn=False)
+
+    def line_received(self, line):
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+
+        if self.has_handlers('RAW_MESSAGE'):
+            self.process_event(
+                'RAW_MESSAGE', self.server_name, None,
+                awirc.utils.decode(line)
+            )
+
+        msg = self.parse_message(line)
+        if msg is None:
+            return
+
+        if not self.server_name:
+            # get the real server name, the server sends the first
+            # messages, so we get to know the servers name.
+            self.server_name = str(msg.prefix)
+
+        if msg.command == 'BATCH':
+            self._batch(msg)
+        elif self._batches and msg.has_tags:
+            batch = self._batches.get(msg.tags.get('batch'))
+            if batch is not None and batch.aggregate:
+                batch.messages.append(msg)
+                return
+
+        self.message_received(msg)
+
+    def message_received(self, msg):
+        '''dispatches the events of a parsed message'''
+        self.message = msg
+
+        if msg.command == 'NICK' and msg.prefix.nick == self.nickname:
+            self.nickname = msg.args[0]
+
+        for event in self.message_events(msg):
+            self.process_event(*event)
+
+    def message_events(self, msg):
+        '''yields the (event_type, source, target, args) events of msg'''
+        is_chan = False
+        if msg.args and msg.args[0]:
+            is_chan = awirc.utils.is_channel(msg.args[0])
+
+        target = None
+        command, args = msg.command, msg.args
+        if command in ('NOTICE', 'PRIVMSG'):
+            is_priv = command == 'PRIVMSG'
+            target = args[0]
+            text = args[1]
+
+            if awirc.utils.X_DELIM in text:
+                normal_msgs, extended_msgs = awirc.utils.extract_ctcp(text)
+                if extended_msgs:
+                    for tag, data in extended_msgs:
+                        type_ = 'CTCP_' if is_priv else 'CTCPREPLY_'
+                        yield (type_+tag, msg.prefix, target, data)
+
+                if not normal_msgs:
+                    return
+
+                text = ' '.join(normal_msgs)
+
+            if is_chan:
+                if is_priv:
+                    command = 'PUBMSG'
+                else:
+                    command = 'PUBNOTICE'
+            elif not is_priv:
+                command = 'PRIVNOTICE'
+            #else
+            #    command = 'PRIVMSG'
+
+            args = text
+        elif command in ('KICK', 'BAN', 'MODE', 'JOIN', 'PART'):
+            target = args[0]
+            args = args[1:]
+
+        yield (command, msg.prefix, target, args)
+
+    def _batch(self, msg):
+        ref = msg.args[0] if msg.args else ''
+
+        if ref.startswith('+'):
+            batch = Batch(ref[1:], msg.args[1] if len(msg.args) > 1 else '',
+                          msg.args[2:], msg.tags)
+            parent = self._batches.get(batch.tags.get('batch'))
+            # nested batches of an aggregated batch are aggregated too
+            batch.aggregate = bool(
+                (parent is not None and parent.aggregate) or
+                self.has_handlers('BATCH_' + batch.type)
+            )
+            self._batches[batch.ref] = batch
+        elif ref.startswith('-'):
+            batch = self._batches.pop(ref[1:], None)
+            if batch is None or not batch.aggregate:
+                return
+
+            parent = self._batches.get(batch.tags.get('batch'))
+            if parent is not None and parent.aggregate:
+                parent.messages.append(batch)
+                return
+
+            if self.state is not None:
+                self.state.process_batch(batch)
+            self.process_event(
+                'BATCH_' + batch.type, msg.prefix, None, batch
+            )
+
+    def handle_connect(self):
+        self.host, self.port = self.peername()[:2]
+
+        self.server_caps.clear()
+        self.caps.clear()
+        self._batches.clear()
+        self.own_userhost = None
+        self._start_keepalive()
+        if self.caps_wanted:
+            # the server waits with the registration until CAP END
+            self._cap_negotiating = True
+            self.cap('LS', '302')
+
+        if self.password:
+            self.pass_(self.password)
+
+        self.nick(self.nickname)
+        self.user(self.realname, self.username)
+
+        self.process_event(
+            'CONNECT', self.server_name, None, None
+        )
+
+    def handle_disconnect(self):
+        self._stop_keepalive()
+        # before a failed reconnect attempt joined is already empty
+        if self._rejoin is None:
+            self._rejoin_keys = self._channel_keys(self.joined.values())
+        self.process_event(
+            'DISCONNECT', self.server_name, None, None
+        )
+
+    def handle_reconnect(self, attempt, delay):
+        if self._rejoin is None:
+            self._rejoin = list(self.joined.values())
+        self.joined.clear()
+        self.process_event(
+            'RECONNECTING', self.server_name, None, (attempt, delay)
+        )
+
+    def handle_overload(self, stage, info):
+        # OVERLOAD handlers always run inline, a spawned handler would
+        # wait for the exhausted pool
+        args = (self.server_name, None, (stage, info))
+        handlers = self.get_handlers('OVERLOAD') + \
+            self.get_filtered_handlers('OVERLOAD', args)
+        for handler, _ in handlers:
+            try:
+                handler('OVERLOAD', *args)
+            except Exception:
+                self.handle_error(handler, *sys.exc_info())
+
+    @property
+    def lag(self):
+        '''seconds, the round trip time of the last keepalive PING or how
+        long the current PING is unanswered if that is longer, None until
+        the first PING'''
+        if self._ping_sent is not None:
+            waiting = time.monotonic() - self._ping_sent
+            if self._lag is None or waiting > self._lag:
+                return waiting
+        return self._lag
+
+    def _start_keepalive(self):
+        self._stop_keepalive()
+        self._lag = self._ping_token = self._ping_sent = None
+        self._lag_measured = time.monotonic()
+        self._keepalive_bytes = self.bytes_in
+        if self.ping_interval:
+            self._cancel_keepalive = self._call_later(
+                self.ping_interval, self._keepalive
+            )
+
+    def _stop_keepalive(self):
+        if self._cancel_keepalive is not None:
+            self._cancel_keepalive()
+            self._cancel_keepalive = None
+
+    def _keepalive(self):
+        # nothing on the hot path, idle means bytes_in didn't change
+        # since the last run
+        self._cancel_keepalive = None
+        if not self.connected or not self.ping_interval:
+            return
+        now = time.monotonic()
+        received = self.bytes_in != self._keepalive_bytes
+        self._keepalive_bytes = self.bytes_in
+        delay = self.ping_interval
+
+        if self._ping_sent is not None:
+            waited = now - self._ping_sent
+            if waited < self.ping_timeout:
+                delay = self.ping_timeout - waited
+            elif not received:
+                self.ping_timeouts += 1
+                self.process_event(
+                    'PING_TIMEOUT', self.server_name, None, waited
+                )
+                self.abort()
+                return
+            else:
+                # the server is alive, it just doesn't answer our PING
+                self._lag = waited
+                self._ping_token = self._ping_sent = None
+
+        if self._ping_sent is None and (not received or (
+                self.lag_interval is not None and
+                now - self._lag_measured >= self.lag_interval)):
+            self._ping_sent = now
+            self._ping_token = 'awirc-{:.6f}'.format(now)
+            self.send('PING :' + self._ping_token,
+                      priority=awirc.scheduler.PRIORITY_HIGH)
+            delay = self.ping_timeout
+
+        self._cancel_keepalive = self._call_later(delay, self._keepalive)
+
+    def _channel_keys(self, channels):
+        keys = dict()
+        if self.state is not None:
+            for name in channels:
+                channel = self.state.channel(name)
+                if channel is not None and channel.modes.get('k'):
+                    keys[name] = channel.modes['k']
+        return keys
+
+    def rejoin(self, channels, keys=None):
+        '''joins channels in batches (TARGMAX) before other queued
+        messages, keys maps channel names to their keys (default the keys
+        known by the state tracker)'''
+        if keys is None:
+            keys = self._channel_keys(channels)
+        self.join_channels(channels, keys, first=True)
+
+    def nick(self, newnick):
+        Protocol.nick(self, newnick)
+        self.nickname = newnick
+
+    # intern events
+    def handle_001(self, event_type, source, target, args):
+        self.nickname = args[0]
+        # registered, the server did not understand CAP
+        self._cap_negotiating = False
+        if not self._rejoin:
+            self.release_outbound()
+
+    def handle_005(self, event_type, source, target, args):
+        f, b = awirc.utils.parse_005(args)
+        self.rpl_isupport[0].extend(f)
+        self.rpl_isupport[1].update(b)
+        # the same casemapping the state tracker uses
+        if 'CASEMAPPING' in b:
+            self.set_casemapping(b['CASEMAPPING'])
+
+    def set_casemapping(self, casemapping):
+        EventManager.set_casemapping(self, casemapping)
+        # joined is keyed like the state tracker
+        self.joined = dict(
+            (self._key(name), name) for name in self.joined.values()
+        )
+
+    def handle_cap(self, event_type, source, target, args):
+        # <nick> <subcommand> [*] :<caps>
+        if len(args) < 3:
+            return
+        subcommand = args[1].upper()
+        more = len(args) > 3 and args[2] == '*'
+        caps = args[-1].split()
+
+        if subcommand in ('LS', 'NEW'):
+            for cap in caps:
+                name, _, value = cap.partition('=')
+                self.server_caps[name] = value
+            if not more:
+                self._cap_request(
+                    [c.partition('=')[0] for c in caps]
+                    if subcommand == 'NEW' else list(self.server_caps)
+                )
+        elif subcommand == 'DEL':
+            for cap in caps:
+                self.server_caps.pop(cap, None)
+                self.caps.discard(cap)
+        elif subcommand in ('ACK', 'NAK'):
+            if subcommand == 'ACK':
+                for cap in caps:
+                    if cap.startswith('-'):
+                        self.caps.discard(cap[1:])
+                    else:
+                        self.caps.add(cap)
+            if not more:
+                self._cap_pending = max(self._cap_pending - 1, 0)
+                if not self._cap_pending:
+                    self._cap_end()
+
+    def _cap_request(self, offered):
+        wanted = [c for c in offered
+                  if c in self.caps_wanted and c not in self.caps]
+        if not wanted:
+            self._cap_end()
+            return
+
+        # stay well below the line length, a REQ is acknowledged as a whole
+        request = list()
+        for cap in wanted:
+            if request and len(' '.join(request + [cap])) > 400:
+                self._cap_pending += 1
+                self.cap('REQ', ' '.join(request))
+                request = list()
+            request.append(cap)
+        self._cap_pending += 1
+        self.cap('REQ', ' '.join(request))
+
+    def _cap_end(self):
+        if self._cap_negotiating:
+            self._cap_negotiating = False
+            self.cap('END')
+
+    def _is_me(self, nick):
+        return nick is not None and \
+            self._key(nick) == self._key(self.nickname)
+
+    def handle_join(self, event_type, source, target, args):
+        if self._is_me(source.nick):
+            self.joined[self._key(target)] = target
+            # our prefix, used to split messages (Protocol.text_length)
+            if source.user:
+                self.own_userhost = '{}@{}'.format(source.user,
+                                                   source.host)
+
+    def handle_displayed_host(self, event_type, source, target, args):
+        # <nick> <host> :is now your displayed host
+        if len(args) > 1:
+            user = self.username
+            if self.own_userhost:
+                user = self.own_userhost.partition('@')[0]
+            self.own_userhost = '{}@{}'.format(user, args[1])
+
+    def handle_part(self, event_type, source, target, args):
+        if self._is_me(source.nick):
+            self.joined.pop(self._key(target), None)
+
+    def handle_kick(self, event_type, source, target, args):
+        if args and self._is_me(args[0]):
+            self.joined.pop(self._key(target), None)
+
+    def handle_motd_end(self, event_type, source, target, args):
+        # ISUPPORT (TARGMAX) is known by now, messages queued while
+        # reconnecting are held back until the channels are rejoined
+        if self._rejoin:
+            self.rejoin(self._rejoin, self._rejoin_keys)
+            self.release_outbound()
+        self._rejoin = None
+        self._rejoin_keys = dict()
+
+    def handle_pong(self, event_type, source, target, args):
+        self.pong(*args[:2])
+
+    def handle_keepalive_pong(self, event_type, source, target, args):
+        if self._ping_sent is None or not args or \
+                args[-1] != self._ping_token:
+            return
+        now = time.monotonic()
+        self._lag = now - self._ping_sent
+        self._lag_measured = now
+        self.rtt.observe(self._lag)
+        self._ping_token = self._ping_sent = None
@@ -0,0 +1,107 @@
+'''answers common CTCP requests.
+
+    awirc.ctcp.Responder(client, version='mybot 1.0')
+
+The responder answers VERSION, PING, TIME and CLIENTINFO inline (no
+greenlet per request) with replies built once. Requests are limited per
+source host and in total, requests over the limit are ignored, so a CTCP
+flood can't flood us off the server. Replies are sent with PRIORITY_LOW,
+they are the first messages dropped by a full outbound queue.
+'''
+import time
+
+import awirc.scheduler
+import awirc.utils
+
+
+class Responder(object):
+    # replies per second and source host (burst, rate) and in total
+    per_source = (2, 0.2)
+    total = (10, 2.0)
+    # upper bound of tracked source hosts before the oldest are forgotten
+    max_sources = 4096
+    # longer PING payloads are not echoed
+    max_ping_length = 64
+
+    def __init__(self, client, version='awirc', per_source=None,
+                 total=None, clock=time.monotonic):
+        self.client = client
+        self.clock = clock
+        if per_source is not None:
+            self.per_source = per_source
+        if total is not None:
+            self.total = total
+
+        self._sources = dict()
+        self._total = awirc.scheduler.TokenBucket(*self.total, clock=clock)
+        self.ignored = 0
+
+        self._handlers = dict([
+            ('CTCP_VERSION', self.handle_version),
+            ('CTCP_PING', self.handle_ping),
+            ('CTCP_TIME', self.handle_time),
+            ('CTCP_CLIENTINFO', self.handle_clientinfo)])
+
+        # the encoded payloads which don't depend on the request
+        self._version = awirc.utils.make_ctcp_string(
+            (('VERSION', version),)
+        ).encode('utf-8')
+        self._clientinfo = awirc.utils.make_ctcp_string((
+            ('CLIENTINFO', ' '.join(
+                sorted(t[5:] for t in self._handlers) + ['ACTION'])),
+        )).encode('utf-8')
+
+        for event_type, handler in self._handlers.items():
+            client.bind(event_type, handler, spawn=False)
+
+    def detach(self):
+        for event_type, handler in self._handlers.items():
+            self.client.unbind(event_type, handler)
+
+    def allow(self, source):
+        '''returns True if a request of source may be answered'''
+        if not source.nick:
+            return False
+        key = source.host or source.raw
+        bucket = self._sources.get(key)
+        if bucket is None:
+            if len(self._sources) >= self.max_sources:
+                # dicts keep insertion order, forget the oldest half
+                for old in list(self._sources)[:self.max_sources // 2]:
+                    del self._sources[old]
+            bucket = self._sources[key] = awirc.scheduler.TokenBucket(
+                *self.per_source, clock=self.clock
+            )
+
+        if bucket.delay(b'') or self._total.delay(b''):
+            self.ignored += 1
+            return False
+        bucket.consume(b'')
+        self._total.consume(b'')
+        return True
+
+    def reply(self, nick, payload):
+        '''sends payload (str or encoded) as NOTICE to nick'''
+        self.client.send(self.client.wire.text('NOTICE', nick, payload),
+                         priority=awirc.scheduler.PRIORITY_LOW, target=nick)
+
+    def handle_version(self, event_type, source, target, args):
+        if self.allow(source):
+            self.reply(source.nick, self._version)
+
+    def handle_ping(self, event_type, source, target, args):
+        if args is not None and len(args) > self.max_ping_length:
+            return
+        if self.allow(source):
+            self.reply(source.nick,
+                       awirc.utils.make_ctcp_string((('PING', args),)))
+
+    def handle_time(self, event_type, source, target, args):
+        if self.allow(source):
+            self.reply(source.nick, awirc.utils.make_ctcp_string(
+                (('TIME', time.strftime('%a %b %d %H:%M:%S %Y')),)
+            ))
+
+    def handle_clientinfo(self, event_type, source, target, args):
+        if self.allow(source):
+            self.reply(source.nick, self._clientinfo)
@@ -1,33 +1,324 @@
 from collections import defaultdict
+import traceback
+import time
+import sys
+import fnmatch
+import re
 
+import awirc.mask
 import awirc.utils
 
-# TODO gevent.spawn for events
-# maybe blinker
+
+def is_pattern(event_type):
+    'returns True if event_type contains fnmatch wildcards'
+    return any(c in event_type for c in '*?[')
+
+
+def compile_pattern(event_type):
+    'returns a match function for an event type with wildcards'
+    return re.compile(fnmatch.translate(event_type)).match
+
+
+def _as_tuple(value):
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+class EventFilter(object):
+    '''conditions of a filtered binding, see EventManager.bind'''
+    __slots__ = ('targets', 'exclude', 'predicate', 'key', '_names',
+                 '_sources')
+
+    def __init__(self, target=None, source=None, exclude=None,
+                 predicate=None, casemapping='rfc1459'):
+        self.key = awirc.utils.casemapper(casemapping)
+        # keys of the targets, None matches every target
+        self.targets = None
+        self._names = None
+        if target is not None:
+            self._names = _as_tuple(target)
+            self.targets = frozenset(self.key(t) for t in self._names)
+        self.exclude = tuple(e.upper() for e in _as_tuple(exclude or ()))
+        self.predicate = predicate
+
+        self._sources = None
+        if source is not None:
+            self._sources = awirc.mask.MaskSet(
+                _as_tuple(source), casemapping=casemapping
+            )
+
+    def set_casemapping(self, casemapping):
+        '''re-keys the targets and source masks'''
+        self.key = awirc.utils.casemapper(casemapping)
+        if self._names is not None:
+            self.targets = frozenset(self.key(t) for t in self._names)
+        if self._sources is not None:
+            self._sources.set_casemapping(casemapping)
+
+    def excludes(self, event_type):
+        return any(
+            fnmatch.fnmatchcase(event_type, e) if is_pattern(e)
+            else e == event_type
+            for e in self.exclude
+        )
+
+    def matches(self, event_type, args, source_index=0):
+        '''checks source and predicate, targets and excluded event types
+        are resolved by the EventManager'''
+        if self._sources is not None:
+            source = args[source_index] if len(args) > source_index else None
+            if not source or self._sources.match(source) is None:
+                return False
+        if self.predicate is not None:
+            return bool(self.predicate(event_type, *args))
+        return True
+
 
 class EventManager(object):
-    def __init__(self, pool):
-        self._pool = pool
+    # position of the source and the target in the arguments of
+    # process_event, used by filtered bindings
+    source_index = 0
+    target_index = 1
+
+    # upper bound for cached lookups, event types can be controlled by
+    # other users (e.g. CTCP_<tag>), so the cache can't grow forever
+    max_cache_size = 1024
+    # seconds, handle_overload is called at most once per interval and stage
+    overload_interval = 1.0
+
+    def __init__(self, pool, inline=False):
+        self._handler_pool = pool
+        # if True, handlers run directly in the dispatching greenlet unless
+        # they were bound with spawn=True, otherwise every handler gets
+        # its own greenlet
+        self.inline = inline
 
         self._events = defaultdict(list)
+        # wildcard event types, mapped to their compiled regex
+        self._patterns = dict()
+        # event_type -> tuple of handlers, invalidated on (un)bind
+        self._cache = dict()
 
-    def bind(self, event_type, handler):
-        self._events[event_type.upper()].append(handler)
+        # event_type -> list of (handler, spawn, EventFilter)
+        self._filtered = defaultdict(list)
+        # event_type -> ({target key: entries}, entries) or None
+        self._filtered_cache = dict()
+        # targets of filtered bindings are compared with this casemapping
+        self.casemapping = 'rfc1459'
+        self._key = awirc.utils.casemapper(self.casemapping)
 
-    def unbind(self, event_type, handler=None):
+        # spawning in a bounded pool (e.g. gevent.pool.Pool(size)) blocks
+        # the dispatching greenlet while the pool is full
+        self._bounded_pool = getattr(pool, 'size', None) is not None
+        # stage -> number of times it ran into its bound
+        self.overloads = defaultdict(int)
+        self._overloaded = set()
+        # stage -> time handle_overload was last called
+        self._overload_reported = dict()
+
+    def bind(self, event_type, handler, spawn=None, target=None,
+             source=None, exclude=None, predicate=None):
+        '''binds handler to event_type, event_type may contain wildcards.
+
+        spawn controls whether the handler runs in its own greenlet,
+        if it is None the managers inline setting is used. Handlers which
+        block (network, disk, gevent.sleep) should be bound with spawn=True,
+        inline handlers are executed in order of the incoming events.
+
+        The filters restrict the events handler is called for: target is
+        a name or a list of names (e.g. channels, compared ignoring case,
+        see set_casemapping), source nick!user@host masks (see awirc.mask),
+        exclude event types (wildcards allowed) a wildcard binding skips and
+        predicate is called like the handler and returns whether to call
+        it. Filtered handlers are looked up by target and run after the
+        unfiltered ones, handlers which don't match are never spawned.'''
         event_type = event_type.upper()
 
-        if handler is None:
-            self._events[event_type] = list()
+        if target is None and source is None and exclude is None and \
+                predicate is None:
+            self._events[event_type].append((handler, spawn))
         else:
-            if handler in self._events[event_type]:
-                self._events[event_type].remove(handler)
+            self._filtered[event_type].append((handler, spawn, EventFilter(
+                target, source, exclude, predicate, self.casemapping
+            )))
+        if is_pattern(event_type) and event_type not in self._patterns:
+            self._patterns[event_type] = compile_pattern(event_type)
+        self._cache.clear()
+        self._filtered_cache.clear()
+
+    def unbind(self, event_type, handler=None):
+        event_type = event_type.upper()
+
+        removed = False
+        for events in (self._events, self._filtered):
+            if event_type not in events or removed:
+                continue
+            if handler is None:
+                del events[event_type]
+                continue
+
+            entries = events[event_type]
+            for entry in entries:
+                if entry[0] == handler:
+                    entries.remove(entry)
+                    removed = True
+                    break
+            if not entries:
+                del events[event_type]
+
+        if event_type not in self._events and \
+                event_type not in self._filtered:
+            self._patterns.pop(event_type, None)
+        self._cache.clear()
+        self._filtered_cache.clear()
+
+    def set_casemapping(self, casemapping):
+        '''re-keys the filtered bindings, e.g. once the server sent
+        CASEMAPPING'''
+        if casemapping == self.casemapping:
+            return
+        self.casemapping = casemapping
+        self._key = awirc.utils.casemapper(casemapping)
+        for entries in self._filtered.values():
+            for entry in entries:
+                entry[2].set_casemapping(casemapping)
+        self._filtered_cache.clear()
+
+    def get_handlers(self, event_type):
+        '''returns a tuple of (handler, spawn) pairs bound to event_type,
+        handlers bound to the exact event type come first, followed
+        by handlers of matching wildcard patterns in bind order'''
+        try:
+            return self._cache[event_type]
+        except KeyError:
+            pass
+
+        handlers = list(self._events.get(event_type, ()))
+        for pattern, match in self._patterns.items():
+            if pattern != event_type and match(event_type):
+                handlers.extend(self._events.get(pattern, ()))
+        handlers = tuple(handlers)
+
+        if len(self._cache) >= self.max_cache_size:
+            self._cache.clear()
+        self._cache[event_type] = handlers
+
+        return handlers
+
+    def _get_filtered(self, event_type):
+        '''returns the filtered bindings of event_type as a tuple of the
+        bindings by target key and the bindings without target filter,
+        None if there are none'''
+        try:
+            return self._filtered_cache[event_type]
+        except KeyError:
+            pass
+
+        entries = list(self._filtered.get(event_type, ()))
+        for pattern, match in self._patterns.items():
+            if pattern != event_type and match(event_type):
+                entries.extend(self._filtered.get(pattern, ()))
+
+        by_target = defaultdict(tuple)
+        other = list()
+        for entry in entries:
+            event_filter = entry[2]
+            if event_filter.exclude and event_filter.excludes(event_type):
+                continue
+            if event_filter.targets is None:
+                other.append(entry)
+            else:
+                for key in event_filter.targets:
+                    by_target[key] += (entry,)
+
+        index = None
+        if by_target or other:
+            index = (dict(by_target), tuple(other))
+
+        if len(self._filtered_cache) >= self.max_cache_size:
+            self._filtered_cache.clear()
+        self._filtered_cache[event_type] = index
+
+        return index
+
+    def has_handlers(self, event_type):
+        '''returns True if handlers (filtered or not) are bound to
+        event_type'''
+        return bool(self.get_handlers(event_type) or
+                    (self._filtered and self._get_filtered(event_type)))
+
+    def get_filtered_handlers(self, event_type, args):
+        '''returns a tuple of (handler, spawn) pairs of the filtered
+        bindings which match the event'''
+        index = self._get_filtered(event_type)
+        if index is None:
+            return ()
+
+        by_target, entries = index
+        if by_target and len(args) > self.target_index:
+            target = args[self.target_index]
+            if target:
+                entries = by_target.get(self._key(target), ()) + entries
+
+        source_index = self.source_index
+        return tuple(
+            (handler, spawn) for handler, spawn, event_filter in entries
+            if event_filter.matches(event_type, args, source_index)
+        )
 
     def process_event(self, event_type, *args):
-        evt_keys = set(awirc.utils.fnmatch_m_s(self._events, event_type))
+        default_spawn = not self.inline
+        pool = self._handler_pool
+
+        handlers = self.get_handlers(event_type)
+        if self._filtered:
+            filtered = self.get_filtered_handlers(event_type, args)
+            if filtered:
+                handlers += filtered
+
+        for handler, spawn in handlers:
+            if spawn is None:
+                spawn = default_spawn
+
+            if spawn:
+                if self._bounded_pool:
+                    if pool.full():
+                        self.report_overload('handlers', running=len(pool))
+                    elif self._overloaded and \
+                            pool.free_count() >= pool.size // 2:
+                        self.clear_overload('handlers')
+                pool.spawn(handler, event_type, *args)
+            else:
+                try:
+                    handler(event_type, *args)
+                except Exception:
+                    self.handle_error(handler, *sys.exc_info())
+
+    def report_overload(self, stage, **info):
+        '''called when a stage ('inbound', 'outbound', 'handlers') hits its
+        bound. It counts again once the stage drained to half of its bound
+        (clear_overload), handle_overload is called at most once per
+        overload_interval'''
+        if stage in self._overloaded:
+            return
+        self._overloaded.add(stage)
+        self.overloads[stage] += 1
+
+        now = time.monotonic()
+        last = self._overload_reported.get(stage)
+        if last is not None and now - last < self.overload_interval:
+            return
+        self._overload_reported[stage] = now
+        self.handle_overload(stage, info)
 
-        for key in evt_keys:
-            for handler in self._events[key]:
-                self._pool.spawn(handler, event_type, *args)
+    def clear_overload(self, stage):
+        self._overloaded.discard(stage)
 
+    def handle_overload(self, stage, info):
+        pass
 
+    def handle_error(self, context, type, value, tb):
+        '''called with the exception info if an inline handler raises,
+        spawned handlers are reported by the gevent hub instead'''
+        traceback.print_exception(type, value, tb)
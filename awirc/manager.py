@@ -0,0 +1,177 @@
+from collections import defaultdict
+from functools import partial
+import traceback
+import sys
+
+import gevent.pool
+import gevent
+
+import awirc
+
+
+class ClientManager(object):
+    '''runs many clients in one process.
+
+    All clients share one bounded pool for their handlers, so at most
+    pool_size handlers run at the same time, spawning blocks while the pool
+    is full. Handlers bound on the manager are bound on every client
+    (including clients added later) and get the client as first argument:
+
+        handler(client, event_type, source, target, args)
+    '''
+    def __init__(self, pool_size=None, stagger=0.1):
+        self.pool = gevent.pool.Pool(pool_size)
+        # seconds between two connects of connect_all
+        self.stagger = stagger
+
+        self.clients = dict()
+        # (event_type, handler, spawn) in bind order
+        self._bindings = list()
+        # (name, event_type, handler) -> list of the handlers bound on the
+        # client, one per binding (e.g. with different filters)
+        self._bound = defaultdict(list)
+
+    def create(self, name, *args, **kwargs):
+        '''creates an awirc.Client which uses the shared pool and adds it
+        under name, arguments are passed to awirc.Client'''
+        kwargs['handler_pool'] = self.pool
+        client = awirc.Client(*args, **kwargs)
+        self.add(name, client)
+        return client
+
+    def add(self, name, client):
+        if name in self.clients:
+            raise ValueError('client {!r} already exists'.format(name))
+
+        self.clients[name] = client
+        for event_type, handler, spawn, filters in self._bindings:
+            self._bind_client(name, client, event_type, handler, spawn,
+                              filters)
+
+    def remove(self, name):
+        '''removes the client from the manager and returns it,
+        the client is not disconnected'''
+        client = self.clients.pop(name)
+        for key in [k for k in self._bound if k[0] == name]:
+            for bound in self._bound.pop(key):
+                client.unbind(key[1], bound)
+        return client
+
+    def __getitem__(self, name):
+        return self.clients[name]
+
+    def __iter__(self):
+        return iter(self.clients.values())
+
+    def __len__(self):
+        return len(self.clients)
+
+    def lag(self):
+        '''returns {name: lag} of the connected clients, lag is None until
+        it was measured (see BaseClient.lag)'''
+        return dict((name, client.lag)
+                    for name, client in self.clients.items()
+                    if client.connected)
+
+    def _bind_client(self, name, client, event_type, handler, spawn,
+                     filters):
+        bound = partial(handler, client)
+        self._bound[(name, event_type, handler)].append(bound)
+        client.bind(event_type, bound, spawn=spawn, **filters)
+
+    def bind(self, event_type, handler, spawn=None, **filters):
+        '''binds handler to event_type of every client, handler is called
+        with the client first. filters are passed to EventManager.bind, a
+        predicate is called without the client.'''
+        event_type = event_type.upper()
+
+        self._bindings.append((event_type, handler, spawn, filters))
+        for name, client in self.clients.items():
+            self._bind_client(name, client, event_type, handler, spawn,
+                              filters)
+
+    def unbind(self, event_type, handler):
+        event_type = event_type.upper()
+
+        self._bindings = [b for b in self._bindings
+                          if b[:2] != (event_type, handler)]
+        for name, client in self.clients.items():
+            for bound in self._bound.pop((name, event_type, handler), ()):
+                client.unbind(event_type, bound)
+
+    def connect(self, name, **kwargs):
+        '''connects the client in a new greenlet and returns it,
+        keyword arguments are passed to Client.connect'''
+        return gevent.spawn(self._connect, name, self.clients[name], kwargs)
+
+    def connect_all(self, stagger=None, **kwargs):
+        '''connects all clients which are not connected yet, connects are
+        spread stagger seconds apart so hundreds of clients don't hit the
+        servers at the same time. Returns the group of connect greenlets,
+        keyword arguments are passed to Client.connect.'''
+        if stagger is None:
+            stagger = self.stagger
+
+        group = gevent.pool.Group()
+        delay = 0
+        for name, client in self.clients.items():
+            if client.connected:
+                continue
+            group.add(gevent.spawn_later(
+                delay, self._connect, name, client, kwargs
+            ))
+            delay += stagger
+        return group
+
+    def _connect(self, name, client, kwargs):
+        try:
+            client.connect(**kwargs)
+        except Exception:
+            self.handle_connect_error(name, client, *sys.exc_info())
+
+    def handle_connect_error(self, name, client, type, value, tb):
+        '''called if a connect of connect_all fails'''
+        traceback.print_exception(type, value, tb)
+
+    def disconnect_all(self, msg=''):
+        group = gevent.pool.Group()
+        for client in self.clients.values():
+            if client.connected:
+                group.spawn(client.disconnect, msg)
+        group.join()
+
+    def join(self, timeout=None):
+        '''waits until all clients are terminated'''
+        group = gevent.pool.Group()
+        for client in self.clients.values():
+            group.spawn(client.gevent_pool.join)
+        group.join(timeout=timeout)
+
+    def stats(self):
+        '''returns totals over all clients, the state of the shared pool
+        and the traffic_stats of every client (under 'clients')'''
+        clients = dict(
+            (name, client.traffic_stats())
+            for name, client in self.clients.items()
+        )
+
+        totals = dict.fromkeys(
+            ('lines_in', 'bytes_in', 'lines_out', 'bytes_out', 'queued'), 0
+        )
+        connected = 0
+        for s in clients.values():
+            connected += s['connected']
+            totals['queued'] += s['scheduler']['queued']
+            for key in ('lines_in', 'bytes_in', 'lines_out', 'bytes_out'):
+                totals[key] += s[key]
+
+        totals.update({
+            'clients': len(clients),
+            'connected': connected,
+            'pool': {
+                'size': self.pool.size,
+                'running': len(self.pool),
+                'free': self.pool.free_count(),
+            },
+        })
+        return {'total': totals, 'clients': clients}
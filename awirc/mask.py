@@ -0,0 +1,295 @@
+'''matching prefixes against large sets of nick!user@host masks.
+
+    ignores = awirc.mask.MaskSet(['*!*@*.spam.example', 'troll*!*@*'],
+                                 isupport=client.rpl_isupport[1])
+    if ignores.match(source):
+        return
+
+Masks are indexed by a literal part: the nick, the host, its domain
+suffix, the user, the host prefix up to a dot (IP ranges), the first
+characters of the nick or the first characters of a literal between
+wildcards (e.g. *!*foo*@*, looked up by the n-grams of the prefix), so
+a prefix is only checked against the masks which can match it. The few
+masks without a literal part are matched by combined regexes. Nicks and
+hosts are compared according to the CASEMAPPING of the server.
+'''
+import re
+
+import awirc.utils
+
+
+# length of the nick prefixes masks like troll*!*@* are indexed by
+_NICK_PREFIX = 3
+# length of the n-grams masks like *!*foo*@* are indexed by
+_NGRAM = 3
+# alternatives per combined regex, the cost of a miss grows faster than
+# the number of alternatives
+_COMBINED_SIZE = 64
+
+
+def normalize(mask):
+    '''completes a mask to nick!user@host, like ircds do for bans:
+    nick, user@host, nick!user and hosts (containing a dot or colon)'''
+    if '!' in mask:
+        if '@' not in mask:
+            mask += '@*'
+        return mask
+    if '@' in mask:
+        return '*!' + mask
+    if '.' in mask or ':' in mask:
+        return '*!*@' + mask
+    return mask + '!*@*'
+
+
+def _translate(mask):
+    # only * and ? are wildcards, [] and \ are valid in nicks
+    return ''.join(
+        '.*' if c == '*' else '.' if c == '?' else re.escape(c)
+        for c in mask
+    )
+
+
+def _compile(mask):
+    return re.compile(_translate(mask) + r'\Z', re.DOTALL).match
+
+
+def _has_wildcard(s):
+    return '*' in s or '?' in s
+
+
+class MaskSet(object):
+    def __init__(self, masks=(), isupport=None, casemapping='rfc1459'):
+        '''masks is an iterable of masks or a dict of masks to values (e.g.
+        an access level), the casemapping is taken from isupport (the
+        parsed RPL_ISUPPORT, client.rpl_isupport[1]) if given'''
+        if isupport is not None:
+            casemapping = isupport.get('CASEMAPPING') or casemapping
+        self.casemapping = casemapping
+        self._lower = awirc.utils.casemapper(casemapping)
+
+        # lowered mask -> (mask, value), in the order they were added
+        self._masks = dict()
+        self._index()
+
+        if isinstance(masks, dict):
+            masks = masks.items()
+        else:
+            masks = ((mask, None) for mask in masks)
+        for mask, value in masks:
+            self.add(mask, value)
+
+    def _index(self):
+        # key -> {lowered mask: compiled match or None (not compiled yet)}
+        self._nicks = dict()
+        self._nick_prefixes = dict()
+        # hosts and domain suffixes (starting with a dot)
+        self._hosts = dict()
+        self._users = dict()
+        # host prefixes ending with a dot
+        self._host_prefixes = dict()
+        # n-grams of a literal inside wildcards, one dict per field (nick,
+        # user, host)
+        self._ngrams = (dict(), dict(), dict())
+        # masks without literal parts, matched by _combined, a list of
+        # (match, masks) of up to _COMBINED_SIZE masks
+        self._other = dict()
+        self._combined = None
+
+    def set_casemapping(self, casemapping):
+        '''re-indexes the masks, e.g. once the server sent ISUPPORT'''
+        if casemapping == self.casemapping:
+            return
+        self.casemapping = casemapping
+        self._lower = awirc.utils.casemapper(casemapping)
+
+        masks = list(self._masks.values())
+        self._masks = dict()
+        self._index()
+        for mask, value in masks:
+            self.add(mask, value)
+
+    def _slot(self, lowered):
+        '''returns the dict and key lowered is indexed under'''
+        nick, _, userhost = lowered.partition('!')
+        user, _, host = userhost.rpartition('@')
+
+        if not _has_wildcard(nick):
+            return self._nicks, nick
+        if not _has_wildcard(host):
+            return self._hosts, host
+
+        parts = re.split(r'[*?]', host)
+        dot = parts[-1].find('.')
+        if dot != -1 and len(parts[-1]) - dot > 1:
+            return self._hosts, parts[-1][dot:]
+        if not _has_wildcard(user):
+            return self._users, user
+        dot = parts[0].rfind('.')
+        if dot > 0:
+            return self._host_prefixes, parts[0][:dot + 1]
+
+        literal = re.split(r'[*?]', nick)[0]
+        if len(literal) >= _NICK_PREFIX:
+            return self._nick_prefixes, literal[:_NICK_PREFIX]
+
+        # the longest literal of a field
+        longest = max(
+            (len(part), field, part)
+            for field, value in enumerate((nick, user, host))
+            for part in re.split(r'[*?]', value)
+        )
+        if longest[0] >= _NGRAM:
+            return self._ngrams[longest[1]], longest[2][:_NGRAM]
+        if literal:
+            return self._nick_prefixes, literal
+        return self._other, None
+
+    def add(self, mask, value=None):
+        '''adds mask (completed by normalize), masks which only differ in
+        case are the same mask'''
+        mask = normalize(mask)
+        lowered = self._lower(mask)
+        known = lowered in self._masks
+        self._masks[lowered] = (mask, value)
+        if known:
+            return
+
+        index, key = self._slot(lowered)
+        if index is self._other:
+            self._other[lowered] = None
+            self._combined = None
+        else:
+            index.setdefault(key, dict())[lowered] = None
+
+    def remove(self, mask):
+        '''removes mask, raises KeyError if it is not in the set'''
+        lowered = self._lower(normalize(mask))
+        del self._masks[lowered]
+
+        index, key = self._slot(lowered)
+        if index is self._other:
+            del self._other[lowered]
+            self._combined = None
+        else:
+            del index[key][lowered]
+            if not index[key]:
+                del index[key]
+
+    def discard(self, mask):
+        if mask in self:
+            self.remove(mask)
+
+    def __contains__(self, mask):
+        return self._lower(normalize(mask)) in self._masks
+
+    def __len__(self):
+        return len(self._masks)
+
+    def __iter__(self):
+        return (mask for mask, _ in self._masks.values())
+
+    def _candidates(self, nick, user, host):
+        '''yields the dicts of the indexed masks which may match'''
+        index = self._nicks.get(nick)
+        if index:
+            yield index
+        for length in range(1, min(len(nick), _NICK_PREFIX) + 1):
+            index = self._nick_prefixes.get(nick[:length])
+            if index:
+                yield index
+
+        hosts = self._hosts
+        index = hosts.get(host)
+        if index:
+            yield index
+        # a host starting with a dot is its own first suffix
+        dot = host.find('.', 1)
+        while dot != -1:
+            index = hosts.get(host[dot:])
+            if index:
+                yield index
+            dot = host.find('.', dot + 1)
+
+        index = self._users.get(user)
+        if index:
+            yield index
+        if self._host_prefixes:
+            dot = host.find('.')
+            while dot != -1:
+                index = self._host_prefixes.get(host[:dot + 1])
+                if index:
+                    yield index
+                dot = host.find('.', dot + 1)
+
+        for ngrams, value in zip(self._ngrams, (nick, user, host)):
+            if not ngrams:
+                continue
+            seen = set()
+            for start in range(len(value) - _NGRAM + 1):
+                ngram = value[start:start + _NGRAM]
+                index = ngrams.get(ngram)
+                if index and ngram not in seen:
+                    seen.add(ngram)
+                    yield index
+
+    def _iter_matches(self, prefix, first):
+        # yields the lowered masks matching prefix
+        raw = getattr(prefix, 'raw', prefix)
+        if not raw:
+            return
+        s = self._lower(raw)
+        nick, _, userhost = s.partition('!')
+        user, _, host = userhost.rpartition('@')
+
+        for index in self._candidates(nick, user, host):
+            for lowered, match in index.items():
+                if match is None:
+                    match = index[lowered] = _compile(lowered)
+                if match(s):
+                    yield lowered
+
+        other = self._other
+        if not other:
+            return
+        if self._combined is None:
+            others = list(other)
+            self._combined = [
+                (re.compile('|'.join(
+                    '({}\\Z)'.format(_translate(m)) for m in chunk
+                ), re.DOTALL).match, chunk)
+                for chunk in (others[i:i + _COMBINED_SIZE]
+                              for i in range(0, len(others), _COMBINED_SIZE))
+            ]
+
+        for combined, chunk in self._combined:
+            m = combined(s)
+            if m is None:
+                continue
+            if first:
+                # the first alternative which matched
+                yield chunk[m.lastindex - 1]
+                return
+            for lowered in chunk:
+                match = other[lowered]
+                if match is None:
+                    match = other[lowered] = _compile(lowered)
+                if match(s):
+                    yield lowered
+
+    def match(self, prefix):
+        '''returns a mask matching prefix (an awirc.protocol.Prefix or
+        nick!user@host) or None'''
+        for lowered in self._iter_matches(prefix, True):
+            return self._masks[lowered][0]
+        return None
+
+    def matches(self, prefix):
+        '''returns a list of all masks matching prefix'''
+        return [self._masks[lowered][0]
+                for lowered in self._iter_matches(prefix, False)]
+
+    def get(self, prefix, default=None):
+        '''returns the value of a mask matching prefix'''
+        for lowered in self._iter_matches(prefix, True):
+            return self._masks[lowered][1]
+        return default
@@ -0,0 +1,354 @@
+'''optional instrumentation of clients.
+
+    metrics = awirc.metrics.Metrics()
+    metrics.instrument(client, 'freenode')
+    metrics.snapshot()                     # dict
+    awirc.metrics.serve_prometheus(metrics, port=9100)
+
+Nothing is measured until a client is instrumented, instrument replaces
+line_received, parse_message, message_received, process_event and the
+bound handlers of that client with timing wrappers. Traffic counters, the
+outbound queue and the size of the handler pool are read from the client
+when a snapshot is taken, so they don't cost anything on the hot path.
+'''
+from bisect import bisect_left
+import asyncio
+import time
+import sys
+
+
+# seconds
+DEFAULT_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3,
+                   1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0)
+# round trip times of keepalive PINGs
+LAG_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last slot counts values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        '''count, sum and the cumulative count per upper bound'''
+        cumulative = list()
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+def _handler_name(handler):
+    func = getattr(handler, 'func', handler)  # functools.partial
+    name = getattr(func, '__qualname__', None) or repr(func)
+    module = getattr(func, '__module__', None)
+    return '{}.{}'.format(module, name) if module else name
+
+
+class _TimedHandler(object):
+    '''measures runtime and exceptions of a handler, compares equal to
+    the handler so unbind keeps working'''
+    __slots__ = ('handler', 'runtime', 'errors')
+
+    def __init__(self, handler, runtime, errors):
+        self.handler = handler
+        self.runtime = runtime
+        self.errors = errors
+
+    def __call__(self, *args):
+        start = time.perf_counter()
+        try:
+            return self.handler(*args)
+        except Exception:
+            self.errors.inc()
+            raise
+        finally:
+            self.runtime.observe(time.perf_counter() - start)
+
+    def __eq__(self, other):
+        if isinstance(other, _TimedHandler):
+            other = other.handler
+        return self.handler == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.handler)
+
+
+class Metrics(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+
+        # (name, labels) -> Counter or Histogram, labels is a sorted tuple
+        self._metrics = dict()
+        # client name -> client
+        self.clients = dict()
+
+    def counter(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = Counter()
+        return metric
+
+    def histogram(self, name, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = Histogram(self.buckets)
+        return metric
+
+    def instrument(self, client, name=None):
+        '''wraps the hot paths of client, name is used as client label'''
+        if name is None:
+            name = '{}@{}'.format(client.nickname, client.host)
+        if name in self.clients:
+            raise ValueError('client {!r} already instrumented'.format(name))
+        self.clients[name] = client
+
+        clock = time.perf_counter
+        line_time = self.histogram('awirc_line_seconds', client=name)
+        parse_time = self.histogram('awirc_parse_seconds', client=name)
+        dispatch_time = self.histogram('awirc_dispatch_seconds', client=name)
+
+        line_received = client.line_received
+        parse_message = client.parse_message
+        message_received = client.message_received
+        process_event = client.process_event
+        get_handlers = client.get_handlers
+        bind = client.bind
+
+        def timed_line_received(line):
+            start = clock()
+            try:
+                return line_received(line)
+            finally:
+                line_time.observe(clock() - start)
+
+        def timed_parse_message(line):
+            start = clock()
+            try:
+                return parse_message(line)
+            finally:
+                parse_time.observe(clock() - start)
+
+        def timed_message_received(msg):
+            start = clock()
+            try:
+                return message_received(msg)
+            finally:
+                dispatch_time.observe(clock() - start)
+
+        # event type -> (events counter, handler calls counter), bounded
+        # like the dispatch cache since CTCP_<tag> events are controlled
+        # by other users
+        event_counters = dict()
+        other = (
+            self.counter('awirc_events_total', client=name, event='_other'),
+            self.counter('awirc_handler_calls_total', client=name,
+                         event='_other'),
+        )
+
+        def counted_process_event(event_type, *args):
+            counters = event_counters.get(event_type)
+            if counters is None:
+                if len(event_counters) >= client.max_cache_size:
+                    counters = other
+                else:
+                    counters = event_counters[event_type] = (
+                        self.counter('awirc_events_total', client=name,
+                                     event=event_type),
+                        self.counter('awirc_handler_calls_total',
+                                     client=name, event=event_type),
+                    )
+            counters[0].inc()
+            # filtered handlers are not counted, their predicates would
+            # run twice
+            counters[1].inc(len(get_handlers(event_type)))
+            return process_event(event_type, *args)
+
+        def wrap(handler):
+            if isinstance(handler, _TimedHandler) or \
+                    asyncio.iscoroutinefunction(handler):
+                # coroutines are awaited by the asyncio backend
+                return handler
+            label = _handler_name(handler)
+            return _TimedHandler(
+                handler,
+                self.histogram('awirc_handler_seconds', client=name,
+                               handler=label),
+                self.counter('awirc_handler_errors_total', client=name,
+                             handler=label)
+            )
+
+        def timed_bind(event_type, handler, spawn=None, **filters):
+            return bind(event_type, wrap(handler), spawn=spawn, **filters)
+
+        for handlers in client._events.values():
+            handlers[:] = [(wrap(h), spawn) for h, spawn in handlers]
+        for handlers in client._filtered.values():
+            handlers[:] = [(wrap(h), spawn, f) for h, spawn, f in handlers]
+        client._cache.clear()
+        client._filtered_cache.clear()
+
+        client.line_received = timed_line_received
+        client.parse_message = timed_parse_message
+        client.message_received = timed_message_received
+        client.process_event = counted_process_event
+        client.bind = timed_bind
+
+        sendall = getattr(client, '_sendall', None)
+        if sendall is not None:
+            write_time = self.histogram('awirc_write_seconds', client=name)
+
+            def timed_sendall(buffers):
+                start = clock()
+                try:
+                    return sendall(buffers)
+                finally:
+                    write_time.observe(clock() - start)
+            client._sendall = timed_sendall
+
+    def _collect(self):
+        '''reads the counters kept by the clients themselves'''
+        collected = list()
+        for name, client in self.clients.items():
+            stats = client.traffic_stats()
+            scheduler = stats['scheduler']
+            labels = (('client', name),)
+            for key in ('lines_in', 'bytes_in', 'lines_out', 'bytes_out'):
+                collected.append(
+                    (('awirc_{}_total'.format(key), labels), stats[key])
+                )
+            collected.extend([
+                (('awirc_connected', labels), int(stats['connected'])),
+                (('awirc_queued_messages', labels), scheduler['queued']),
+                (('awirc_queue_wait_avg_seconds', labels),
+                 scheduler['wait_avg']),
+                (('awirc_queue_wait_max_seconds', labels),
+                 scheduler['wait_max']),
+                (('awirc_queue_oldest_wait_seconds', labels),
+                 scheduler['oldest_wait']),
+                # handlers spawned, the pool may be shared by the clients
+                # of a ClientManager
+                (('awirc_pool_greenlets', labels),
+                 len(client._handler_pool)),
+                (('awirc_inbound_queued_lines', labels),
+                 stats['inbound_queued']),
+                (('awirc_dropped_messages_total', labels), stats['dropped']),
+            ])
+            rtt = getattr(client, 'rtt', None)
+            if rtt is not None:
+                collected.extend([
+                    (('awirc_rtt_seconds', labels), rtt.snapshot()),
+                    (('awirc_ping_timeouts_total', labels),
+                     client.ping_timeouts),
+                ])
+                if client.lag is not None:
+                    collected.append((('awirc_lag_seconds', labels),
+                                      client.lag))
+            for stage, count in stats['overloads'].items():
+                collected.append((
+                    ('awirc_overloads_total', labels + (('stage', stage),)),
+                    count
+                ))
+        return collected
+
+    def snapshot(self):
+        '''returns {name: {labels: value}}, labels is a tuple of
+        (label, value) pairs, histograms are dicts (see Histogram)'''
+        result = dict()
+        for (name, labels), metric in self._metrics.items():
+            result.setdefault(name, dict())[labels] = metric.snapshot()
+        for (name, labels), value in self._collect():
+            result.setdefault(name, dict())[labels] = value
+        return result
+
+
+# exporters
+def _labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')
+                         .replace('\n', '\\n'))
+        for k, v in labels
+    ) + '}'
+
+
+def prometheus_text(metrics):
+    '''renders a snapshot in the Prometheus text exposition format'''
+    lines = list()
+    for name, values in sorted(metrics.snapshot().items()):
+        first = next(iter(values.values()))
+        if isinstance(first, dict):
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, h in values.items():
+                for bound, count in h['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(labels, (('le', le),)), count
+                    ))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels),
+                                                  h['sum']))
+                lines.append('{}_count{} {}'.format(name, _labels(labels),
+                                                    h['count']))
+        else:
+            kind = 'counter' if name.endswith('_total') else 'gauge'
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in values.items():
+                lines.append('{}{} {}'.format(name, _labels(labels), value))
+    return '\n'.join(lines) + '\n'
+
+
+def serve_prometheus(metrics, host='127.0.0.1', port=9100):
+    '''serves prometheus_text on http://host:port/metrics (gevent),
+    returns the started gevent.pywsgi.WSGIServer'''
+    import gevent.pywsgi
+
+    def application(environ, start_response):
+        if environ.get('PATH_INFO') not in ('/', '/metrics'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found\n']
+        try:
+            body = prometheus_text(metrics).encode('utf-8')
+        except Exception:
+            start_response('500 Internal Server Error',
+                           [('Content-Type', 'text/plain')],
+                           sys.exc_info())
+            return [b'error\n']
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+        ])
+        return [body]
+
+    server = gevent.pywsgi.WSGIServer((host, port), application, log=None)
+    server.start()
+    return server
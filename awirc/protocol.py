@@ -1,26 +1,78 @@
 from collections import defaultdict
 
+import awirc.scheduler
 import awirc.utils
+import awirc.wire
 
 
 class Prefix(object):
+    '''nick!user@host or server prefix of a message.
+
+    The prefix is split on first access of nick, user or host, use
+    Prefix.intern to share instances for repeated prefixes.'''
+    __slots__ = ('_raw', '_nick', '_user', '_host')
+
+    # maximum number of interned prefixes before the cache is reset
+    max_interned = 4096
+    _interned = dict()
+
     def __init__(self, prefix):
-        self.nick = None
-        self.user = None
-        self.host = None
+        # str or undecoded bytes
+        self._raw = prefix
+        self._nick = None
+        self._user = None
+        # None until the prefix was split, even a server prefix has a host
+        self._host = None
+
+    @classmethod
+    def intern(cls, prefix):
+        '''returns a shared Prefix for prefix (str or bytes)'''
+        try:
+            return cls._interned[prefix]
+        except KeyError:
+            pass
+
+        if len(cls._interned) >= cls.max_interned:
+            cls._interned.clear()
+        p = cls._interned[prefix] = cls(prefix)
+        return p
+
+    def _split(self):
+        prefix = self.raw
 
         if '!' in prefix:
-            self.nick = awirc.utils.nick_from_nickmask(prefix)
-            self.user = awirc.utils.user_from_nickmask(prefix)
-            self.host = awirc.utils.host_from_nickmask(prefix)
+            self._nick, _, userhost = prefix.partition('!')
+            self._user, _, self._host = userhost.partition('@')
         else:
-            self.host = prefix
+            self._host = prefix
+
+    @property
+    def raw(self):
+        '''the unsplit prefix'''
+        if not isinstance(self._raw, str):
+            self._raw = awirc.utils.decode(self._raw)
+        return self._raw
+
+    @property
+    def nick(self):
+        if self._host is None:
+            self._split()
+        return self._nick
+
+    @property
+    def user(self):
+        if self._host is None:
+            self._split()
+        return self._user
+
+    @property
+    def host(self):
+        if self._host is None:
+            self._split()
+        return self._host
 
     def __str__(self):
-        if self.nick is not None and self.user is not None:
-            return '{}!{}@{}'.format(self.nick, self.user, self.host)
-        else:
-            return self.host
+        return self.raw
 
     def __repr__(self):
         return 'Prefix(nick={!r}, user={!r}, host={!r})'.format(
@@ -29,16 +81,93 @@ class Prefix(object):
 
 
 class Message(object):
-    def __init__(self, prefix, command, args):
-        self.prefix = Prefix(prefix)
+    __slots__ = ('_prefix', 'command', '_args', '_raw_args', '_tags')
+
+    _fields = ('prefix', 'command', 'args')
+
+    def __init__(self, prefix, command, args, tags=None):
+        self._prefix = prefix
         self.command = command.upper()
-        self.args = args
+        self._args = args
+        self._raw_args = None
+        self._tags = tags
+
+    @classmethod
+    def from_raw(cls, prefix, command, args, tags=None):
+        '''creates a message from an undecoded prefix, undecoded
+        arguments and undecoded tags (bytes), they are decoded on first
+        access'''
+        self = cls.__new__(cls)
+        self._prefix = prefix
+        self.command = command.upper()
+        self._args = None
+        self._raw_args = args
+        self._tags = tags
+        return self
+
+    @property
+    def prefix(self):
+        if not isinstance(self._prefix, Prefix):
+            self._prefix = Prefix.intern(self._prefix)
+        return self._prefix
+
+    @prefix.setter
+    def prefix(self, value):
+        self._prefix = value
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = [awirc.utils.decode(arg) for arg in self._raw_args]
+            self._raw_args = None
+        return self._args
+
+    @args.setter
+    def args(self, value):
+        self._args = value
+        self._raw_args = None
+
+    @property
+    def tags(self):
+        '''IRCv3 message tags, an empty dict if the message has none'''
+        if self._tags is None:
+            self._tags = dict()
+        elif not isinstance(self._tags, dict):
+            self._tags = awirc.utils.parse_tags(self._tags)
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        self._tags = value
+
+    @property
+    def has_tags(self):
+        '''checks for tags without parsing them'''
+        return bool(self._tags)
+
+    @property
+    def time(self):
+        '''the server-time of the message as an aware datetime or None'''
+        value = self.tags.get('time')
+        if value:
+            return awirc.utils.parse_server_time(value)
+        return None
 
     def __getitem__(self, key):
-        return (self.prefix, self.command, self.args).__getitem__(key)
+        if isinstance(key, slice):
+            return tuple(self)[key]
+        return getattr(self, self._fields[key])
+
+    def __iter__(self):
+        yield self.prefix
+        yield self.command
+        yield self.args
+
+    def __len__(self):
+        return 3
 
     def __contains__(self, item):
-        return (self.prefix, self.command, self.args).__contains__(item)
+        return any(x is item or x == item for x in self)
 
     def __str__(self):
         return ' '.join([str(self.prefix), self.command, ' '.join(self.args)])
@@ -49,9 +178,93 @@ class Message(object):
         )
 
 
+class Batch(object):
+    '''an IRCv3 batch, messages holds the Message (and nested Batch)
+    objects in the order they were received'''
+    __slots__ = ('ref', 'type', 'params', 'tags', 'messages', 'aggregate')
+
+    def __init__(self, ref, type, params, tags=None):
+        self.ref = ref
+        self.type = type.upper()
+        self.params = params
+        self.tags = tags or dict()
+        self.messages = list()
+        # whether the messages are dispatched as one event
+        self.aggregate = False
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __repr__(self):
+        return 'Batch(ref={!r}, type={!r}, messages={})'.format(
+            self.ref, self.type, len(self.messages)
+        )
+
+
 class Protocol(object):
+    # longest line (including CRLF) a server relays, messages are split
+    # so they still fit with our nick!user@host prepended
+    max_line_length = awirc.wire.MAX_LINE_LENGTH
+
     def __init__(self):
         self.rpl_isupport = (list(), defaultdict(tuple))
+        # builds the lines of privmsg, notice and friends as bytes
+        self.wire = awirc.wire.Serializer(self.max_line_length)
+        # user@host as seen by others, None until the server told us
+        self.own_userhost = None
+
+    def text_length(self, command, target):
+        '''returns how many bytes of text fit into a command to target
+        after the server prepended our prefix, the user@host length is
+        estimated from USERLEN and HOSTLEN until it is known. It is at
+        least 1, the server cuts what doesn't fit when relaying.'''
+        if self.own_userhost is not None:
+            userhost = len(self.own_userhost.encode('utf-8'))
+        else:
+            isupport = self.rpl_isupport[1]
+            # ident prefix (~), user, @, host
+            userhost = 1 + isupport.get('USERLEN', 10) + 1 + \
+                isupport.get('HOSTLEN', 63)
+        # :nick!user@host COMMAND target :text\r\n
+        return max(1, self.max_line_length - (
+            len(self.nickname.encode('utf-8')) + userhost +
+            len(command) + len(target.encode('utf-8')) + 8
+        ))
+
+    def _send_text(self, command, target, text):
+        wire = self.wire
+        for line in awirc.utils.split_bytes(
+                text, self.text_length(command, target), decode=False,
+                quoted=True):
+            self.send(wire.text(command, target, line), target=target)
+
+    def _send_text_many(self, command, targets, text):
+        # the longest target limits the text of the relayed lines, the
+        # targets themselves take at most half of the line
+        length = self.text_length(command, '')
+        for group in awirc.utils.group_targets(
+                targets, self.max_targets(command), max_length=length // 2):
+            joined = ','.join(group)
+            # COMMAND a,b :text\r\n is sent, COMMAND a :text relayed
+            text_length = max(1, min(
+                length - max(len(t.encode('utf-8')) for t in group),
+                self.max_line_length - len(command) -
+                len(joined.encode('utf-8')) - 5
+            ))
+            for line in awirc.utils.split_bytes(text, text_length,
+                                                decode=False, quoted=True):
+                self.send(self.wire.text(command, joined, line))
+
+    def _registration_priority(self):
+        # registration commands pass the messages held back until the
+        # client is registered (Connection.release_outbound), afterwards
+        # they are flood limited like everything else
+        if getattr(self, '_out_priority', None) is not None:
+            return awirc.scheduler.PRIORITY_HIGH
+        return awirc.scheduler.PRIORITY_NORMAL
 
     def action(self, target, action):
         self.ctcp(target, (('ACTION', action),))
@@ -59,6 +272,12 @@ class Protocol(object):
     def admin(self, server=''):
         self.send('ADMIN {}'.format(server))
 
+    def cap(self, subcommand, caps=''):
+        if ' ' in caps:
+            caps = ':' + caps
+        self.send('CAP {} {}'.format(subcommand, caps).rstrip(),
+                  priority=self._registration_priority())
+
     def ctcp(self, target, messages):
         '''sends a ctcp request to target.
 
@@ -96,10 +315,40 @@ class Protocol(object):
                     chanp = '!&#+'
                 if not chan[0] in chanp:
                     chan = '#' + chan
-                self.send('JOIN {} {}'.format(chan, key))
+                self.send('JOIN {} {}'.format(chan, key), target=chan)
+
+    def join_channels(self, channels, keys=None, first=False):
+        '''joins channels with as few JOINs as TARGMAX and the line length
+        allow, keys maps channel names to their keys. With first the JOINs
+        are sent before already queued messages.'''
+        keys = keys or dict()
+        # channels with a key have to come first
+        channels = sorted(channels, key=lambda c: c not in keys)
+
+        for group in awirc.utils.group_targets(
+                channels, self.max_targets('JOIN'),
+                size=lambda c: len(c) + len(keys.get(c, '')) + 2):
+            group_keys = [keys[c] for c in group if c in keys]
+            self.send('JOIN {} {}'.format(
+                ','.join(group), ','.join(group_keys)
+            ).rstrip(), first=first)
+
+    def max_targets(self, command):
+        '''returns the maximum number of targets of command according to
+        TARGMAX (or MAXTARGETS), None if there is no known limit'''
+        isupport = self.rpl_isupport[1]
+        targmax = isupport.get('TARGMAX')
+        if targmax and command in targmax:
+            value = targmax[command]
+            return value if isinstance(value, int) else None
+        try:
+            return int(isupport.get('MAXTARGETS'))
+        except (TypeError, ValueError):
+            return None
 
     def kick(self, channel, nick, comment=''):
-        self.send('KICK {} {} :{}'.format(channel, nick, comment))
+        self.send('KICK {} {} :{}'.format(channel, nick, comment),
+                  target=channel)
 
     def links(self, server_mask, remote_server=''):
         cmd = 'LINKS'
@@ -119,7 +368,8 @@ class Protocol(object):
         self.send('LUSERS {}'.format(server))
 
     def mode(self, channel, mode, user=''):
-        self.send('MODE {} {} {}'.format(channel, mode, user))
+        self.send('MODE {} {} {}'.format(channel, mode, user),
+                  target=channel)
 
     def motd(self, server=''):
         self.send('MOTD {}'.format(server))
@@ -128,42 +378,45 @@ class Protocol(object):
         self.send('NAMES {}'.format(channel))
 
     def nick(self, newnick):
-        self.send('NICK {}'.format(newnick))
+        self.send('NICK {}'.format(newnick),
+                  priority=self._registration_priority())
 
     def notice(self, target, text):
-        for part in awirc.utils.ssplit(text, 420):
-            self.send('NOTICE {} :{}'.format(
-                target, ''.join(filter(None, part)))
-            )
+        self._send_text('NOTICE', target, text)
+
+    def notice_many(self, targets, text):
+        self._send_text_many('NOTICE', targets, text)
 
     def oper(self, nick, password):
         self.send('OPER {} {}'.format(nick, password))
 
     def part(self, channel, message=''):
-        self.send('PART {} {}'.format(channel, message))
+        self.send('PART {} {}'.format(channel, message), target=channel)
 
     def pass_(self, password):
-        self.send('PASS {}'.format(password))
+        self.send('PASS {}'.format(password),
+                  priority=self._registration_priority())
 
     def ping(self, target, target2=''):
         self.send('PING {} {}'.format(target, target2))
 
     def pong(self, target, target2=''):
-        self.send('PONG {} {}'.format(target, target2))
+        self.send('PONG {} {}'.format(target, target2),
+                  priority=awirc.scheduler.PRIORITY_HIGH)
 
     def privmsg(self, target, text):
-        for part in awirc.utils.ssplit(text, 420):
-            self.send('PRIVMSG {} :{}'.format(
-                target, ''.join(filter(None, part)))
-            )
+        '''sends text to target, split into as few lines as the line
+        length allows'''
+        self._send_text('PRIVMSG', target, text)
 
     def privmsg_many(self, targets, text):
-        for part in awirc.utils.ssplit(text, 420):
-            self.send('PRIVMSG {} :{}'.format(
-                ','.join(targets), ''.join(filter(None, part))))
+        '''sends text to targets, with as few targets per line as TARGMAX
+        (or MAXTARGETS) and the line length allow'''
+        self._send_text_many('PRIVMSG', targets, text)
 
     def quit(self, message=''):
-        self.send('QUIT :{}'.format(message))
+        self.send('QUIT :{}'.format(message),
+                  priority=awirc.scheduler.PRIORITY_HIGH)
 
     def squit(self, server, comment=''):
         self.send('SQUIT {} :{}'.format(server, comment))
@@ -176,15 +429,17 @@ class Protocol(object):
 
     def topic(self, channel, new_topic=None):
         if new_topic is None:
-            self.send('TOPIC {}'.format(channel))
+            self.send('TOPIC {}'.format(channel), target=channel)
         else:
-            self.send('TOPIC {} :{}'.format(channel, new_topic))
+            self.send('TOPIC {} :{}'.format(channel, new_topic),
+                      target=channel)
 
     def trace(self, target=''):
         self.send('TRACE {}'.format(target))
 
     def user(self, username, realname):
-        self.send('USER {} 0 * :{}'.format(username, realname))
+        self.send('USER {} 0 * :{}'.format(username, realname),
+                  priority=self._registration_priority())
 
     def userhost(self, nick):
         self.send('USERHOST {}'.format(nick))
@@ -207,8 +462,7 @@ class Protocol(object):
     def whowas(self, nick, max='', server=''):
         self.send('WHOWAS {} {} {}'.format(nick, max, server))
 
-    def send(self, msg):
+    def send(self, msg, priority=awirc.scheduler.PRIORITY_NORMAL,
+             target=None, first=False):
         raise NotImplementedError
 
-# TODO IRCv3
-
@@ -0,0 +1,373 @@
+'''request/response correlation for WHO, WHOIS, NAMES, LIST and MODE.
+
+    result = client.queries.whois('nick').get(timeout=5)  # gevent
+    result = await client.queries.whois('nick')           # asyncio
+
+    for channel, users, topic in client.queries.list():
+        ...
+
+Replies are matched to the oldest pending query of the same kind, servers
+answer commands in order. Numerics which carry the queried nick/channel
+are only matched to a query for that nick/channel, so several queries can
+be in flight at the same time. The replies are still dispatched to the
+normal handlers.
+'''
+import time
+
+
+class QueryError(Exception):
+    def __init__(self, numeric, args):
+        Exception.__init__(self, numeric, args)
+        self.numeric = numeric
+        self.args_ = args
+
+
+class QueryTimeout(QueryError):
+    pass
+
+
+# end of a stream
+_END = object()
+
+
+def _parse_who(replies):
+    result = list()
+    for numeric, args in replies:
+        if numeric != '352' or len(args) < 8:
+            continue
+        hops, _, realname = args[7].partition(' ')
+        result.append({
+            'channel': args[1], 'user': args[2], 'host': args[3],
+            'server': args[4], 'nick': args[5], 'flags': args[6],
+            'hops': hops, 'realname': realname,
+        })
+    return result
+
+
+def _parse_whois(replies):
+    result = {'channels': list(), 'operator': False, 'secure': False}
+    for numeric, args in replies:
+        if numeric == '311':
+            result.update(nick=args[1], user=args[2], host=args[3],
+                          realname=args[-1])
+        elif numeric == '312':
+            result.update(server=args[2], server_info=args[-1])
+        elif numeric == '313':
+            result['operator'] = True
+        elif numeric == '317':
+            result['idle'] = int(args[2])
+            if len(args) > 4:
+                result['signon'] = int(args[3])
+        elif numeric == '319':
+            result['channels'].extend(args[-1].split())
+        elif numeric == '330':
+            result['account'] = args[2]
+        elif numeric == '301':
+            result['away'] = args[-1]
+        elif numeric == '671':
+            result['secure'] = True
+    return result
+
+
+def _parse_names(replies):
+    names = list()
+    for numeric, args in replies:
+        if numeric == '353':
+            names.extend(args[-1].split())
+    return names
+
+
+def _parse_list_row(numeric, args):
+    if numeric != '322':
+        return None
+    users = int(args[2]) if args[2].isdigit() else 0
+    return (args[1], users, args[3] if len(args) > 3 else '')
+
+
+def _parse_list(replies):
+    return [r for r in (_parse_list_row(*x) for x in replies) if r]
+
+
+def _parse_mode(replies):
+    for numeric, args in replies:
+        if numeric == '324':
+            return args[2], args[3:]
+    return None
+
+
+def _parse_mode_list(replies):
+    result = list()
+    for numeric, args in replies:
+        if numeric in ('367', '348', '346') and len(args) >= 3:
+            result.append(tuple(args[2:5]))
+    return result
+
+
+class Query(object):
+    '''a pending request, use get (gevent) or await it (asyncio).
+
+    Streaming queries (LIST) can be iterated (or async iterated), rows are
+    handed out as they arrive and not kept in memory.'''
+    def __init__(self, manager, kind, key, future, stream=None):
+        self.manager = manager
+        self.kind = kind
+        # lowered nick/channel the query is about, or None
+        self.key = key
+        self.future = future
+        self.replies = list()
+        self.error = None
+        # the query finished with an exception (error numeric, timeout)
+        self.failed = False
+
+        self._stream = stream
+        self._cancel_timeout = None
+
+    def get(self, timeout=None):
+        '''blocks until the result is available (gevent)'''
+        return self.future.result(timeout)
+
+    def done(self):
+        return self.future.done()
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def __iter__(self):
+        while True:
+            row = self._stream.get()
+            if row is _END:
+                break
+            yield row
+        # raises if the query failed
+        self.future.result()
+
+    async def __aiter__(self):
+        while True:
+            row = await self._stream.get()
+            if row is _END:
+                break
+            yield row
+        self.future.result()
+
+    def _feed(self, numeric, args):
+        if self._stream is not None:
+            row = QueryManager.kinds[self.kind][4](numeric, args)
+            if row is not None:
+                self._stream.put_nowait(row)
+        else:
+            self.replies.append((numeric, args))
+
+    def _finish(self, exception=None):
+        if self._cancel_timeout is not None:
+            self._cancel_timeout()
+        if self.future.done():
+            return
+
+        if exception is None and self.error is not None:
+            exception = QueryError(*self.error)
+
+        if exception is not None:
+            self.failed = True
+            self.future.set_exception(exception)
+        elif self._stream is not None:
+            self.future.set_result(None)
+        else:
+            parse = QueryManager.kinds[self.kind][3]
+            self.future.set_result(parse(self.replies))
+
+        if self._stream is not None:
+            self._stream.put_nowait(_END)
+
+
+class QueryManager(object):
+    # kind -> (replies, ends, errors, parse, parse_row for streams)
+    kinds = {
+        'WHO': (('352', '354'), ('315',), ('403',), _parse_who, None),
+        'WHOIS': (('311', '312', '313', '317', '319', '330', '301',
+                   '671', '276', '307', '320', '338', '378', '379'),
+                  ('318',), ('401', '402', '431'), _parse_whois, None),
+        'NAMES': (('353',), ('366',), (), _parse_names, None),
+        'LIST': (('322',), ('323',), (), _parse_list, _parse_list_row),
+        'MODE': ((), ('324',), ('403', '442'), _parse_mode, None),
+        'MODE_LIST': (('367', '348', '346'), ('368', '349', '347'),
+                      ('403', '442', '482'), _parse_mode_list, None),
+    }
+    # error numerics no end numeric follows
+    final_errors = {
+        'WHOIS': ('431',),
+        'MODE': ('403', '442'),
+        'MODE_LIST': ('403', '442', '482'),
+    }
+    # argument index of the nick/channel a numeric refers to
+    key_index = {
+        '311': 1, '312': 1, '313': 1, '317': 1, '319': 1, '330': 1,
+        '301': 1, '671': 1, '276': 1, '307': 1, '320': 1, '338': 1,
+        '378': 1, '379': 1, '318': 1, '401': 1,
+        '315': 1, '403': 1, '442': 1, '482': 1,
+        '353': 2, '366': 1, '324': 1,
+        '367': 1, '368': 1, '348': 1, '349': 1, '346': 1, '347': 1,
+    }
+
+    # default seconds until a query fails with QueryTimeout
+    timeout = 30
+    # seconds WHOIS results are cached
+    whois_ttl = 60
+
+    def __init__(self, client):
+        self.client = client
+
+        # numeric -> pending queries accepting it, oldest first
+        self._pending = dict()
+        self._bound = set()
+        # lowered nick -> (expires, Query)
+        self._whois_cache = dict()
+
+    def _key(self, name):
+        if name is None:
+            return None
+        if self.client.state is not None:
+            return self.client.state.key(name)
+        return name.lower()
+
+    def _bind(self, kind):
+        if kind in self._bound:
+            return
+        if not self._bound:
+            self.client.bind('DISCONNECT', self._handle_disconnect, spawn=False)
+        self._bound.add(kind)
+
+        replies, ends, errors = self.kinds[kind][:3]
+        for numeric in replies + ends + errors:
+            if numeric not in self._pending:
+                self._pending[numeric] = list()
+                self.client.bind(numeric, self._handle, spawn=False)
+
+    def _start(self, kind, key, command, timeout, stream=False):
+        self._bind(kind)
+
+        query = Query(
+            self, kind, self._key(key), self.client._new_future(),
+            self.client._new_queue() if stream else None
+        )
+
+        replies, ends, errors = self.kinds[kind][:3]
+        for numeric in replies + ends + errors:
+            self._pending[numeric].append(query)
+
+        if timeout is None:
+            timeout = self.timeout
+        if timeout:
+            query._cancel_timeout = self.client._call_later(
+                timeout, self._timeout, query
+            )
+
+        self.client.send(command)
+        return query
+
+    def _remove(self, query):
+        replies, ends, errors = self.kinds[query.kind][:3]
+        for numeric in replies + ends + errors:
+            try:
+                self._pending[numeric].remove(query)
+            except ValueError:
+                pass
+
+    def _timeout(self, query):
+        self._remove(query)
+        query._cancel_timeout = None
+        query._finish(QueryTimeout(None, None))
+
+    def _handle_disconnect(self, event_type, source, target, args):
+        queries = set()
+        for pending in self._pending.values():
+            queries.update(pending)
+            del pending[:]
+        for query in queries:
+            query._finish(QueryError('DISCONNECT', None))
+        self._whois_cache.clear()
+
+    def _handle(self, event_type, source, target, args):
+        pending = self._pending.get(event_type)
+        if not pending:
+            return
+
+        index = self.key_index.get(event_type)
+        if index is None:
+            query = pending[0]
+        else:
+            key = self._key(args[index]) if len(args) > index else None
+            error = event_type in self.kinds[pending[0].kind][2]
+            for query in pending:
+                # an error about a nick/channel never fails an unkeyed query
+                if query.key == key or (query.key is None and not error):
+                    break
+            else:
+                return
+
+        ends, errors = self.kinds[query.kind][1:3]
+        if event_type in errors:
+            query.error = (event_type, args)
+        else:
+            # end numerics can carry data too (324)
+            query._feed(event_type, args)
+
+        if event_type in ends or \
+                event_type in self.final_errors.get(query.kind, ()):
+            self._remove(query)
+            query._finish()
+
+    # queries
+    def who(self, mask, op='', timeout=None):
+        '''result: list of dicts (nick, user, host, ...)'''
+        # keyed by the mask, 315 and 403 carry it
+        return self._start(
+            'WHO', mask, 'WHO {} {}'.format(mask, op).rstrip(), timeout
+        )
+
+    def whois(self, nick, timeout=None, cache=True):
+        '''result: dict (nick, user, host, realname, channels, ...),
+        fails with QueryError if the nick doesn't exist. Successful results
+        are cached for whois_ttl seconds and concurrent requests for the
+        same nick share one query.'''
+        key = self._key(nick)
+        now = time.monotonic()
+
+        if cache:
+            cached = self._whois_cache.get(key)
+            if cached is not None:
+                expires, query = cached
+                if not query.done() or (expires > now and not query.failed):
+                    return query
+
+        query = self._start('WHOIS', nick, 'WHOIS {}'.format(nick), timeout)
+        if cache:
+            if len(self._whois_cache) > 1024:
+                self._whois_cache = dict(
+                    (k, v) for k, v in self._whois_cache.items()
+                    if v[0] > now
+                )
+            self._whois_cache[key] = (now + self.whois_ttl, query)
+        return query
+
+    def names(self, channel, timeout=None):
+        '''result: list of names as sent by the server (with prefixes)'''
+        return self._start(
+            'NAMES', channel, 'NAMES {}'.format(channel), timeout
+        )
+
+    def list(self, channels=None, timeout=None):
+        '''streaming query, iterating yields (channel, users, topic)'''
+        cmd = 'LIST'
+        if channels is not None:
+            cmd = 'LIST {}'.format(','.join(channels))
+        return self._start('LIST', None, cmd, timeout, stream=True)
+
+    def mode(self, channel, mode='', timeout=None):
+        '''without mode the result is (modes, params), for the list modes
+        b, e and I it is a list of (mask, setter, time) tuples'''
+        if mode.lstrip('+') in ('b', 'e', 'I'):
+            return self._start(
+                'MODE_LIST', channel,
+                'MODE {} {}'.format(channel, mode), timeout
+            )
+        return self._start('MODE', channel, 'MODE {}'.format(channel), timeout)
@@ -0,0 +1,104 @@
+'''reconnect policy and happy eyeballs connects.
+
+    client = awirc.Client('nick', 'irc.example.net', 6667,
+                          reconnect=awirc.reconnect.Backoff(maximum=120))
+    client.connect(happy_eyeballs=True)
+
+A client with reconnect keeps its bindings, state objects and queued
+messages when the connection drops, dispatches DISCONNECT, RECONNECTING
+(args is (attempt, delay)) before every attempt and CONNECT once
+connected again. Joined channels are rejoined after the MOTD.
+'''
+import random
+
+
+class Backoff(object):
+    '''jittered exponential backoff.
+
+    The delay of attempt n is min(maximum, initial * factor ** n), reduced
+    by a random share of up to jitter (1.0 is full jitter), so clients
+    which lost their connection at the same time don't come back at the
+    same time. A connection which lasted stable seconds resets the attempts.'''
+    def __init__(self, initial=1.0, maximum=300.0, factor=2.0, jitter=0.5,
+                 stable=60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.stable = stable
+
+    def delay(self, attempt):
+        # the exponent is bounded, a float would overflow eventually
+        delay = min(self.maximum,
+                    self.initial * self.factor ** min(attempt, 64))
+        return delay * (1 - self.jitter * random.random())
+
+
+def happy_eyeballs(host, port, timeout=10, source=None, delay=0.25):
+    '''connects to all addresses of host, alternating address families
+    (IPv6 first) and starting the next attempt every delay seconds while
+    the previous ones are pending (RFC 8305). Returns the first connected
+    socket, the others are closed.'''
+    # not on import, the asyncio backend uses Backoff without gevent
+    import gevent.socket
+    import gevent.event
+    import gevent.pool
+    import gevent
+
+    infos = gevent.socket.getaddrinfo(
+        host, port, 0, gevent.socket.SOCK_STREAM
+    )
+    if not infos:
+        raise OSError('getaddrinfo returned no addresses for {}'.format(host))
+
+    by_family = dict()
+    for info in infos:
+        by_family.setdefault(info[0], list()).append(info)
+    families = sorted(by_family, key=lambda f: f != gevent.socket.AF_INET6)
+    ordered = list()
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+
+    result = gevent.event.AsyncResult()
+    errors = list()
+    group = gevent.pool.Group()
+
+    def attempt(info):
+        family, type_, proto, _, address = info
+        sock = gevent.socket.socket(family, type_, proto)
+        connected = False
+        try:
+            sock.settimeout(timeout)
+            if source is not None:
+                sock.bind(source)
+            sock.connect(address)
+            connected = True
+        except OSError as e:
+            errors.append(e)
+            if len(errors) == len(ordered):
+                result.set_exception(errors[-1])
+        finally:
+            # failed, killed or lost the race
+            if not connected or result.ready():
+                sock.close()
+        if connected and not result.ready():
+            result.set(sock)
+
+    def start():
+        for info in ordered:
+            group.spawn(attempt, info)
+            if result.wait(delay) is not None or result.ready():
+                break
+
+    starter = gevent.spawn(start)
+    try:
+        sock = result.get(timeout=timeout)
+    except gevent.Timeout:
+        raise gevent.socket.timeout('timed out')
+    finally:
+        starter.kill()
+        group.kill()
+    sock.settimeout(None)
+    return sock
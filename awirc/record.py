@@ -0,0 +1,184 @@
+'''records inbound traffic of a client and replays it without a socket.
+
+    recorder = awirc.record.Recorder('capture.awr')
+    recorder.attach(client)
+    ...
+    recorder.close()
+
+    client = awirc.Client('nick', 'irc.example.net', 6667, inline=True)
+    client.bind('PUBMSG', handler)
+    awirc.record.replay(client, 'capture.awr')            # fast as possible
+    awirc.record.replay(client, 'capture.awr', speed=1)   # real time
+
+The file starts with MAGIC, followed by one record per line: the receive
+time (seconds since the epoch, double), the length of the line (uint32)
+and the raw line without delimiter. Records are only appended, a capture
+cut off by a crash is read up to the last complete record.
+'''
+import struct
+import mmap
+import time
+
+MAGIC = b'AWIRCREC\x01'
+_RECORD = struct.Struct('!dI')
+# seconds, smaller gaps of a timed replay are caught up with the next sleep
+_MIN_SLEEP = 0.001
+
+
+class Recorder(object):
+    def __init__(self, path, buffering=65536, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.lines = 0
+
+        self._file = open(path, 'ab', buffering=buffering)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._clients = list()
+
+    def write(self, line, timestamp=None):
+        '''appends one raw line (str or bytes)'''
+        if isinstance(line, str):
+            line = line.encode('utf-8')
+        if timestamp is None:
+            timestamp = self.clock()
+        self._file.write(_RECORD.pack(timestamp, len(line)) + line)
+        self.lines += 1
+
+    def attach(self, client):
+        '''records every line client receives, before it is parsed (where
+        RAW_MESSAGE is dispatched)'''
+        line_received = client.line_received
+        write = self.write
+
+        def recording_line_received(line):
+            write(line)
+            return line_received(line)
+
+        client.line_received = recording_line_received
+        self._clients.append((client, line_received))
+
+    def detach(self, client):
+        for entry in self._clients:
+            if entry[0] is client:
+                client.line_received = entry[1]
+                self._clients.remove(entry)
+                break
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        for client, _ in list(self._clients):
+            self.detach(client)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Capture(object):
+    '''reads a recorded file through mmap, iterating yields
+    (timestamp, line) tuples'''
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            self._map = b''
+
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('{!r} is not an awirc capture'.format(path))
+
+    def __iter__(self):
+        data = self._map
+        size = len(data)
+        header = _RECORD.size
+        unpack_from = _RECORD.unpack_from
+
+        offset = len(MAGIC)
+        while offset + header <= size:
+            timestamp, length = unpack_from(data, offset)
+            offset += header
+            if offset + length > size:
+                # incomplete last record
+                break
+            yield timestamp, data[offset:offset + length]
+            offset += length
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def replay(client, path, speed=None, sleep=None, yield_every=1024):
+    '''feeds the lines of a capture to client.line_received, returns the
+    number of lines.
+
+    With speed None the lines are replayed as fast as possible (yielding
+    to other greenlets every yield_every lines so spawned handlers run),
+    otherwise the recorded gaps are kept, divided by speed. sleep defaults
+    to gevent.sleep.'''
+    if sleep is None:
+        import gevent
+        sleep = gevent.sleep
+
+    line_received = client.line_received
+    count = 0
+    with Capture(path) as capture:
+        first = start = None
+        for timestamp, line in capture:
+            if speed is not None:
+                if first is None:
+                    first, start = timestamp, time.monotonic()
+                ahead = (timestamp - first) / speed - \
+                    (time.monotonic() - start)
+                # sleeping for every line would cost more than the gaps
+                if ahead > _MIN_SLEEP:
+                    sleep(ahead)
+            elif yield_every and not count % yield_every:
+                sleep(0)
+
+            line_received(line)
+            count += 1
+    sleep(0)
+    return count
+
+
+async def replay_async(client, path, speed=None, yield_every=1024):
+    '''replay for awirc.aio clients'''
+    import asyncio
+
+    line_received = client.line_received
+    count = 0
+    with Capture(path) as capture:
+        first = start = None
+        for timestamp, line in capture:
+            if speed is not None:
+                if first is None:
+                    first, start = timestamp, time.monotonic()
+                ahead = (timestamp - first) / speed - \
+                    (time.monotonic() - start)
+                if ahead > _MIN_SLEEP:
+                    await asyncio.sleep(ahead)
+            elif yield_every and not count % yield_every:
+                await asyncio.sleep(0)
+
+            line_received(line)
+            count += 1
+    await asyncio.sleep(0)
+    return count
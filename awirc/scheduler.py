@@ -0,0 +1,189 @@
+from collections import OrderedDict, deque
+import time
+
+
+# priority lanes, lower values are sent first
+PRIORITY_HIGH = 0  # PONG, QUIT
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# target of the messages put with first, it is not rotated
+_FIRST = object()
+
+
+class TokenBucket(object):
+    '''flood control, similar to what ircds enforce.
+
+    The bucket holds up to burst tokens and refills rate tokens per
+    second. Every message costs one token, plus one additional token per
+    penalty_bytes bytes if penalty_bytes is set. The defaults match
+    common client defaults (5 messages at once, then one every 2 seconds).'''
+    def __init__(self, burst=5, rate=0.5, penalty_bytes=None,
+                 clock=time.monotonic):
+        self.burst = burst
+        self.rate = rate
+        self.penalty_bytes = penalty_bytes
+        self.clock = clock
+
+        self.tokens = float(burst)
+        self._last = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self._last) * self.rate
+        )
+        self._last = now
+
+    def cost(self, message):
+        if self.penalty_bytes:
+            return 1 + len(message) // self.penalty_bytes
+        return 1
+
+    def delay(self, message):
+        '''returns the seconds until message may be sent, 0 if it can
+        be sent right away'''
+        self._refill()
+        # a message can never cost more than a full bucket
+        needed = min(self.cost(message), self.burst)
+        if self.tokens >= needed:
+            return 0
+        return (needed - self.tokens) / self.rate
+
+    def consume(self, message):
+        '''charges the bucket for message, the bucket may go into debt'''
+        self._refill()
+        self.tokens -= self.cost(message)
+
+
+class Scheduler(object):
+    '''outgoing message scheduler.
+
+    Messages are queued in priority lanes, within a lane every target
+    gets its own FIFO and the targets are served round robin, so one busy
+    target can't starve the others. If a TokenBucket is given, messages
+    are only released at the rate it allows, messages in the PRIORITY_HIGH
+    lane are never held back but still charged.
+
+    The scheduler itself never blocks, the connection asks for the next
+    message with pop and waits for the returned delay. Connections use a
+    Scheduler with the default TokenBucket unless they are given one.'''
+    lanes = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+    def __init__(self, bucket=None, clock=time.monotonic):
+        self.bucket = bucket
+        self.clock = clock
+
+        # lane -> OrderedDict(target -> deque((queued_at, message)))
+        self._lanes = dict((lane, OrderedDict()) for lane in self.lanes)
+        self._size = 0
+
+        self._sent = 0
+        self._dropped = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def __len__(self):
+        return self._size
+
+    def put(self, message, priority=PRIORITY_NORMAL, target=None,
+            first=False):
+        '''queues message, messages put with first are sent before the
+        other messages of their lane (in the order they were put)'''
+        targets = self._lanes[priority]
+        if first:
+            target = _FIRST
+        try:
+            queue = targets[target]
+        except KeyError:
+            queue = targets[target] = deque()
+            if first:
+                targets.move_to_end(target, last=False)
+        queue.append((self.clock(), message))
+        self._size += 1
+
+    def pop(self, max_size=None, max_priority=None):
+        '''returns a (message, delay) tuple. message is None if there is
+        nothing to send right now, delay is the number of seconds until the
+        next message may be sent or None if the scheduler is empty.
+        Messages larger than max_size are not returned, lanes above
+        max_priority are held back.'''
+        for lane in self.lanes:
+            if max_priority is not None and lane > max_priority:
+                break
+            targets = self._lanes[lane]
+            if not targets:
+                continue
+
+            target, queue = next(iter(targets.items()))
+            queued_at, message = queue[0]
+
+            if max_size is not None and len(message) > max_size:
+                return None, 0
+
+            if self.bucket is not None:
+                if lane != PRIORITY_HIGH:
+                    delay = self.bucket.delay(message)
+                    if delay:
+                        return None, delay
+                self.bucket.consume(message)
+
+            queue.popleft()
+            if queue:
+                if target is not _FIRST:
+                    targets.move_to_end(target)
+            else:
+                del targets[target]
+            self._size -= 1
+
+            wait = self.clock() - queued_at
+            self._sent += 1
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+
+            return message, 0
+
+        return None, None
+
+    def drop(self, priority=PRIORITY_LOW):
+        '''removes the oldest message of the target with the most queued
+        messages in lane priority, returns it or None if the lane is empty'''
+        targets = self._lanes[priority]
+        if not targets:
+            return None
+
+        target = max(targets, key=lambda t: len(targets[t]))
+        queue = targets[target]
+        _, message = queue.popleft()
+        if not queue:
+            del targets[target]
+        self._size -= 1
+        self._dropped += 1
+        return message
+
+    def clear(self):
+        for targets in self._lanes.values():
+            targets.clear()
+        self._size = 0
+
+    def stats(self):
+        '''returns a dict with the current queue depth (total and per lane)
+        and the wait times of sent messages'''
+        now = self.clock()
+        oldest = [queue[0][0] for targets in self._lanes.values()
+                  for queue in targets.values()]
+
+        return {
+            'queued': self._size,
+            'lanes': dict(
+                (lane, sum(len(q) for q in targets.values()))
+                for lane, targets in self._lanes.items()
+            ),
+            'targets': sum(len(targets) for targets in self._lanes.values()),
+            'sent': self._sent,
+            'dropped': self._dropped,
+            'wait_avg': self._wait_total / self._sent if self._sent else 0.0,
+            'wait_max': self._wait_max,
+            'oldest_wait': now - min(oldest) if oldest else 0.0,
+            'tokens': self.bucket.tokens if self.bucket is not None else None,
+        }
@@ -0,0 +1,311 @@
+'''spreads clients over several worker processes.
+
+Every worker process runs an awirc.manager.ClientManager, clients are
+assigned to a worker by their key. Events selected by `forward` are sent
+to the supervisor (parent process) and dispatched there, method calls on
+a RemoteClient are sent to the worker owning the client:
+
+    supervisor = ShardSupervisor(workers=4, forward=('PUBMSG',))
+    supervisor.bind('PUBMSG', handler)
+    supervisor.start()
+    supervisor.add('net1', 'nick', 'irc.example.net', 6667)
+    supervisor.connect_all()
+    supervisor.client('net1').join_channel('#awirc')
+
+Supervisor handlers are called with the key of the client:
+
+    handler(event_type, key, source, target, args)
+'''
+import multiprocessing
+import traceback
+import pickle
+import socket
+import struct
+import zlib
+import sys
+import os
+
+import gevent.socket
+import gevent.queue
+import gevent.pool
+import gevent
+
+from awirc.event import EventManager, compile_pattern
+from awirc.protocol import Prefix
+import awirc.manager
+
+
+_HEADER = struct.Struct('!I')
+
+
+class Channel(object):
+    '''length prefixed pickle frames over a (gevent) socket'''
+    chunk_size = 65536
+
+    def __init__(self, sock):
+        self._socket = sock
+        self._out_queue = gevent.queue.Queue()
+        self._writer = gevent.spawn(self._write)
+
+    def send(self, obj):
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        self._out_queue.put(_HEADER.pack(len(data)) + data)
+
+    def _write(self):
+        queue = self._out_queue
+        while True:
+            frames = [queue.get()]
+            while queue.qsize():
+                frames.append(queue.get_nowait())
+            # None is queued by close, after the last frame
+            closing = None in frames
+            if closing:
+                frames = [frame for frame in frames if frame is not None]
+            try:
+                self._socket.sendall(b''.join(frames))
+            except OSError:
+                break
+            if closing:
+                break
+
+    def __iter__(self):
+        '''yields received objects until the other end closes'''
+        buffer = bytearray()
+        while True:
+            try:
+                incoming = self._socket.recv(self.chunk_size)
+            except OSError:
+                incoming = b''
+            if not incoming:
+                break
+            buffer += incoming
+
+            start = 0
+            while len(buffer) - start >= _HEADER.size:
+                size, = _HEADER.unpack_from(buffer, start)
+                end = start + _HEADER.size + size
+                if len(buffer) < end:
+                    break
+                yield pickle.loads(buffer[start + _HEADER.size:end])
+                start = end
+            del buffer[:start]
+
+    def close(self, timeout=1):
+        '''sends the queued frames (waiting up to timeout for them) and
+        closes the socket'''
+        self._out_queue.put(None)
+        self._writer.join(timeout)
+        self._writer.kill()
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+
+
+def shard_of(key, workers):
+    '''returns the worker index for key, stable across processes'''
+    return zlib.crc32(str(key).encode('utf-8')) % workers
+
+
+class RemoteClient(object):
+    '''proxy for a client living in a worker process, calling a method
+    sends it to the worker, return values are discarded'''
+    def __init__(self, supervisor, key):
+        self._supervisor = supervisor
+        self.key = key
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            self._supervisor.call(self.key, name, *args, **kwargs)
+        return call
+
+
+class ShardSupervisor(EventManager):
+    # handlers are called with the key of the client first
+    source_index = 1
+    target_index = 2
+
+    default_forward = ('CONNECT', 'DISCONNECT', 'PUBMSG', 'PRIVMSG',
+                       'PUBNOTICE', 'PRIVNOTICE')
+
+    def __init__(self, workers=None, forward=None, pool_size=None,
+                 init=None, inline=False):
+        '''workers defaults to the number of CPUs. forward is a list of
+        event types (wildcards allowed) sent to the supervisor, pool_size
+        bounds the handler pool of every worker. init is called with the
+        ClientManager in every worker, it has to be picklable (a module
+        level function) and can bind worker local handlers.'''
+        self._pool = gevent.pool.Group()
+        EventManager.__init__(self, self._pool, inline=inline)
+
+        self.workers = workers or os.cpu_count() or 1
+        self.forward = tuple(
+            self.default_forward if forward is None else forward
+        )
+        self.pool_size = pool_size
+        self.init = init
+
+        self._processes = list()
+        self._channels = list()
+        self.keys = dict()  # key -> worker index
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+
+        for index in range(self.workers):
+            parent, child = socket.socketpair()
+            process = context.Process(
+                target=_worker_main,
+                args=(child, self.forward, self.pool_size, self.init),
+                name='awirc-shard-{}'.format(index),
+                daemon=True
+            )
+            process.start()
+            child.close()
+
+            channel = Channel(gevent.socket.socket(fileno=parent.detach()))
+            self._processes.append(process)
+            self._channels.append(channel)
+            self._pool.spawn(self._read, index, channel)
+
+    def _read(self, index, channel):
+        for message in channel:
+            if message[0] == 'event':
+                _, key, event_type, source, target, args = message
+                if source is not None:
+                    source = Prefix.intern(source)
+                self.process_event(event_type, key, source, target, args)
+            elif message[0] == 'error':
+                self.handle_worker_error(index, *message[1:])
+
+    def handle_worker_error(self, index, key, text):
+        '''called with the formatted traceback of a failed command'''
+        sys.stderr.write(
+            'awirc shard {} ({!r}): {}'.format(index, key, text)
+        )
+
+    def shard(self, key):
+        return shard_of(key, self.workers)
+
+    def _send(self, key, message):
+        index = self.keys.get(key)
+        if index is None:
+            raise KeyError(key)
+        self._channels[index].send(message)
+
+    def add(self, key, *args, **kwargs):
+        '''creates a client in the worker owning key,
+        arguments are passed to awirc.Client'''
+        if key in self.keys:
+            raise ValueError('client {!r} already exists'.format(key))
+
+        self.keys[key] = self.shard(key)
+        self._send(key, ('add', key, args, kwargs))
+        return RemoteClient(self, key)
+
+    def remove(self, key, msg=''):
+        '''disconnects and removes the client'''
+        self._send(key, ('remove', key, msg))
+        del self.keys[key]
+
+    def client(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        return RemoteClient(self, key)
+
+    def call(self, key, method, *args, **kwargs):
+        '''calls method on the client in its worker'''
+        self._send(key, ('call', key, method, args, kwargs))
+
+    def connect(self, key, **kwargs):
+        self._send(key, ('connect', key, kwargs))
+
+    def connect_all(self, stagger=None, **kwargs):
+        '''staggered connect of all clients, in every worker'''
+        for channel in self._channels:
+            channel.send(('connect_all', stagger, kwargs))
+
+    def stop(self, msg='', timeout=5):
+        '''disconnects all clients and stops the workers'''
+        for channel in self._channels:
+            channel.send(('stop', msg))
+        for process in self._processes:
+            # Process.join would block the hub (and the channel writers)
+            try:
+                gevent.socket.wait_read(process.sentinel, timeout=timeout)
+            except gevent.socket.timeout:
+                process.terminate()
+            process.join()
+        for channel in self._channels:
+            channel.close()
+        self._pool.kill()
+
+        self._processes = list()
+        self._channels = list()
+        self.keys = dict()
+
+
+def _forwarder(channel, key, patterns, index):
+    previous = [compile_pattern(p.upper()) for p in patterns[:index]]
+
+    def forward(client, event_type, source, target, args):
+        # events matching an earlier pattern were already forwarded
+        if any(match(event_type) for match in previous):
+            return
+        if source is not None:
+            source = str(source)
+        channel.send(('event', key(client), event_type, source, target, args))
+    return forward
+
+
+def _worker_main(sock, forward, pool_size, init):
+    channel = Channel(gevent.socket.socket(fileno=sock.detach()))
+    manager = awirc.manager.ClientManager(pool_size)
+    keys = dict()  # id(client) -> key
+
+    for index, pattern in enumerate(forward):
+        manager.bind(
+            pattern,
+            _forwarder(channel, lambda c: keys[id(c)], forward, index),
+            spawn=False
+        )
+
+    if init is not None:
+        init(manager)
+
+    for message in channel:
+        command = message[0]
+        try:
+            if command == 'add':
+                _, key, args, kwargs = message
+                client = manager.create(key, *args, **kwargs)
+                keys[id(client)] = key
+            elif command == 'remove':
+                _, key, msg = message
+                client = manager.remove(key)
+                keys.pop(id(client), None)
+                if client.connected:
+                    gevent.spawn(client.disconnect, msg)
+            elif command == 'call':
+                _, key, method, args, kwargs = message
+                getattr(manager[key], method)(*args, **kwargs)
+            elif command == 'connect':
+                _, key, kwargs = message
+                manager.connect(key, **kwargs)
+            elif command == 'connect_all':
+                _, stagger, kwargs = message
+                manager.connect_all(stagger, **kwargs)
+            elif command == 'stop':
+                manager.disconnect_all(message[1])
+                break
+        except Exception:
+            # stop and connect_all don't carry a key
+            key = None
+            if command in ('add', 'remove', 'call', 'connect'):
+                key = message[1]
+            channel.send(('error', key, traceback.format_exc()))
+
+    channel.close()
@@ -4,98 +4,589 @@ import gevent.event
 import gevent.pool
 import gevent.ssl
 import gevent
+import traceback
+import time
+import sys
 
-import awirc.utils
+from awirc.client import BaseClient
+from awirc.protocol import Protocol
+import awirc.monkey
+import awirc.reconnect
+import awirc.scheduler
+import awirc.tls
+import awirc.wire
 
 
 class Connection(object):
-    delimiter = '\r\n'
+    delimiter = awirc.wire.DELIMITER
+    # send cuts the trailing argument of longer lines (awirc.wire.truncate),
+    # None disables the limit
+    max_line_length = awirc.wire.MAX_LINE_LENGTH
+    # initial size of the receive buffer, it grows up to max_chunk_size
+    # while the server sends faster than we read
     chunk_size = 4096
+    max_chunk_size = 65536
+    # upper bounds for a single (vectored) write of queued messages,
+    # max_write_lines stays below IOV_MAX
+    max_write_size = 16384
+    max_write_lines = 1024
 
-    def __init__(self, pool, host, port, ssl=False):
+    # with reconnect only PRIORITY_HIGH messages (registration) are sent
+    # until release_outbound is called, messages queued while disconnected
+    # wait for the registration
+    hold_until_registered = False
+
+    # bounds, 0 is unbounded. Without inline, up to max_inbound received
+    # lines wait for the dispatching greenlet before the reader stops
+    # receiving (the server's sends back up in TCP instead of memory).
+    # Once max_outbound messages are queued, send blocks until the writer
+    # made room (outbound_policy 'block') or drops messages, PRIORITY_LOW
+    # first ('drop'). PRIORITY_HIGH messages are never held back.
+    max_inbound = 10000
+    max_outbound = 0
+    outbound_policy = 'block'
+
+    def __init__(self, pool, host, port, ssl=False, inline=False,
+                 chunk_size=None, scheduler=None, reconnect=None,
+                 max_inbound=None, max_outbound=None, outbound_policy=None):
         self._pool = pool
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+            self.max_chunk_size = max(self.max_chunk_size, chunk_size)
+        if max_inbound is not None:
+            self.max_inbound = max_inbound
+        if max_outbound is not None:
+            self.max_outbound = max_outbound
+        if outbound_policy is not None:
+            self.outbound_policy = outbound_policy
+        if self.outbound_policy not in ('block', 'drop'):
+            raise ValueError(
+                'unknown outbound_policy {!r}'.format(self.outbound_policy)
+            )
 
         self.host = host
         self.port = port
         self.ssl = ssl
+        # host is replaced with the peer address once connected, SNI and
+        # certificate checks need the name
+        self.server_hostname = host
+        # inline calls line_received directly in the read greenlet
+        self.inline = inline
 
         self._socket = None
+        self._reader = None
+        self._writer = None
+        self._dispatcher = None
+        self._in_queue = None
 
         self._connected = False
-        self._out_queue = gevent.queue.Queue()
+        # set by terminate, stops reconnecting
+        self._terminated = False
+        self._connected_at = None
+
+        # awirc.reconnect.Backoff or None, True uses the default backoff
+        if reconnect is True:
+            reconnect = awirc.reconnect.Backoff()
+        self.reconnect = reconnect or None
+        self._reconnect_attempt = 0
+        self._connect_args = dict()
+        # (context, session) of the last TLS connection, resumed on reconnect
+        self._tls_session = None
+        self.tls_resumed = False
+        # lanes above are held back, None sends everything
+        self._out_priority = None
+
+        if scheduler is None:
+            # flood control by default, awirc.scheduler.Scheduler() without
+            # a bucket sends as fast as the socket allows
+            scheduler = awirc.scheduler.Scheduler(
+                awirc.scheduler.TokenBucket()
+            )
+        self.scheduler = scheduler
+        # set whenever a message gets queued, wakes up the writer
+        self._out_ready = gevent.event.Event()
+        # set once all queued messages were written
+        self._out_flushed = gevent.event.Event()
+        self._out_flushed.set()
+        self._out_pending = 0
+        # cleared while a send waits for room in the outbound queue
+        self._out_room = gevent.event.Event()
+        self._out_room.set()
+
+        self.dropped = 0
+        self.lines_in = 0
+        # received lines longer than max_chunk_size, they are dropped
+        self.overlong_lines = 0
+        self.bytes_in = 0
+        self.lines_out = 0
+        self.bytes_out = 0
 
-    def connect(self, timeout=10, source=None, ssl_args=None):
+    def connect(self, timeout=10, source=None, ssl_args=None,
+                happy_eyeballs=False, handshake_timeout=None):
+        '''connects to the server, with happy_eyeballs all resolved
+        addresses are tried concurrently (see awirc.reconnect). TLS
+        contexts are shared between clients (see awirc.tls), the TLS
+        handshake may take up to handshake_timeout (default timeout)'''
         if ssl_args is None:
             ssl_args = dict()
+        self._connect_args = dict(timeout=timeout, source=source,
+                                  ssl_args=ssl_args,
+                                  happy_eyeballs=happy_eyeballs,
+                                  handshake_timeout=handshake_timeout)
+        self._terminated = False
 
-        self._socket = gevent.socket.create_connection(
-            (self.host, self.port),
-            timeout=timeout,
-            source_address=source
-        )
+        if happy_eyeballs:
+            self._socket = awirc.reconnect.happy_eyeballs(
+                self.host, self.port, timeout=timeout, source=source
+            )
+        else:
+            self._socket = gevent.socket.create_connection(
+                (self.host, self.port),
+                timeout=timeout,
+                source_address=source
+            )
 
         if self.ssl:
-            self._socket = gevent.ssl.wrap_socket(self._socket, **ssl_args)
+            if handshake_timeout is None:
+                handshake_timeout = timeout
+            self._socket = self._wrap_ssl(self._socket, ssl_args,
+                                          handshake_timeout)
 
         gevent.socket.wait_write(self._socket.fileno(), timeout=timeout)
-        read = self._pool.spawn(self._read)
+        self._connected = True
+        self._connected_at = time.monotonic()
+        if self.hold_until_registered and self.reconnect is not None:
+            self._out_priority = awirc.scheduler.PRIORITY_HIGH
+
+        if not self.inline and (self._dispatcher is None or
+                                self._dispatcher.dead):
+            # kept across reconnects, lines received before are dispatched
+            self._in_queue = gevent.queue.Queue(self.max_inbound or None)
+            self._dispatcher = self._pool.spawn(self._dispatch)
+
+        self._reader = self._pool.spawn(self._read)
         # the read greenlet exits (e.g. other end closes connection, timeout)
         # but the write greenlet will still wait for information
-        read.link(lambda g: self.terminate())
-        self._pool.spawn(self._write)
+        self._reader.link(lambda g: self._connection_lost())
+        self._writer = self._pool.spawn(self._write)
 
         self.handle_connect()
 
+    def _wrap_ssl(self, sock, ssl_args, timeout):
+        context = awirc.tls.context(ssl_args, gevent.ssl.SSLContext)
+        session = None
+        if self._tls_session is not None and \
+                self._tls_session[0] is context:
+            session = self._tls_session[1]
+
+        sock = context.wrap_socket(
+            sock, do_handshake_on_connect=False, session=session,
+            server_hostname=ssl_args.get('server_hostname',
+                                         self.server_hostname)
+        )
+        previous = sock.gettimeout()
+        try:
+            sock.settimeout(timeout)
+            sock.do_handshake()
+        except BaseException:
+            sock.close()
+            raise
+        sock.settimeout(previous)
+
+        self.tls_resumed = sock.session_reused
+        self._tls_session = (context, sock.session)
+        return sock
+
+    def _connection_lost(self):
+        if self._terminated:
+            return
+        if self.reconnect is None:
+            self.terminate()
+            return
+
+        # keep the pool (handlers) and the queued messages, a batch the
+        # writer was sending when the connection dropped is lost
+        self._writer.kill(block=False)
+        self._close_socket()
+        # blocked senders drop or queue beyond the bound while disconnected
+        self._out_room.set()
+
+        if time.monotonic() - self._connected_at >= self.reconnect.stable:
+            self._reconnect_attempt = 0
+        self._pool.spawn(self._reconnect)
+
+    def _reconnect(self):
+        while not self._terminated:
+            attempt = self._reconnect_attempt
+            delay = self.reconnect.delay(attempt)
+            self._reconnect_attempt += 1
+
+            self.handle_reconnect(attempt, delay)
+            gevent.sleep(delay)
+            try:
+                self.connect(**self._connect_args)
+            except OSError:
+                continue
+            return
+
     def _read(self):
-        buffer = ''
+        # lines are received into a reusable buffer, `end` marks the end of
+        # the received data. The buffer grows (up to max_chunk_size) if a
+        # recv fills it completely and shrinks back to chunk_size once it
+        # is drained and traffic calms down. A line longer than
+        # max_chunk_size is dropped up to its delimiter.
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        end = 0
+        skipping = False
+
+        delimiter = self.delimiter
+        dlen = len(delimiter)
 
         while True:
             gevent.socket.wait_read(self._socket.fileno())
 
-            incoming = ''
+            if end == len(buffer):
+                if end >= self.max_chunk_size:
+                    # keep what may be the start of a split delimiter
+                    if not skipping:
+                        self.overlong_lines += 1
+                    skipping = True
+                    buffer[:dlen - 1] = buffer[end - dlen + 1:end]
+                    end = dlen - 1
+                else:
+                    # a single line doesn't fit into the buffer
+                    view.release()
+                    buffer.extend(bytes(
+                        min(end, self.max_chunk_size - end)
+                    ))
+                    view = memoryview(buffer)
+
+            received = 0
             try:
-                incoming = self._socket.recv(self.chunk_size)
-            except ConnectionError:
+                received = self._socket.recv_into(view[end:])
+            except OSError:
                 pass
 
-            if not incoming:
+            if not received:
                 break
 
-            try:
-                incoming = incoming.decode('utf-8')
-            except UnicodeDecodeError:
-                incoming = incoming.decode('iso-8859-1', errors='ignore')
+            self.bytes_in += received
+            filled = end + received == len(buffer)
+            end += received
+
+            start = 0
+            if skipping:
+                pos = buffer.find(delimiter, 0, end)
+                if pos == -1:
+                    continue
+                start = pos + dlen
+                skipping = False
+
+            pos = buffer.find(delimiter, start, end)
+            while pos != -1:
+                self.lines_in += 1
+                self._line_received(bytes(view[start:pos]).strip())
+                start = pos + dlen
+                pos = buffer.find(delimiter, start, end)
 
-            buffer += incoming
-            while self.delimiter in buffer:
-                line, buffer = buffer.split(self.delimiter, 1)
-                self._pool.spawn(self.line_received, line.strip())
+            if start:
+                # move the incomplete line to the front
+                buffer[:end - start] = buffer[start:end]
+                end -= start
 
+            size = len(buffer)
+            if filled and size < self.max_chunk_size:
+                size = min(size * 2, self.max_chunk_size)
+            elif not end and received < size // 4 and size > self.chunk_size:
+                size = max(size // 2, self.chunk_size)
+
+            if size != len(buffer):
+                view.release()
+                if size > len(buffer):
+                    buffer.extend(bytes(size - len(buffer)))
+                else:
+                    del buffer[size:]
+                view = memoryview(buffer)
+
+        self._connected = False
         self.handle_disconnect()
 
+    def _line_received(self, line):
+        if self.inline:
+            try:
+                self.line_received(line)
+            except Exception:
+                self.handle_error(self.line_received, *sys.exc_info())
+        else:
+            queue = self._in_queue
+            if queue.full():
+                self.report_overload('inbound', queued=queue.qsize())
+            # blocks the reader while the queue is full
+            queue.put(line)
+
+    def _dispatch(self):
+        # lines are parsed and dispatched in the order they were received,
+        # handlers are spawned unless they were bound with spawn=False
+        queue = self._in_queue
+        low = self.max_inbound // 2
+
+        while True:
+            line = queue.get()
+            try:
+                self.line_received(line)
+            except Exception:
+                self.handle_error(self.line_received, *sys.exc_info())
+
+            if self._overloaded and queue.qsize() <= low:
+                self.clear_overload('inbound')
+
     def _write(self):
+        scheduler = self.scheduler
+
         while True:
-            message = self._out_queue.get()
-            self._socket.sendall(message)
+            message, delay = scheduler.pop(max_priority=self._out_priority)
+            if message is None:
+                # empty (delay is None) or flood control holds it back,
+                # a new message may be allowed earlier (priority)
+                self._out_ready.clear()
+                self._out_ready.wait(delay)
+                continue
 
-    def send(self, data):
-        message = awirc.utils.low_quote(data)
-        message = message + self.delimiter
-        message = message.encode('utf-8')
-        self._out_queue.put(message)
+            batch = [message]
+            size = len(message)
 
-    def terminate(self, block=True, timeout=None):
+            # send everything which is ready in one go
+            while len(batch) < self.max_write_lines:
+                message, _ = scheduler.pop(self.max_write_size - size,
+                                           self._out_priority)
+                if message is None:
+                    break
+                batch.append(message)
+                size += len(message)
+
+            try:
+                self._sendall(batch)
+                self.lines_out += len(batch)
+                self.bytes_out += size
+            finally:
+                # a batch lost with the connection (the writer is killed)
+                # isn't pending anymore either
+                self._out_pending -= len(batch)
+                if not self._out_pending:
+                    self._out_flushed.set()
+            if self.max_outbound and len(scheduler) < self.max_outbound:
+                self._out_room.set()
+                if self._overloaded and \
+                        len(scheduler) <= self.max_outbound // 2:
+                    self.clear_overload('outbound')
+
+    def _sendall(self, buffers):
+        if self.ssl or len(buffers) == 1:
+            # SSL sockets don't support sendmsg
+            self._socket.sendall(b''.join(buffers))
+            return
+
+        while buffers:
+            sent = self._socket.sendmsg(buffers)
+            for i, buf in enumerate(buffers):
+                if sent < len(buf):
+                    buffers = buffers[i:]
+                    buffers[0] = memoryview(buf)[sent:]
+                    break
+                sent -= len(buf)
+            else:
+                break
+
+    def release_outbound(self):
+        '''sends all queued messages, not just the registration'''
+        self._out_priority = None
+        self._out_ready.set()
+
+    def flush(self, timeout=None):
+        '''blocks until all queued messages were written to the socket,
+        returns False if the timeout expired before that'''
+        return self._out_flushed.wait(timeout=timeout)
+
+    def send(self, data, priority=awirc.scheduler.PRIORITY_NORMAL,
+             target=None, first=False):
+        '''queues data, target is used to share the bandwidth fairly
+        between targets (see awirc.scheduler.Scheduler), first puts it in
+        front of the queued messages. data is a line (str or bytes) or a
+        serialized line (see awirc.wire). The trailing argument of a line
+        longer than max_line_length is cut, without one ValueError is
+        raised. Returns False if the message was dropped (see
+        max_outbound)'''
+        if isinstance(data, bytes) and data.endswith(self.delimiter):
+            message = data
+        else:
+            message = awirc.wire.encode(data, self.max_line_length,
+                                        self.delimiter)
+
+        if self.max_outbound and len(self.scheduler) >= self.max_outbound \
+                and priority != awirc.scheduler.PRIORITY_HIGH:
+            if not self._make_room(priority):
+                return False
+
+        self.scheduler.put(message, priority=priority, target=target,
+                           first=first)
+        self._out_pending += 1
+        self._out_flushed.clear()
+        self._out_ready.set()
+        return True
+
+    def _make_room(self, priority):
+        '''waits for or makes room in the full outbound queue, returns
+        False if the new message has to be dropped'''
+        scheduler = self.scheduler
+        self.report_overload('outbound', queued=len(scheduler))
+
+        if self.outbound_policy == 'block':
+            # only while the writer sends everything, the registration
+            # (or a dropped connection) would never make room
+            while len(scheduler) >= self.max_outbound and \
+                    self._connected and self._out_priority is None:
+                self._out_room.clear()
+                self._out_room.wait()
+            if len(scheduler) < self.max_outbound:
+                return True
+
+        self.dropped += 1
+        if priority != awirc.scheduler.PRIORITY_LOW and \
+                scheduler.drop(awirc.scheduler.PRIORITY_LOW) is not None:
+            self._out_pending -= 1
+            return True
+        return False
+
+    @property
+    def connected(self):
+        return self._connected
+
+    def peername(self):
+        return self._socket.getpeername()
+
+    def traffic_stats(self):
+        '''returns a dict with traffic counters and the state of the
+        outgoing scheduler'''
+        return {
+            'connected': self._connected,
+            'host': self.host,
+            'port': self.port,
+            'lines_in': self.lines_in,
+            'overlong_lines': self.overlong_lines,
+            'bytes_in': self.bytes_in,
+            'lines_out': self.lines_out,
+            'bytes_out': self.bytes_out,
+            'inbound_queued': self._in_queue.qsize() if self._in_queue else 0,
+            'dropped': self.dropped,
+            'overloads': dict(self.overloads),
+            'tls_resumed': self.tls_resumed,
+            'scheduler': self.scheduler.stats(),
+        }
+
+    def _close_socket(self):
+        self._connected = False
+        if self.ssl and self._tls_session is not None:
+            # TLS 1.3 session tickets arrive after the handshake
+            session = getattr(self._socket, 'session', None)
+            if session is not None:
+                self._tls_session = (self._tls_session[0], session)
         try:
             self._socket.shutdown(gevent.socket.SHUT_RDWR)
             self._socket.close()
-        except OSError:
-            # Connection already down
+        except (OSError, AttributeError):
+            # Connection already down or never established
+            pass
+
+    def abort(self):
+        '''closes the connection as if the server did, e.g. when it stopped
+        responding, it is reconnected if reconnect is set'''
+        try:
+            # the reader sees the end of the stream and exits
+            self._socket.shutdown(gevent.socket.SHUT_RDWR)
+        except (OSError, AttributeError):
             pass
 
+    def terminate(self, block=True, timeout=None):
+        self._terminated = True
+        self._close_socket()
+        self._out_room.set()
         self._pool.kill(block=block, timeout=timeout)
 
+    # primitives used by awirc.query
+    def _new_future(self):
+        return gevent.event.AsyncResult()
+
+    def _new_queue(self):
+        return gevent.queue.Queue()
+
+    def _call_later(self, seconds, func, *args):
+        '''calls func after seconds, returns a function cancelling it'''
+        greenlet = gevent.spawn_later(seconds, func, *args)
+        return lambda: greenlet.kill(block=False)
+
     def handle_connect(self):
         pass
 
     def handle_disconnect(self):
         pass
+
+    def handle_reconnect(self, attempt, delay):
+        '''called before reconnect attempt (starting at 0) after delay'''
+        pass
+
+    def handle_error(self, context, type, value, tb):
+        '''called if line_received raises, EventManager.handle_error takes
+        over in a client'''
+        traceback.print_exception(type, value, tb)
+
+
+class Client(BaseClient, Connection, Protocol):
+    def __init__(self, nickname, host, port, ssl=False,
+                 username=None, realname=None, password=None, inline=False,
+                 chunk_size=None, scheduler=None, handler_pool=None,
+                 caps=None, reconnect=None, max_inbound=None,
+                 max_outbound=None, outbound_policy=None, max_handlers=None,
+                 ping_interval=None, ping_timeout=None):
+        # patched here and not on import, so using the asyncio backend
+        # doesn't touch gevent
+        awirc.monkey.patch()
+
+        # greenlets of this connection, handlers are spawned in
+        # handler_pool if one is given (e.g. shared by a ClientManager)
+        # or in a pool of this client running up to max_handlers
+        self._pool = gevent.pool.Group()
+        self._handler_greenlets = None
+        if handler_pool is None and max_handlers:
+            handler_pool = gevent.pool.Pool(max_handlers)
+            self._handler_greenlets = handler_pool
+        if handler_pool is None:
+            handler_pool = self._pool
+
+        Connection.__init__(self, self._pool, host, port, ssl=ssl,
+                            inline=inline, chunk_size=chunk_size,
+                            scheduler=scheduler, reconnect=reconnect,
+                            max_inbound=max_inbound,
+                            max_outbound=max_outbound,
+                            outbound_policy=outbound_policy)
+        BaseClient.__init__(self, handler_pool, nickname, username=username,
+                            realname=realname, password=password,
+                            inline=inline, caps=caps,
+                            ping_interval=ping_interval,
+                            ping_timeout=ping_timeout)
+        Protocol.__init__(self)
+
+    @property
+    def gevent_pool(self):
+        return self._pool
+
+    def terminate(self, block=True, timeout=None):
+        Connection.terminate(self, block=block, timeout=timeout)
+        if self._handler_greenlets is not None:
+            self._handler_greenlets.kill(block=block, timeout=timeout)
+
+    def disconnect(self, msg='', timeout=1):
+        self.quit(msg)
+        # give the QUIT a chance to reach the server
+        self.flush(timeout=timeout)
+        self.terminate()
@@ -0,0 +1,312 @@
+'''channel and user state tracking.
+
+    client = awirc.Client(...)
+    state = awirc.state.StateTracker(client)
+
+    state.channel('#awirc').members  # {nick key: prefix modes}
+    state.user('Nick').channels      # {channel key, ...}
+
+All nicks and channel names are keyed by their lowered form according to
+the CASEMAPPING of the server (use StateTracker.key). Every user is stored
+once, no matter in how many channels it is, so updates for JOIN, PART,
+KICK, QUIT and NICK only touch the channels of the affected user.
+'''
+import awirc.protocol
+import awirc.utils
+
+
+class User(object):
+    __slots__ = ('nick', 'user', 'host', 'realname', 'account', 'away',
+                 'channels')
+
+    def __init__(self, nick, user=None, host=None):
+        self.nick = nick
+        self.user = user
+        self.host = host
+        self.realname = None
+        self.account = None
+        self.away = False
+        # keys of the channels the user is in (which we know of)
+        self.channels = set()
+
+    def __repr__(self):
+        return 'User(nick={!r}, user={!r}, host={!r})'.format(
+            self.nick, self.user, self.host
+        )
+
+
+class Channel(object):
+    __slots__ = ('name', 'topic', 'modes', 'members')
+
+    def __init__(self, name):
+        self.name = name
+        self.topic = None
+        # channel modes without list modes, mode -> parameter or None
+        self.modes = dict()
+        # user key -> prefix modes of the user, e.g. 'o' or 'ov'
+        self.members = dict()
+
+    def __repr__(self):
+        return 'Channel(name={!r}, members={})'.format(
+            self.name, len(self.members)
+        )
+
+
+class StateTracker(object):
+    def __init__(self, client):
+        self.client = client
+        client.state = self
+
+        self.users = dict()
+        self.channels = dict()
+
+        self.key = awirc.utils.casemapper('rfc1459')
+        # prefix mode -> prefix symbol and the other way round
+        self.prefix = {'o': '@', 'v': '+'}
+        self._prefix_modes = {'@': 'o', '+': 'v'}
+        # list modes, modes which always / only when set take a parameter
+        self._list_modes = set('beI')
+        self._param_modes = set('beIkqaohv')
+        self._param_set_modes = set('l')
+
+        self._handlers = dict([
+            ('005', self.handle_005),
+            ('JOIN', self.handle_join),
+            ('PART', self.handle_part),
+            ('KICK', self.handle_kick),
+            ('QUIT', self.handle_quit),
+            ('NICK', self.handle_nick),
+            ('MODE', self.handle_mode),
+            ('TOPIC', self.handle_topic),
+            ('332', self.handle_332),
+            ('352', self.handle_352),
+            ('353', self.handle_353),
+            ('DISCONNECT', self.handle_disconnect)])
+        for event_type, handler in self._handlers.items():
+            client.bind(event_type, handler, spawn=False)
+
+    # queries
+    def channel(self, name):
+        return self.channels.get(self.key(name))
+
+    def user(self, nick):
+        return self.users.get(self.key(nick))
+
+    def is_me(self, nick):
+        return self.key(nick) == self.key(self.client.nickname)
+
+    def members(self, channel):
+        '''returns a dict nick -> prefix modes for channel'''
+        chan = self.channel(channel)
+        if chan is None:
+            return dict()
+        users = self.users
+        return dict((users[k].nick, m) for k, m in chan.members.items())
+
+    def channels_of(self, nick):
+        '''returns the names of the known channels of nick'''
+        user = self.user(nick)
+        if user is None:
+            return list()
+        return [self.channels[k].name for k in user.channels]
+
+    # updates
+    def _add_member(self, channel, nick, user=None, host=None, modes=''):
+        key = self.key(nick)
+        u = self.users.get(key)
+        if u is None:
+            u = self.users[key] = User(nick, user, host)
+        elif host is not None:
+            u.user, u.host = user, host
+
+        chan_key = self.key(channel.name)
+        channel.members[key] = modes
+        u.channels.add(chan_key)
+        return u
+
+    def _remove_member(self, chan_key, key):
+        channel = self.channels.get(chan_key)
+        if channel is not None:
+            channel.members.pop(key, None)
+
+        user = self.users.get(key)
+        if user is not None:
+            user.channels.discard(chan_key)
+            if not user.channels:
+                del self.users[key]
+
+    def _remove_channel(self, chan_key):
+        channel = self.channels.pop(chan_key, None)
+        if channel is None:
+            return
+
+        for key in channel.members:
+            user = self.users.get(key)
+            if user is not None:
+                user.channels.discard(chan_key)
+                if not user.channels:
+                    del self.users[key]
+
+    def _parse_names(self, name):
+        '''splits a NAMES entry into (modes, nick, user, host),
+        supports multi-prefix and userhost-in-names'''
+        modes = ''
+        i = 0
+        while i < len(name) and name[i] in self._prefix_modes:
+            modes += self._prefix_modes[name[i]]
+            i += 1
+
+        nick, user, host = name[i:], None, None
+        if '!' in nick:
+            nick, _, userhost = nick.partition('!')
+            user, _, host = userhost.partition('@')
+        return modes, nick, user, host
+
+    def process_batch(self, batch):
+        '''applies the messages of an aggregated batch (they are not
+        dispatched one by one)'''
+        for msg in batch.messages:
+            if isinstance(msg, awirc.protocol.Batch):
+                self.process_batch(msg)
+                continue
+            for event in self.client.message_events(msg):
+                handler = self._handlers.get(event[0])
+                if handler is not None:
+                    handler(*event)
+
+    # event handlers
+    def handle_005(self, event_type, source, target, args):
+        isupport = self.client.rpl_isupport[1]
+
+        if 'CASEMAPPING' in isupport:
+            self.key = awirc.utils.casemapper(isupport['CASEMAPPING'])
+
+        if 'PREFIX' in isupport:
+            self.prefix = dict(isupport['PREFIX'])
+            self._prefix_modes = dict(
+                (v, k) for k, v in self.prefix.items()
+            )
+
+        if 'CHANMODES' in isupport:
+            chanmodes = [str(m) for m in isupport['CHANMODES']] + ['', '']
+            self._list_modes = set(chanmodes[0])
+            self._param_modes = set(chanmodes[0] + chanmodes[1])
+            self._param_set_modes = set(chanmodes[2])
+        self._param_modes.update(self.prefix)
+
+    def handle_join(self, event_type, source, target, args):
+        chan_key = self.key(target)
+
+        channel = self.channels.get(chan_key)
+        if channel is None:
+            if not self.is_me(source.nick):
+                return
+            channel = self.channels[chan_key] = Channel(target)
+
+        user = self._add_member(channel, source.nick, source.user, source.host)
+        # extended-join: JOIN #channel account :realname
+        if len(args) >= 2:
+            user.account = None if args[0] == '*' else args[0]
+            user.realname = args[1]
+
+    def handle_part(self, event_type, source, target, args):
+        chan_key = self.key(target)
+        if self.is_me(source.nick):
+            self._remove_channel(chan_key)
+        else:
+            self._remove_member(chan_key, self.key(source.nick))
+
+    def handle_kick(self, event_type, source, target, args):
+        chan_key = self.key(target)
+        if self.is_me(args[0]):
+            self._remove_channel(chan_key)
+        else:
+            self._remove_member(chan_key, self.key(args[0]))
+
+    def handle_quit(self, event_type, source, target, args):
+        key = self.key(source.nick)
+        user = self.users.pop(key, None)
+        if user is None:
+            return
+
+        for chan_key in user.channels:
+            self.channels[chan_key].members.pop(key, None)
+
+    def handle_nick(self, event_type, source, target, args):
+        old_key = self.key(source.nick)
+        user = self.users.pop(old_key, None)
+        if user is None:
+            return
+
+        user.nick = args[0]
+        new_key = self.key(args[0])
+        self.users[new_key] = user
+
+        for chan_key in user.channels:
+            members = self.channels[chan_key].members
+            members[new_key] = members.pop(old_key)
+
+    def handle_mode(self, event_type, source, target, args):
+        channel = self.channel(target)
+        if channel is None or not args:
+            return
+
+        params = iter(args[1:])
+        adding = True
+        for mode in args[0]:
+            if mode in '+-':
+                adding = mode == '+'
+                continue
+
+            param = None
+            if mode in self._param_modes or \
+                    (adding and mode in self._param_set_modes):
+                param = next(params, None)
+
+            if mode in self.prefix:
+                key = self.key(param or '')
+                if key in channel.members:
+                    modes = channel.members[key].replace(mode, '')
+                    if adding:
+                        # keep the modes ordered by rank
+                        modes = ''.join(
+                            m for m in self.prefix if m in modes or m == mode
+                        )
+                    channel.members[key] = modes
+            elif mode not in self._list_modes:
+                if adding:
+                    channel.modes[mode] = param
+                else:
+                    channel.modes.pop(mode, None)
+
+    def handle_topic(self, event_type, source, target, args):
+        channel = self.channel(args[0])
+        if channel is not None:
+            channel.topic = args[1] if len(args) > 1 else None
+
+    def handle_332(self, event_type, source, target, args):
+        self.handle_topic(event_type, source, target, args[1:])
+
+    def handle_352(self, event_type, source, target, args):
+        # <me> <channel> <user> <host> <server> <nick> <flags> :<hops> <real>
+        if len(args) < 8:
+            return
+        user = self.user(args[5])
+        if user is not None:
+            user.user, user.host = args[2], args[3]
+            user.away = args[6].startswith('G')
+            user.realname = args[7].partition(' ')[2]
+
+    def handle_353(self, event_type, source, target, args):
+        # <me> <type> <channel> :<names>
+        channel = self.channel(args[2])
+        if channel is None:
+            return
+
+        for name in args[3].split():
+            modes, nick, user, host = self._parse_names(name)
+            self._add_member(channel, nick, user, host, modes)
+
+    def handle_disconnect(self, event_type, source, target, args):
+        self.users.clear()
+        self.channels.clear()
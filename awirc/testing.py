@@ -0,0 +1,245 @@
+'''a local stand-in IRC server and scripted traffic for tests and
+benchmarks (see bench.py).
+
+    server = FakeServer()
+    server.start()
+    client = awirc.Client('nick', *server.address)
+    client.connect()
+    server.wait_registered()
+    server.play(privmsg_flood(100000), rate=50000)
+
+The server registers clients (001, 005), answers PING, CAP LS (without
+capabilities), JOIN (with NAMES) and QUIT, everything else is recorded in
+FakeConnection.received if record is set.
+'''
+import itertools
+import random
+import time
+
+import gevent.server
+import gevent.event
+import gevent
+
+
+class FakeConnection(object):
+    def __init__(self, server, sock, address):
+        self.server = server
+        self.socket = sock
+        self.address = address
+        self.nickname = None
+        self.registered = gevent.event.Event()
+        self.received = list()
+        self._user = False
+
+    def send(self, data):
+        '''sends one line (str or bytes, without delimiter) or a list of
+        lines in one write'''
+        if isinstance(data, (list, tuple)):
+            data = b''.join(_line(l) for l in data)
+        else:
+            data = _line(data)
+        self.socket.sendall(data)
+
+    def _serve(self):
+        for line in self.socket.makefile('rb'):
+            line = line.rstrip(b'\r\n').decode('utf-8', 'replace')
+            if self.server.record:
+                self.received.append(line)
+            args = line.split(' ')
+            command = args[0].upper()
+
+            if command == 'NICK':
+                self.nickname = args[1]
+            elif command == 'USER':
+                self._user = True
+            elif command == 'PING':
+                self.send(':{} PONG {} {}'.format(
+                    self.server.name, self.server.name, ' '.join(args[1:])
+                ))
+            elif command == 'CAP' and args[1].upper() == 'LS':
+                self.send(':{} CAP * LS :'.format(self.server.name))
+            elif command == 'JOIN':
+                for channel in args[1].split(','):
+                    self.send([
+                        ':{}!u@localhost JOIN {}'.format(
+                            self.nickname, channel),
+                        ':{} 353 {} = {} :@{}'.format(
+                            self.server.name, self.nickname, channel,
+                            self.nickname),
+                        ':{} 366 {} {} :End of /NAMES list.'.format(
+                            self.server.name, self.nickname, channel),
+                    ])
+            elif command == 'QUIT':
+                break
+
+            if self._user and self.nickname and \
+                    not self.registered.is_set():
+                self.send(self.server.welcome(self.nickname))
+                self.registered.set()
+
+
+def _line(line):
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    if not line.endswith(b'\r\n'):
+        line += b'\r\n'
+    return line
+
+
+class FakeServer(object):
+    name = 'irc.localhost'
+
+    def __init__(self, host='127.0.0.1', port=0, record=False):
+        self.record = record
+        self.connections = list()
+        self._connected = gevent.event.Event()
+        self._server = gevent.server.StreamServer((host, port), self._handle)
+
+    @property
+    def address(self):
+        return self._server.address[:2]
+
+    def start(self):
+        self._server.start()
+
+    def stop(self):
+        self._server.stop()
+
+    def welcome(self, nick):
+        name = self.name
+        return [
+            ':{} 001 {} :Welcome to the awirc test network'.format(name, nick),
+            ':{} 005 {} CASEMAPPING=rfc1459 CHANTYPES=# PREFIX=(ov)@+ '
+            'CHANMODES=beI,k,l,imnst NICKLEN=30 :are supported by this '
+            'server'.format(name, nick),
+            ':{} 376 {} :End of /MOTD command.'.format(name, nick),
+        ]
+
+    def _handle(self, sock, address):
+        connection = FakeConnection(self, sock, address)
+        self.connections.append(connection)
+        self._connected.set()
+        try:
+            connection._serve()
+        except OSError:
+            pass
+        finally:
+            self.connections.remove(connection)
+            sock.close()
+
+    def wait_registered(self, timeout=10):
+        '''waits until a client is connected and registered'''
+        if not self._connected.wait(timeout):
+            raise gevent.Timeout(timeout)
+        for connection in list(self.connections):
+            connection.registered.wait(timeout)
+
+    def drop(self):
+        '''closes the connections of all clients'''
+        for connection in list(self.connections):
+            connection.socket.shutdown(2)
+
+    def send(self, data):
+        '''sends data (see FakeConnection.send) to all clients'''
+        for connection in list(self.connections):
+            connection.send(data)
+
+    def play(self, lines, rate=None, chunk=256):
+        '''sends lines (an iterable, it is consumed lazily) to all clients,
+        chunk lines per write, at most rate lines per second'''
+        start = time.monotonic()
+        sent = 0
+
+        batch = list()
+        for line in lines:
+            batch.append(_line(line))
+            if len(batch) < chunk:
+                continue
+            self.send(b''.join(batch))
+            sent += len(batch)
+            batch = list()
+
+            if rate:
+                ahead = sent / rate - (time.monotonic() - start)
+                if ahead > 0:
+                    gevent.sleep(ahead)
+            else:
+                gevent.sleep(0)
+
+        if batch:
+            self.send(b''.join(batch))
+            sent += len(batch)
+        return sent
+
+
+# scripted traffic, every generator yields lines (bytes without delimiter)
+def _nicks(count, prefix='user'):
+    return ['{}{}'.format(prefix, i) for i in range(count)]
+
+
+def privmsg_flood(count, channel='#bench', users=100, stamp=False):
+    '''count PRIVMSGs to channel from users different nicks, with stamp
+    the text is time.monotonic() at the time the line is generated'''
+    nicks = [n.encode('ascii') for n in _nicks(users)]
+    channel = channel.encode('utf-8')
+    text = b'the quick brown fox jumps over the lazy dog ' * 2
+    for i in range(count):
+        nick = nicks[i % users]
+        if stamp:
+            text = repr(time.monotonic()).encode('ascii')
+        yield b':' + nick + b'!' + nick + b'@host.example PRIVMSG ' + \
+            channel + b' :' + text
+
+
+def names_burst(users=10000, channel='#bench', nick='me', per_line=40):
+    '''JOIN of nick followed by a NAMES reply with users entries'''
+    yield ':{0}!u@localhost JOIN {1}'.format(nick, channel).encode('utf-8')
+    prefixes = ('', '', '', '+', '@')
+    nicks = _nicks(users)
+    for i in range(0, users, per_line):
+        names = ' '.join(
+            random.choice(prefixes) + n for n in nicks[i:i + per_line]
+        )
+        yield ':{} 353 {} = {} :{}'.format(
+            FakeServer.name, nick, channel, names
+        ).encode('utf-8')
+    yield ':{} 366 {} {} :End of /NAMES list.'.format(
+        FakeServer.name, nick, channel
+    ).encode('utf-8')
+
+
+def netsplit(users=10000, servers=('hub.example', 'leaf.example')):
+    '''a QUIT storm of users users'''
+    reason = '{} {}'.format(*servers).encode('ascii')
+    for nick in _nicks(users):
+        nick = nick.encode('ascii')
+        yield b':' + nick + b'!' + nick + b'@host.example QUIT :' + reason
+
+
+def ctcp_traffic(count, nick='me', users=100):
+    '''CTCP requests to nick, mixed with ACTIONs'''
+    nicks = [n.encode('ascii') for n in _nicks(users)]
+    requests = (b'\x01VERSION\x01', b'\x01PING 1234567890\x01',
+                b'\x01TIME\x01', b'\x01ACTION waves\x01 and \x01CLIENTINFO\x01')
+    nick = nick.encode('utf-8')
+    for i in range(count):
+        source = nicks[i % users]
+        yield b':' + source + b'!' + source + b'@host.example PRIVMSG ' + \
+            nick + b' :' + requests[i % len(requests)]
+
+
+SCENARIOS = ('privmsg', 'names', 'netsplit', 'ctcp')
+
+
+def scenario(name, count, nick='me'):
+    '''returns the traffic generator for a scenario by name,
+    a netsplit is preceded by a NAMES burst of the splitting users'''
+    if name == 'privmsg':
+        return privmsg_flood(count, stamp=True)
+    elif name == 'names':
+        return names_burst(count, nick=nick)
+    elif name == 'netsplit':
+        return itertools.chain(names_burst(count, nick=nick), netsplit(count))
+    elif name == 'ctcp':
+        return ctcp_traffic(count, nick=nick)
+    raise ValueError('unknown scenario {!r}'.format(name))
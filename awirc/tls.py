@@ -0,0 +1,66 @@
+'''shared TLS contexts.
+
+Building an SSLContext (loading the CA bundle) costs more than the
+handshake itself, clients with the same ssl_args share one context:
+
+    client.connect(ssl_args={'cert_reqs': ssl.CERT_REQUIRED})
+
+ssl_args takes the arguments of ssl.wrap_socket (keyfile, certfile,
+cert_reqs, ssl_version, ca_certs, ciphers) plus check_hostname and
+server_hostname, or a ready 'context'. Certificates are not verified
+unless cert_reqs is given, like ssl.wrap_socket did.
+'''
+import ssl
+
+
+# (context class, configuration) -> SSLContext
+_contexts = dict()
+# arguments which end up in the context, everything else is per socket
+_CONTEXT_ARGS = ('keyfile', 'certfile', 'cert_reqs', 'ssl_version',
+                 'ca_certs', 'ciphers', 'check_hostname')
+
+
+def context(ssl_args, cls=ssl.SSLContext):
+    '''returns the SSLContext for ssl_args, contexts are created once per
+    configuration and class (gevent.ssl.SSLContext for the gevent backend)'''
+    if ssl_args.get('context') is not None:
+        return ssl_args['context']
+
+    key = (cls, tuple(sorted(
+        (name, ssl_args[name]) for name in _CONTEXT_ARGS if name in ssl_args
+    )))
+    try:
+        return _contexts[key]
+    except KeyError:
+        pass
+
+    result = _contexts[key] = create_context(ssl_args, cls)
+    return result
+
+
+def create_context(ssl_args, cls=ssl.SSLContext):
+    '''builds a new SSLContext from ssl.wrap_socket style arguments'''
+    context = cls(ssl_args.get('ssl_version', ssl.PROTOCOL_TLS_CLIENT))
+
+    cert_reqs = ssl_args.get('cert_reqs', ssl.CERT_NONE)
+    if cert_reqs == ssl.CERT_NONE:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        context.verify_mode = cert_reqs
+        if ssl_args.get('ca_certs'):
+            context.load_verify_locations(ssl_args['ca_certs'])
+        else:
+            context.load_default_certs()
+        context.check_hostname = ssl_args.get('check_hostname', True)
+
+    if ssl_args.get('certfile'):
+        context.load_cert_chain(ssl_args['certfile'], ssl_args.get('keyfile'))
+    if ssl_args.get('ciphers'):
+        context.set_ciphers(ssl_args['ciphers'])
+    return context
+
+
+def clear():
+    '''drops the cached contexts, e.g. after certificates were renewed'''
+    _contexts.clear()
@@ -1,28 +1,117 @@
+from datetime import datetime, timezone
 from fnmatch import fnmatch
 from pprint import pformat
 import textwrap
+import re
 
-from awirc.protocol import Message
+import awirc.protocol
 
 
 # protocol helpers
+def decode(data):
+    '''decodes raw data (bytes, bytearray or memoryview) to a string,
+    falls back to iso-8859-1 if the data is not valid utf-8'''
+    try:
+        return str(data, 'utf-8')
+    except UnicodeDecodeError:
+        return str(data, 'iso-8859-1', errors='ignore')
+
+
+def parse_message(data):
+    '''parses a single line (bytes, bytearray or memoryview, without
+    the delimiter) into a Message, returns None for empty lines.
+
+    The line is low level dequoted and split in one pass, prefix and
+    arguments stay bytes until they are accessed on the message.'''
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    # stripped before dequoting, quoted whitespace is part of the message
+    data = data.strip()
+    if not data:
+        return None
+    if M_QUOTE_B in data:
+        data = low_dequote(data)
+
+    tags = None
+    start = 0
+    if data[0] == 0x40:  # '@', IRCv3 message tags
+        start = data.find(b' ')
+        if start == -1:
+            return None
+        tags = data[1:start]
+        while data[start] == 0x20:
+            start += 1
+
+    prefix = b''
+    if data[start] == 0x3a:  # ':'
+        end = data.find(b' ', start)
+        if end == -1:
+            prefix, start = data[start+1:], len(data)
+        else:
+            prefix, start = data[start+1:end], end
+
+    end = data.find(b' :', start)
+    if end == -1:
+        args = data[start:].split()
+    else:
+        args = data[start:end].split()
+        args.append(data[end+2:])
+
+    command = decode(args.pop(0)) if args else ''
+    return awirc.protocol.Message.from_raw(prefix, command, args, tags)
+
+
 def parse_line(s):
-    prefix = ''
-    trailing = []
+    '''parses an already decoded line into a Message'''
     if s:
-        if s[0] == ':':
-            prefix, s = s[1:].split(' ', 1)
-        if ' :' in s:
-            s, trailing = s.split(' :', 1)
-            args = s.split()
-            args.append(trailing)
-        else:
-            args = s.split()
+        return parse_message(s.encode('utf-8'))
+
+
+_TAG_UNESCAPE = {':': ';', 's': ' ', 'r': '\r', 'n': '\n'}
+_TAG_UNESCAPE_RE = re.compile(r'\\(.?)', re.DOTALL)
+_TAG_ESCAPE = {';': '\\:', ' ': '\\s', '\r': '\\r', '\n': '\\n', '\\': '\\\\'}
+_TAG_ESCAPE_RE = re.compile(r'[; \r\n\\]')
+
+
+def parse_tags(data):
+    '''parses IRCv3 message tags (without the leading @) into a dict,
+    tags without a value map to an empty string'''
+    if not isinstance(data, str):
+        data = decode(data)
+
+    tags = dict()
+    for tag in data.split(';'):
+        key, _, value = tag.partition('=')
+        if '\\' in value:
+            value = _TAG_UNESCAPE_RE.sub(
+                lambda m: _TAG_UNESCAPE.get(m.group(1), m.group(1)), value
+            )
+        if key:
+            tags[key] = value
+    return tags
+
+
+def make_tags(tags):
+    '''the reverse of parse_tags, returns the string without the @'''
+    return ';'.join(
+        key if value is None or value == '' else
+        '{}={}'.format(key, _TAG_ESCAPE_RE.sub(
+            lambda m: _TAG_ESCAPE[m.group(0)], str(value)
+        ))
+        for key, value in tags.items()
+    )
+
+
+def parse_server_time(value):
+    '''parses a server-time tag (2011-10-19T16:40:51.620Z) into an
+    aware datetime, returns None if the value is invalid'''
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ'):
         try:
-            command = args.pop(0)
-        except IndexError:
-            command = ''
-        return Message(prefix, command, args)
+            dt = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return dt.replace(tzinfo=timezone.utc)
+    return None
 
 
 def parse_005(args):
@@ -43,7 +132,8 @@ def parse_005(args):
                 v = tuple(map(get_type, v.split(',')))
             elif k in ('MODES', 'MAXCHANNELS', 'NICKLEN', 'MAXBANS',
                        'TOPICLEN', 'KICKLEN', 'CHANNELLEN', 'CHIDLEN',
-                       'SILENCE', 'AWAYLEN', 'WATCH'):
+                       'SILENCE', 'AWAYLEN', 'WATCH', 'USERLEN',
+                       'HOSTLEN'):
                 v = int(v)
             elif k in ('CHANLIMIT', 'MAXLIST', 'IDCHAN', 'TARGMAX'):
                 v = dict(map(lambda x: (x[0], get_type(x[1])),
@@ -75,21 +165,38 @@ M_QUOTE_TABLE = {
 M_DEQUOTE_TABLE = dict([(v, k) for k, v in M_QUOTE_TABLE.items()])
 
 
+# the same tables for raw (undecoded) lines
+M_QUOTE_B = M_QUOTE.encode('ascii')
+M_DEQUOTE_TABLE_B = dict(
+    (k.encode('ascii'), v.encode('ascii')) for k, v in M_DEQUOTE_TABLE.items()
+)
+
+_M_QUOTE_RE = re.compile('[{}]'.format(''.join(M_QUOTE_TABLE)))
+_M_QUOTE_TRANS = str.maketrans(M_QUOTE_TABLE)
+_M_DEQUOTE_RE = re.compile(re.escape(M_QUOTE) + '(.)', re.DOTALL)
+_M_DEQUOTE_RE_B = re.compile(re.escape(M_QUOTE_B) + b'(.)', re.DOTALL)
+
+
 def low_quote(s):
-    for c in M_QUOTE_TABLE:
-        s = s.replace(c, M_QUOTE_TABLE[c])
-    return s
+    '''quotes s, see awirc.wire.quote for bytes'''
+    if _M_QUOTE_RE.search(s) is None:
+        return s
+    return s.translate(_M_QUOTE_TRANS)
 
 
 def low_dequote(s):
-    s = iter(s)
-    d_s = ''
-    for c in s:
-        if c == M_QUOTE:
-            n = s.next()
-            c = M_DEQUOTE_TABLE.get(c+n, n)  # maybe raise an error
-        d_s += c
-    return d_s
+    '''reverses low_quote, works on str and bytes'''
+    if isinstance(s, str):
+        if M_QUOTE not in s:
+            return s
+        regex, table = _M_DEQUOTE_RE, M_DEQUOTE_TABLE
+    else:
+        if M_QUOTE_B not in s:
+            return s
+        regex, table = _M_DEQUOTE_RE_B, M_DEQUOTE_TABLE_B
+
+    # unknown escapes just drop the M_QUOTE
+    return regex.sub(lambda m: table.get(m.group(0), m.group(1)), s)
 
 STX = chr(1)  # ctcp marker
 X_DELIM = STX
@@ -104,21 +211,21 @@ X_QUOTE_TABLE = {
 X_DEQUOTE_TABLE = dict([(v, k) for k, v in X_QUOTE_TABLE.items()])
 
 
+_X_QUOTE_TRANS = str.maketrans(X_QUOTE_TABLE)
+_X_DEQUOTE_RE = re.compile(re.escape(X_QUOTE) + '(.)', re.DOTALL)
+
+
 def ctcp_quote(s):
-    for c in (X_QUOTE, X_DELIM):
-        s = s.replace(c, X_QUOTE_TABLE[c])
-    return s
+    return s.translate(_X_QUOTE_TRANS)
 
 
 def ctcp_dequote(s):
-    s = iter(s)
-    d_s = ''
-    for c in s:
-        if c == X_QUOTE:
-            n = s.next()
-            c = X_DEQUOTE_TABLE.get(c+n, n)  # maybe raise an error
-        d_s += c
-    return d_s
+    '''reverses ctcp_quote, unknown escapes just drop the X_QUOTE'''
+    if X_QUOTE not in s:
+        return s
+    return _X_DEQUOTE_RE.sub(
+        lambda m: X_DEQUOTE_TABLE.get(m.group(0), m.group(1)), s
+    )
 
 
 def extract_ctcp(s):
@@ -157,6 +264,31 @@ def make_ctcp_string(messages):
     return ''.join(msg_buf)
 
 
+# casemapping, see the CASEMAPPING ISUPPORT token
+_UPPER = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_LOWER = 'abcdefghijklmnopqrstuvwxyz'
+
+CASEMAPPINGS = {
+    'ascii': str.maketrans(_UPPER, _LOWER),
+    'rfc1459': str.maketrans(_UPPER + '[]\\~', _LOWER + '{}|^'),
+    'strict-rfc1459': str.maketrans(_UPPER + '[]\\', _LOWER + '{}|'),
+}
+
+
+def casemapper(casemapping='rfc1459'):
+    '''returns a function which lowers a nick or channel name according
+    to casemapping, unknown casemappings fall back to rfc1459'''
+    if casemapping == 'rfc7613':
+        return str.casefold
+    table = CASEMAPPINGS.get(casemapping, CASEMAPPINGS['rfc1459'])
+    return lambda s: s.translate(table)
+
+
+def irc_lower(s, casemapping='rfc1459'):
+    'lowers s according to casemapping'
+    return casemapper(casemapping)(s)
+
+
 # other helpers
 def is_channel(target, channel_prefixes='!&#+'):
     'returns True if the target is a channel'
@@ -192,6 +324,93 @@ def ssplit(str_, length=420):
     return buf
 
 
+# bytes low quoting doubles, LF never occurs in split lines
+_QUOTED = b'\x00\r\x10'
+
+
+def _quoted_limit(data, start, end, max_bytes):
+    '''returns the end of the longest part of data from start which is at
+    most max_bytes long once low quoted'''
+    limit = min(end, start + max_bytes)
+    while True:
+        part = data[start:limit]
+        excess = 2 * len(part) - len(part.translate(None, _QUOTED)) - \
+            max_bytes
+        if excess <= 0:
+            return limit
+        # every byte less saves at least one quoted byte
+        limit -= excess
+
+
+def split_bytes(text, max_bytes, decode=True, quoted=False):
+    '''splits text into lines which encoded as UTF-8 are at most max_bytes
+    long, at whitespace if possible and never inside a character. Lines
+    of text are split on their own, empty lines are skipped. With decode
+    False the lines are returned encoded, with quoted max_bytes limits the
+    low quoted length (NUL, CR and M_QUOTE take two bytes).'''
+    if max_bytes < 1:
+        # no line could make progress
+        raise ValueError('max_bytes has to be positive, not {}'.format(
+            max_bytes
+        ))
+    result = list()
+    for line in text.split('\n'):
+        data = line.rstrip('\r').encode('utf-8')
+        start = 0
+        end = len(data)
+        # nothing to quote, every byte counts once
+        weighted = quoted and len(data.translate(None, _QUOTED)) != end
+        while start < end:
+            if weighted:
+                limit = _quoted_limit(data, start, end, max_bytes)
+            else:
+                limit = start + max_bytes
+            if limit >= end:
+                cut = resume = end
+            else:
+                cut = data.rfind(b' ', start, limit + 1)
+                if cut > start:
+                    resume = cut + 1
+                else:
+                    cut = limit
+                    # back to the first byte of the character
+                    while cut > start and data[cut] & 0xC0 == 0x80:
+                        cut -= 1
+                    if cut == start:
+                        # max_bytes is smaller than the character
+                        cut += 1
+                        while cut < end and data[cut] & 0xC0 == 0x80:
+                            cut += 1
+                    resume = cut
+
+            chunk = data[start:cut].strip(b' ')
+            if chunk:
+                result.append(chunk.decode('utf-8') if decode else chunk)
+            start = resume
+    return result
+
+
+def group_targets(targets, max_targets=None, max_length=400, size=None):
+    '''splits targets into lists of at most max_targets targets which
+    joined by commas are at most max_length long (size returns the length
+    a target adds, including the comma)'''
+    if size is None:
+        size = lambda target: len(target) + 1
+    group = list()
+    length = 0
+    for target in targets:
+        n = size(target)
+        if group and (length + n > max_length or
+                      (max_targets and len(group) >= max_targets)):
+            yield group
+            group = list()
+            length = 0
+        group.append(target)
+        length += n
+    if group:
+        yield group
+
+
 def fnmatch_m_s(iterable, name):
     for s in iterable:
         if fnmatch(name, s):
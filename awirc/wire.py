@@ -0,0 +1,136 @@
+'''building outgoing lines as bytes.
+
+Connection.send serializes a str line with encode: it is encoded, low
+quoted only if it contains NUL, CR, LF or M_QUOTE, and the trailing
+argument of a line longer than the line length is cut (e.g. a long topic
+or quit message). Protocol builds its text messages with a
+Serializer, the encoded "COMMAND target :" of repeated commands and
+targets is cached:
+
+    client.send(client.wire.text('PRIVMSG', '#chan', 'hello'))
+
+Bytes ending with the delimiter are serialized lines, send passes them on
+as they are.
+'''
+import re
+
+
+DELIMITER = b'\r\n'
+# longest line (including the delimiter, excluding IRCv3 tags) a server
+# accepts
+MAX_LINE_LENGTH = 512
+
+# awirc.utils.M_QUOTE_TABLE for bytes
+_QUOTED = b'\x00\n\r\x10'
+_QUOTE_RE = re.compile(b'[' + _QUOTED + b']')
+_QUOTE_TABLE = {
+    b'\x00': b'\x100',
+    b'\n': b'\x10n',
+    b'\r': b'\x10r',
+    b'\x10': b'\x10\x10',
+}
+
+
+def quote(data):
+    '''low quotes bytes, returns data itself if nothing has to be quoted'''
+    # deleting is faster than searching with a regex
+    if len(data.translate(None, _QUOTED)) == len(data):
+        return data
+    return _QUOTE_RE.sub(lambda m: _QUOTE_TABLE[m.group(0)], data)
+
+
+def check(line, max_length=MAX_LINE_LENGTH):
+    '''raises ValueError if line (bytes) exceeds max_length, tags (their
+    limit is separate) are not counted'''
+    if max_length is None or len(line) <= max_length:
+        return
+    length = len(line)
+    if line.startswith(b'@'):
+        length -= line.find(b' ') + 1
+    if length > max_length:
+        raise ValueError('line is {} bytes long, the limit is {}: {!r}'.format(
+            length, max_length, line[:32] + b'...'
+        ))
+
+
+def truncate(line, max_length=MAX_LINE_LENGTH, delimiter=DELIMITER):
+    '''cuts the trailing argument of line (quoted bytes ending with
+    delimiter) to fit max_length, never inside a character or a quoted
+    byte. Raises ValueError if the line doesn't fit without it.'''
+    start = 0
+    if line.startswith(b'@'):
+        start = line.find(b' ') + 1
+    excess = len(line) - start - max_length
+    if max_length is None or excess <= 0:
+        return line
+
+    body = line[:-len(delimiter)]
+    # prefixes contain no spaces, the first " :" starts the trailing
+    separator = body.find(b' :', start)
+    cut = len(body) - excess
+    if separator < 0 or cut < separator + 2:
+        # raises, the line is too long
+        check(line, max_length)
+    # back to the first byte of the character
+    while cut > separator + 2 and body[cut] & 0xC0 == 0x80:
+        cut -= 1
+    # an odd number of M_QUOTE before the cut quote the byte after it
+    quotes = len(body[separator + 2:cut]) - \
+        len(body[separator + 2:cut].rstrip(b'\x10'))
+    cut -= quotes % 2
+    return body[:cut] + delimiter
+
+
+def encode(line, max_length=MAX_LINE_LENGTH, delimiter=DELIMITER):
+    '''returns the wire bytes of line (str or bytes, without delimiter),
+    see truncate'''
+    if isinstance(line, str):
+        line = line.encode('utf-8')
+    line = quote(line) + delimiter
+    if max_length is not None and len(line) > max_length:
+        line = truncate(line, max_length, delimiter)
+    return line
+
+
+class Serializer(object):
+    # upper bound of cached prefixes, targets are chosen by other users
+    # (e.g. replies to private messages)
+    max_cache = 1024
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH, delimiter=DELIMITER):
+        self.max_line_length = max_line_length
+        self.delimiter = delimiter
+        # (command, target) -> b'COMMAND target :'
+        self._prefixes = dict()
+
+    def prefix(self, command, target):
+        '''returns the encoded "COMMAND target :"'''
+        try:
+            return self._prefixes[(command, target)]
+        except KeyError:
+            pass
+
+        if len(self._prefixes) >= self.max_cache:
+            self._prefixes.clear()
+        prefix = self._prefixes[(command, target)] = quote(
+            '{} {} :'.format(command, target).encode('utf-8')
+        )
+        return prefix
+
+    def text(self, command, target, text):
+        '''returns the wire bytes of COMMAND target :text, text is a str
+        or already encoded. Text which doesn't fit is cut (see truncate),
+        Protocol splits it before.'''
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        line = self.prefix(command, target) + quote(text) + self.delimiter
+        if self.max_line_length and len(line) > self.max_line_length:
+            line = truncate(line, self.max_line_length, self.delimiter)
+        return line
+
+    def line(self, line):
+        '''returns the wire bytes of a complete line (str or bytes)'''
+        return encode(line, self.max_line_length, self.delimiter)
+
+    def clear(self):
+        self._prefixes.clear()
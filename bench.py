@@ -0,0 +1,205 @@
+'''offline benchmark of awirc.Client against awirc.testing.FakeServer.
+
+    python bench.py                       # all scenarios
+    python bench.py privmsg ctcp -n 200000 --rate 100000 --spawn --json
+
+Reports lines/sec and latency percentiles of the stages: parse
+(client.parse_message), dispatch (process_event, including inline
+handlers), handler and, for the privmsg scenario, e2e (server write to
+handler). Also the peak memory, the number of live greenlets and the
+peak number of greenlets in the client's pool.
+'''
+import argparse
+import json
+import time
+import gc
+
+import gevent.event
+import greenlet
+import gevent
+
+import awirc.testing
+import awirc.state
+import awirc.utils
+import awirc
+
+
+END = 'BENCH_END'
+
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    n = len(samples)
+
+    def at(p):
+        return samples[min(int(n * p), n - 1)] * 1e6
+
+    return {
+        'count': n,
+        'p50_us': round(at(0.5), 2),
+        'p90_us': round(at(0.9), 2),
+        'p99_us': round(at(0.99), 2),
+        'max_us': round(samples[-1] * 1e6, 2),
+    }
+
+
+def timed(func, samples):
+    clock = time.perf_counter
+
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            samples.append(clock() - start)
+    return wrapper
+
+
+def greenlet_count():
+    return sum(1 for o in gc.get_objects() if isinstance(o, greenlet.greenlet))
+
+
+def max_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(name, count, rate=None, spawn=False, state=False, tracemalloc=False):
+    samples = dict((stage, list()) for stage in
+                   ('parse', 'dispatch', 'handler', 'e2e'))
+
+    server = awirc.testing.FakeServer()
+    server.start()
+
+    client = awirc.Client('bench', *server.address, inline=not spawn,
+                          caps=())
+    if state:
+        awirc.state.StateTracker(client)
+
+    done = gevent.event.Event()
+    clock = time.perf_counter
+
+    def handler(event_type, source, target, args):
+        start = clock()
+        if event_type == 'PUBMSG':
+            try:
+                samples['e2e'].append(time.monotonic() - float(args))
+            except ValueError:
+                pass
+        elif event_type == 'PRIVNOTICE' and args == END:
+            done.set()
+        samples['handler'].append(clock() - start)
+
+    # not '*', that would also dispatch RAW_MESSAGE for every line
+    for event_type in ('PUBMSG', 'PRIVNOTICE', 'JOIN', 'QUIT', '353',
+                       'CTCP_*'):
+        client.bind(event_type, handler, spawn=spawn)
+    client.connect()
+    server.wait_registered()
+    gevent.sleep(0.1)
+
+    client.parse_message = timed(client.parse_message, samples['parse'])
+    client.process_event = timed(client.process_event, samples['dispatch'])
+
+    if tracemalloc:
+        import tracemalloc as tm
+        tm.start()
+
+    # peak of concurrently running handler greenlets
+    pool_peak = [0]
+
+    def sample_pool():
+        while True:
+            pool_peak[0] = max(pool_peak[0], len(client.gevent_pool))
+            gevent.sleep(0.005)
+    sampler = gevent.spawn(sample_pool)
+
+    lines_in = client.lines_in
+    start = time.perf_counter()
+    try:
+        sent = server.play(
+            awirc.testing.scenario(name, count, nick=client.nickname),
+            rate=rate
+        )
+        server.send(':{} NOTICE {} :{}'.format(
+            server.name, client.nickname, END
+        ))
+        if not done.wait(timeout=max(60, count / 1000)):
+            raise RuntimeError('{}: timed out'.format(name))
+        elapsed = time.perf_counter() - start
+    finally:
+        sampler.kill()
+
+    result = {
+        'scenario': name,
+        'lines': client.lines_in - lines_in,
+        'sent': sent,
+        'seconds': round(elapsed, 4),
+        'lines_per_sec': round((client.lines_in - lines_in) / elapsed),
+        'greenlets': greenlet_count(),
+        'pool_peak': pool_peak[0],
+        'max_rss_kb': max_rss_kb(),
+    }
+    if tracemalloc:
+        result['traced_peak_kb'] = tm.get_traced_memory()[1] // 1024
+        tm.stop()
+    for stage, values in samples.items():
+        result[stage] = percentiles(values)
+
+    client.disconnect()
+    server.stop()
+    return result
+
+
+def report(result):
+    print('{scenario}: {lines} lines in {seconds}s, {lines_per_sec} lines/s, '
+          '{greenlets} greenlets ({pool_peak} peak in the pool), '
+          'max rss {max_rss_kb} kB'.format(**result))
+    for stage in ('parse', 'dispatch', 'handler', 'e2e'):
+        p = result[stage]
+        if p is None:
+            continue
+        print('  {:<9} p50 {:>9} us  p90 {:>9} us  p99 {:>9} us  '
+              'max {:>10} us'.format(stage, p['p50_us'], p['p90_us'],
+                                     p['p99_us'], p['max_us']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', help='{} (default: all)'
+                        .format(', '.join(awirc.testing.SCENARIOS)))
+    parser.add_argument('-n', '--count', type=int, default=100000,
+                        help='messages (or users) per scenario')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='lines per second sent by the server')
+    parser.add_argument('--spawn', action='store_true',
+                        help='spawn handlers instead of running them inline')
+    parser.add_argument('--state', action='store_true',
+                        help='track channel state')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='trace the peak memory (slow)')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in awirc.testing.SCENARIOS:
+            parser.error('unknown scenario {!r}'.format(name))
+
+    results = list()
+    for name in args.scenarios or awirc.testing.SCENARIOS:
+        result = run(name, args.count, rate=args.rate, spawn=args.spawn,
+                     state=args.state, tracemalloc=args.tracemalloc)
+        results.append(result)
+        if not args.json:
+            report(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,9 +3,6 @@ import awirc
 import random
 
 def debug_message(type, source, target, args):
-    if type == 'RAW_MESSAGE':
-        return
-
     print(type, '\t', source, target, args)
 
 
@@ -14,7 +11,7 @@ def main():
         'awircbot{}'.format(random.randint(0, 9999)),
         'chat.freenode.net', port=6667
     )
-    c.bind('*', debug_message)
+    c.bind('*', debug_message, exclude='RAW_MESSAGE')
     c.connect()
 
     c.gevent_pool.join()
@@ -0,0 +1,181 @@
+import awirc
+import awirc.event
+import awirc.manager
+import awirc.query
+import awirc.scheduler
+import awirc.state
+
+
+def offline_client(nick='me'):
+    client = awirc.Client(nick, 'irc.example.net', 6667, inline=True,
+                          scheduler=awirc.scheduler.Scheduler())
+    awirc.state.StateTracker(client)
+    return client
+
+
+def feed(client, *lines):
+    for line in lines:
+        client.line_received(line)
+
+
+def queued(client):
+    lines = list()
+    while len(client.scheduler):
+        message, _ = client.scheduler.pop()
+        lines.append(message)
+    return lines
+
+
+def test_stats_command():
+    # stats is the STATS command, the connection counters are traffic_stats
+    client = offline_client()
+    client.stats('u')
+    assert queued(client)[0].startswith(b'STATS u')
+    stats = client.traffic_stats()
+    assert stats['connected'] is False and 'scheduler' in stats
+
+
+def test_state():
+    client = offline_client()
+    feed(client,
+         ':srv 001 me :welcome',
+         ':srv 005 me CASEMAPPING=rfc1459 PREFIX=(ov)@+ :are supported',
+         ':me!u@h JOIN #Chan',
+         ':srv 353 me = #chan :me @Op +voice',
+         ':Ni[ck]!u@h JOIN #chan',
+         ':op!o@h MODE #chan +k secret',
+         ':op!o@h MODE #chan +v ni{ck}',
+         ':srv 332 me #chan :the topic')
+    state = client.state
+    channel = state.channel('#CHAN')
+    assert channel.modes == {'k': 'secret'}
+    assert channel.topic == 'the topic'
+    assert state.members('#chan') == \
+        {'me': '', 'Op': 'o', 'voice': 'v', 'Ni[ck]': 'v'}
+    assert state.channels_of('NI{CK}') == ['#Chan']
+    assert '#chan' in client.joined
+
+    feed(client, ':ni[ck]!u@h NICK other', ':op!o@h KICK #chan other :bye')
+    assert state.user('other') is None and state.user('ni[ck]') is None
+    feed(client, ':me!u@h PART #chan')
+    assert state.channel('#chan') is None and not client.joined
+
+
+def test_keyed_rejoin():
+    client = offline_client()
+    feed(client,
+         ':srv 001 me :welcome',
+         ':me!u@h JOIN #Keyed',
+         ':me!u@h JOIN #open',
+         ':op!o@h MODE #keyed +k secret')
+    queued(client)
+
+    client.handle_disconnect()
+    client.handle_reconnect(1, 0)
+    feed(client, ':srv 001 me :welcome', ':srv 376 me :end of motd')
+    assert queued(client) == [b'JOIN #Keyed,#open secret\r\n']
+
+    # the keys were used once
+    client.rejoin(['#Keyed'])
+    assert queued(client) == [b'JOIN #Keyed\r\n']
+
+
+def test_query():
+    client = offline_client()
+    queries = awirc.query.QueryManager(client)
+    who = queries.who('#a', timeout=0)
+    mode = queries.mode('#b', timeout=0)
+    assert queued(client) == [b'WHO #a\r\n', b'MODE #b\r\n']
+
+    feed(client, ':srv 403 me #b :No such channel')
+    assert mode.failed and not who.done()
+    feed(client, ':srv 352 me #a u h srv nick H :0 real',
+         ':srv 315 me #a :End of WHO')
+    assert who.get()[0]['nick'] == 'nick' and not who.failed
+
+    whois = queries.whois('nick', timeout=0)
+    feed(client, ':srv 401 me nick :No such nick',
+         ':srv 318 me nick :End of WHOIS')
+    assert whois.failed
+    try:
+        whois.get()
+    except awirc.query.QueryError:
+        pass
+    else:
+        assert False
+    # failed queries are not cached
+    assert queries.whois('nick', timeout=0) is not whois
+
+
+def test_event_filter():
+    hits = list()
+    events = awirc.event.EventManager(None, inline=True)
+    events.bind('PUBMSG', lambda *a: hits.append('target'), target='#a[b]')
+    events.bind('PUBMSG', lambda *a: hits.append('source'),
+                source='Ni[ck]!*@*')
+    events.bind('*', lambda *a: hits.append('all'), exclude='PUB*')
+    events.bind('PUBMSG', lambda *a: hits.append('predicate'),
+                predicate=lambda event_type, source, target, text:
+                text == 'x')
+
+    events.process_event('PUBMSG', 'ni{ck}!u@h', '#A{B}', 'x')
+    assert hits == ['target', 'source', 'predicate'], hits
+    del hits[:]
+    events.process_event('PRIVMSG', 'other!u@h', 'me', 'x')
+    assert hits == ['all'], hits
+
+    del hits[:]
+    events.set_casemapping('ascii')
+    events.process_event('PUBMSG', 'ni{ck}!u@h', '#A{B}', 'y')
+    assert hits == [], hits
+    events.process_event('PUBMSG', 'NI[CK]!u@h', '#A[B]', 'y')
+    assert hits == ['target', 'source'], hits
+
+
+def test_manager_bindings():
+    hits = list()
+
+    def handler(client, event_type, source, target, args):
+        hits.append(target)
+
+    manager = awirc.manager.ClientManager()
+    client = offline_client()
+    manager.add('a', client)
+    # the same handler with different filters
+    manager.bind('PUBMSG', handler, target='#a', spawn=False)
+    manager.bind('PUBMSG', handler, target='#b', spawn=False)
+    client.process_event('PUBMSG', 'n!u@h', '#a', 'x')
+    client.process_event('PUBMSG', 'n!u@h', '#b', 'x')
+    assert hits == ['#a', '#b'], hits
+
+    manager.unbind('PUBMSG', handler)
+    client.process_event('PUBMSG', 'n!u@h', '#a', 'x')
+    assert hits == ['#a', '#b'], hits
+
+    manager.bind('PUBMSG', handler, spawn=False)
+    manager.bind('PUBMSG', handler, target='#a', spawn=False)
+    assert manager.remove('a') is client
+    client.process_event('PUBMSG', 'n!u@h', '#a', 'x')
+    assert hits == ['#a', '#b'], hits
+
+
+def test_create_client():
+    client = awirc.create_client('me', 'irc.example.net', 6667)
+    assert isinstance(client, awirc.Client)
+    try:
+        awirc.create_client('me', 'irc.example.net', 6667, backend='x')
+    except ValueError:
+        pass
+    else:
+        assert False
+
+
+def main():
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'ok')
+
+
+if __name__ == '__main__':
+    main()
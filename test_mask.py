@@ -0,0 +1,100 @@
+import fnmatch
+
+import awirc.mask
+import awirc.utils
+
+
+MASKS = [
+    'nick!*@*', '*!*@host.example', '*!*@*.example', '*!*@.example',
+    '*!ident@*', '*!*@10.0.*', 'troll*!*@*', 'a*!*@*', '*!*foo*@*',
+    '*oo*!*@*', '*!*@*bar*', '*!*@*', '?!*@*', '*[x]*!*@*',
+]
+PREFIXES = [
+    'nick!user@host', 'NICK!user@host', 'x!u@host.example',
+    'x!u@a.b.example', 'x!u@.example', 'x!IDENT@h', 'x!u@10.0.0.1',
+    'trollface!u@h', 'abc!u@h', 'x!xfoofoo@h', 'moon!u@h',
+    'x!u@foobarbaz', 'a!u@h', 'x[x]!u@h', 'x{x}!u@h', 'x!u@example',
+]
+
+
+def brute_force(masks, prefix):
+    lower = awirc.utils.casemapper('rfc1459')
+    return [mask for mask in masks
+            if fnmatch.fnmatchcase(lower(prefix),
+                                   lower(mask).replace('[', '[[]'))]
+
+
+def test_normalize():
+    assert awirc.mask.normalize('nick') == 'nick!*@*'
+    assert awirc.mask.normalize('user@host') == '*!user@host'
+    assert awirc.mask.normalize('nick!user') == 'nick!user@*'
+    assert awirc.mask.normalize('host.example') == '*!*@host.example'
+
+
+def test_matches():
+    masks = awirc.mask.MaskSet(MASKS)
+    for prefix in PREFIXES:
+        expected = brute_force(MASKS, prefix)
+        assert sorted(masks.matches(prefix)) == sorted(expected), prefix
+        if expected:
+            assert masks.match(prefix) in expected, prefix
+        else:
+            assert masks.match(prefix) is None, prefix
+
+
+def test_no_duplicates():
+    masks = awirc.mask.MaskSet(MASKS)
+    for prefix in PREFIXES + ['x!foo@.example', 'foofoo!foo@foo.foo']:
+        matches = masks.matches(prefix)
+        assert len(matches) == len(set(matches)), (prefix, matches)
+
+
+def test_many_masks():
+    # more masks than fit into one combined regex or n-gram
+    masks = ['*!*foo{}*@*'.format(i) for i in range(200)]
+    masks += ['*!*{}*@*'.format(c) for c in 'abcdefghij' * 10]
+    masks += ['*{}?!*@*'.format(i) for i in range(100)]
+    mask_set = awirc.mask.MaskSet(masks)
+    for prefix in ('x!xfoo150y@h', 'x!u@h', 'x!jjj@h', 'x42y!u@h'):
+        expected = set(brute_force(mask_set, prefix))
+        assert set(mask_set.matches(prefix)) == expected, prefix
+    assert mask_set.match('x!u@h') is None
+
+
+def test_values():
+    masks = awirc.mask.MaskSet({'*!*@*.example': 1, 'Nick': 2})
+    assert masks.get('x!u@h.example') == 1
+    assert masks.get('nICK!u@h') == 2
+    assert masks.get('x!u@h', 0) == 0
+    assert 'nick' in masks and len(masks) == 2
+
+    masks.remove('NICK')
+    masks.discard('nick')
+    assert masks.get('nick!u@h') is None
+    assert list(masks) == ['*!*@*.example']
+
+
+def test_casemapping():
+    masks = awirc.mask.MaskSet(['Ni[ck]!*@*', '*!*b[a]r*@*'])
+    assert masks.match('ni{ck}!u@h') == 'Ni[ck]!*@*'
+    assert masks.match('x!B{A}R@h') == '*!*b[a]r*@*'
+
+    masks.set_casemapping('ascii')
+    assert masks.match('ni{ck}!u@h') is None
+    assert masks.match('NI[CK]!u@h') == 'Ni[ck]!*@*'
+    assert masks.match('x!B{A}R@h') is None
+
+    masks = awirc.mask.MaskSet(['Ni[ck]!*@*'],
+                               isupport={'CASEMAPPING': 'ascii'})
+    assert masks.match('ni{ck}!u@h') is None
+
+
+def main():
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'ok')
+
+
+if __name__ == '__main__':
+    main()
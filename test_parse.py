@@ -0,0 +1,141 @@
+import awirc.utils
+
+
+# the parser before the bytes parser: the line was decoded as a whole,
+# low level dequoted and split as str
+def decode_line(data):
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return data.decode('iso-8859-1', errors='ignore')
+
+
+def low_dequote_line(s):
+    result = ''
+    s = iter(s)
+    for c in s:
+        if c == awirc.utils.M_QUOTE:
+            n = next(s)
+            c = awirc.utils.M_DEQUOTE_TABLE.get(c + n, n)
+        result += c
+    return result
+
+
+def parse_line(s):
+    prefix = ''
+    if s[0] == ':':
+        prefix, s = s[1:].split(' ', 1)
+    if ' :' in s:
+        s, trailing = s.split(' :', 1)
+        args = s.split()
+        args.append(trailing)
+    else:
+        args = s.split()
+    command = args.pop(0) if args else ''
+    return prefix, command.upper(), args
+
+
+def old_parse(data):
+    return parse_line(low_dequote_line(decode_line(data).rstrip()))
+
+
+def new_parse(data):
+    msg = awirc.utils.parse_message(data)
+    return msg.prefix.raw, msg.command, msg.args
+
+
+M = awirc.utils.M_QUOTE_B
+
+CORPUS = [
+    # prefix, command, arguments, trailing
+    b':nick!user@host PRIVMSG #chan :hello world',
+    b':irc.example.net 001 bot :Welcome to the network bot',
+    b':irc.example.net 005 bot CHANTYPES=# PREFIX=(ov)@+ :are supported',
+    b':nick!user@host MODE #chan +o other',
+    b':nick!user@host JOIN #chan',
+    b':nick!user@host QUIT :',
+    # missing prefix
+    b'PING :irc.example.net',
+    b'PING irc.example.net',
+    b'ERROR :Closing link',
+    b'NOTICE AUTH :*** Looking up your hostname',
+    # trailing and empty arguments
+    b':nick!u@h PRIVMSG #chan ::-)',
+    b':nick!u@h PRIVMSG #chan :  leading and trailing spaces  ',
+    b':nick!u@h PRIVMSG #chan :a :b :c',
+    b':nick!u@h TOPIC #chan :',
+    b':srv 353 bot = #chan :@op +voice plain',
+    b':srv 324 bot #chan +ntk key',
+    b'CMD   a   b   :spaced   out',
+    # CTCP
+    b':nick!u@h PRIVMSG bot :\x01VERSION\x01',
+    b':nick!u@h PRIVMSG #chan :\x01ACTION waves\x01',
+    # M_QUOTE sequences
+    b':nick!u@h PRIVMSG #chan :a' + M + b'nb',
+    b':nick!u@h PRIVMSG #chan :cr' + M + b'r lf' + M + b'n nul' + M + b'0',
+    b':nick!u@h PRIVMSG #chan :quote ' + M + M + b' itself',
+    b':nick!u@h PRIVMSG #chan :unknown ' + M + b'x escape',
+    b':nick!u@h PRIVMSG #chan :' + M + M + M + b'n',
+    # utf-8 and the iso-8859-1 fallback
+    ':n\xe4ck!u@h PRIVMSG #ch\xe4n :gr\xfc\xdfe ☃'.encode('utf-8'),
+    b':nick!u@h PRIVMSG #chan :caf\xe9',
+    b':nick!u@h PRIVMSG #chan :\xff\xfe broken \xc3',
+    b':n\xe9ck!u@h NICK :other',
+]
+
+TAGGED = [
+    (b'@time=2020-01-01T00:00:00.000Z :nick!u@h PRIVMSG #chan :hi',
+     {'time': '2020-01-01T00:00:00.000Z'}),
+    (b'@a=1;b;c=x\\sy\\:z PING :srv',
+     {'a': '1', 'b': '', 'c': 'x y;z'}),
+    (b'@+draft/reply=abc;batch=ref  :nick!u@h PRIVMSG #chan :in a batch',
+     {'+draft/reply': 'abc', 'batch': 'ref'}),
+]
+
+
+def test_corpus():
+    for line in CORPUS:
+        assert new_parse(line) == old_parse(line), line
+
+
+def test_tags():
+    for line, tags in TAGGED:
+        msg = awirc.utils.parse_message(line)
+        assert msg.tags == tags, line
+        untagged = line.split(b' ', 1)[1].lstrip(b' ')
+        assert new_parse(line) == old_parse(untagged), line
+
+
+def test_per_argument_decoding():
+    # the old parser decoded the whole line as iso-8859-1, arguments are
+    # decoded on their own now
+    msg = awirc.utils.parse_message(
+        b':nick!u@h PRIVMSG #chan :caf\xe9 ' + '☃'.encode('utf-8')
+    )
+    assert msg.args == ['#chan', 'caf\xe9 \xe2\x98\x83']
+    msg = awirc.utils.parse_message(
+        b':nick!u@h KICK #caf\xe9 ' + '☃'.encode('utf-8') + b' :x'
+    )
+    assert msg.args == ['#caf\xe9', '☃', 'x']
+
+
+def test_empty():
+    for line in (b'', b'   ', b'\r\n'):
+        assert awirc.utils.parse_message(line) is None, line
+
+
+def test_buffers():
+    line = CORPUS[0]
+    for data in (bytearray(line), memoryview(line)):
+        assert new_parse(data) == new_parse(line)
+
+
+def main():
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import awirc.scheduler
+
+
+HIGH = awirc.scheduler.PRIORITY_HIGH
+NORMAL = awirc.scheduler.PRIORITY_NORMAL
+LOW = awirc.scheduler.PRIORITY_LOW
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def drain(scheduler):
+    messages = list()
+    while True:
+        message, _ = scheduler.pop()
+        if message is None:
+            return messages
+        messages.append(message)
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = awirc.scheduler.TokenBucket(burst=2, rate=0.5, clock=clock)
+    assert bucket.delay(b'a') == 0
+    bucket.consume(b'a')
+    bucket.consume(b'b')
+    assert bucket.delay(b'c') == 2
+    clock.now = 1
+    assert bucket.delay(b'c') == 1
+    clock.now = 10
+    # refills up to burst
+    assert bucket.delay(b'c') == 0 and bucket.tokens == 2
+
+
+def test_token_bucket_penalty():
+    clock = Clock()
+    bucket = awirc.scheduler.TokenBucket(burst=3, rate=1, penalty_bytes=10,
+                                         clock=clock)
+    assert bucket.cost(b'x' * 25) == 3
+    bucket.consume(b'x' * 25)
+    assert bucket.delay(b'x') == 1
+    # a message never costs more than a full bucket
+    clock.now = 100
+    assert bucket.delay(b'x' * 1000) == 0
+
+
+def test_lanes():
+    scheduler = awirc.scheduler.Scheduler()
+    scheduler.put(b'low', LOW)
+    scheduler.put(b'normal', NORMAL)
+    scheduler.put(b'high', HIGH)
+    scheduler.put(b'first', NORMAL, first=True)
+    assert drain(scheduler) == [b'high', b'first', b'normal', b'low']
+    assert scheduler.pop() == (None, None)
+
+
+def test_round_robin():
+    scheduler = awirc.scheduler.Scheduler()
+    for i in range(3):
+        scheduler.put(b'a', target='#a')
+    scheduler.put(b'b', target='#b')
+    scheduler.put(b'c', target='#c')
+    assert drain(scheduler) == [b'a', b'b', b'c', b'a', b'a']
+
+
+def test_max_priority():
+    scheduler = awirc.scheduler.Scheduler()
+    scheduler.put(b'normal')
+    assert scheduler.pop(max_priority=HIGH) == (None, None)
+    scheduler.put(b'high', HIGH)
+    assert scheduler.pop(max_priority=HIGH) == (b'high', 0)
+    assert scheduler.pop(max_size=3) == (None, 0)
+    assert len(scheduler) == 1
+
+
+def test_flood_control():
+    clock = Clock()
+    bucket = awirc.scheduler.TokenBucket(burst=2, rate=1, clock=clock)
+    scheduler = awirc.scheduler.Scheduler(bucket, clock=clock)
+    for i in range(4):
+        scheduler.put(b'm')
+    assert drain(scheduler) == [b'm', b'm']
+    assert scheduler.pop() == (None, 1)
+
+    # the high lane is never held back, but charged
+    scheduler.put(b'pong', HIGH)
+    assert scheduler.pop() == (b'pong', 0)
+    assert scheduler.pop() == (None, 2)
+
+    clock.now = 2
+    assert scheduler.pop() == (b'm', 0)
+    stats = scheduler.stats()
+    assert stats['queued'] == 1 and stats['sent'] == 4
+    assert stats['wait_max'] == 2
+
+
+def test_drop():
+    scheduler = awirc.scheduler.Scheduler()
+    scheduler.put(b'a1', LOW, target='#a')
+    scheduler.put(b'a2', LOW, target='#a')
+    scheduler.put(b'b1', LOW, target='#b')
+    assert scheduler.drop() == b'a1'
+    assert scheduler.drop(NORMAL) is None
+    assert drain(scheduler) == [b'a2', b'b1']
+    assert scheduler.stats()['dropped'] == 1
+
+
+def main():
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import awirc
+import awirc.scheduler
+import awirc.utils
+import awirc.wire
+
+
+M = awirc.utils.M_QUOTE
+
+
+def dequote(line):
+    '''the text of a serialized line, as the server relays it'''
+    return awirc.utils.low_dequote(line.rstrip(b'\r\n').decode('utf-8'))
+
+
+def queued(client):
+    lines = list()
+    while len(client.scheduler):
+        message, _ = client.scheduler.pop()
+        lines.append(message)
+    return lines
+
+
+def offline_client():
+    return awirc.Client('nick', 'irc.example.net', 6667,
+                        scheduler=awirc.scheduler.Scheduler())
+
+
+def test_quote():
+    assert awirc.wire.quote(b'plain') == b'plain'
+    assert awirc.wire.quote(b'a\x00b\rc\nd\x10') == \
+        b'a\x100b\x10rc\x10nd\x10\x10'
+
+
+def test_encode():
+    assert awirc.wire.encode('PRIVMSG #c :hi') == b'PRIVMSG #c :hi\r\n'
+    assert awirc.wire.encode('PRIVMSG #c :a\nb') == \
+        b'PRIVMSG #c :a\x10nb\r\n'
+
+
+def test_truncate():
+    line = awirc.wire.encode('TOPIC #c :' + 'x' * 600)
+    assert len(line) == 512 and line.endswith(b'x\r\n')
+
+    # not inside a character
+    line = awirc.wire.encode('QUIT :' + '\xe4' * 400)
+    assert len(line) <= 512
+    line.decode('utf-8')
+
+    # not inside a quoted byte
+    for pad in range(4):
+        line = awirc.wire.encode('QUIT :' + 'a' * (500 + pad) + '\n' * 10)
+        assert len(line) <= 512
+        text = line[:-2]
+        assert len(text) - len(text.rstrip(b'\x10')) in (0, 2)
+
+    # tags are not counted
+    line = awirc.wire.encode('@label=x PART #c :' + 'y' * 600)
+    assert len(line) - len(b'@label=x ') == 512
+
+
+def test_truncate_without_trailing():
+    for line in ('MODE ' + 'x' * 600, 'KICK #c ' + 'x' * 600 + ' :r'):
+        try:
+            awirc.wire.encode(line)
+        except ValueError:
+            pass
+        else:
+            assert False, line
+
+
+def test_serializer_text():
+    wire = awirc.wire.Serializer()
+    assert wire.text('PRIVMSG', '#c', 'hi') == b'PRIVMSG #c :hi\r\n'
+    assert wire.text('PRIVMSG', '#c', b'hi') == b'PRIVMSG #c :hi\r\n'
+    line = wire.text('PRIVMSG', '#c', M * 400)
+    assert len(line) <= 512 and line.endswith(b'\x10\x10\r\n')
+
+
+def test_split_quoted():
+    for text in (M * 400, '\x00' * 1000, 'a\x10 ' * 300,
+                 '\xe4\x10\r' * 300 + 'x'):
+        for max_bytes in (1, 2, 3, 7, 400):
+            lines = awirc.utils.split_bytes(text, max_bytes, decode=False,
+                                            quoted=True)
+            for line in lines:
+                line.decode('utf-8')
+                quoted = awirc.wire.quote(line)
+                # a single quoted byte can't be split
+                assert len(quoted) <= max(max_bytes, 2), (text, max_bytes)
+            joined = b''.join(lines).replace(b' ', b'')
+            assert joined == text.encode('utf-8').replace(b' ', b'')
+
+
+def test_split_length():
+    for max_bytes in (0, -3):
+        try:
+            awirc.utils.split_bytes('abcdef', max_bytes)
+        except ValueError:
+            pass
+        else:
+            assert False, max_bytes
+    assert awirc.utils.split_bytes('\xe4\xf6\xfc', 1) == \
+        ['\xe4', '\xf6', '\xfc']
+    assert awirc.utils.split_bytes('ab cd', 3) == ['ab', 'cd']
+
+
+def test_privmsg_control_characters():
+    client = offline_client()
+    for text in (M * 400, '\x00' * 1000, 'a\rb' * 300, '\x01ACTION ' + M):
+        client.privmsg('#c', text)
+        client.notice('nick', text)
+        lines = queued(client)
+        assert all(len(line) <= 512 for line in lines)
+        # nothing is lost, the server relays the dequoted text
+        for command in ('PRIVMSG #c :', 'NOTICE nick :'):
+            relayed = ''.join(
+                dequote(line)[len(command):] for line in lines
+                if dequote(line).startswith(command)
+            )
+            assert relayed.replace(' ', '') == text.replace(' ', '')
+
+
+def main():
+    for name, test in sorted(globals().items()):
+        if name.startswith('test_'):
+            test()
+            print(name, 'ok')
+
+
+if __name__ == '__main__':
+    main()